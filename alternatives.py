@@ -0,0 +1,261 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Precomputed rankings of the viewpoints (alternatives) suggested in Slant topics, and of
+the alternatives to each package.
+
+Viewpoints are ranked by the votes on their pros and cons.  An upvote on a pro or a
+downvote on a con counts for a viewpoint, and the opposite counts against it.  Their
+score is the lower bound of the Wilson score interval for the share of votes that are
+for it, so a viewpoint with a few votes doesn't outrank one with many mostly positive
+votes.
+
+Rankings are computed from the newest fetch of Slant data, and only recomputed when
+there's a newer fetch, or when more rows of the fetch they were computed from have been
+saved since (e.g., if they were computed while the fetch was running).  The top
+viewpoints of each topic are saved in one row per topic, and the topics that suggest
+each package are saved in one row per package, so the alternatives to a package are
+read with a single lookup by its name:
+
+    python alternatives.py --db postgres --db-config postgres-credentials.json
+'''
+
+from __future__ import unicode_literals
+import logging
+import argparse
+import datetime
+import json
+import math
+from collections import defaultdict
+
+from peewee import fn
+from models import init_database, db_proxy, BatchInserter, SlantTopic, Viewpoint, \
+    ViewpointSection, SlantTopicRanking, PackageAlternatives
+
+
+logger = logging.getLogger('data')
+
+# The number of top viewpoints saved for each topic
+DEFAULT_TOP_VIEWPOINTS = 10
+# The most topics saved for a package, starting with those where it ranks highest
+MAX_PACKAGE_TOPICS = 20
+# The z-score for a 95% confidence interval
+WILSON_Z = 1.96
+INSERT_BATCH_SIZE = 500
+
+
+def wilson_lower_bound(positive, negative, z=WILSON_Z):
+    ''' The lower bound of the Wilson score interval for the share of positive votes. '''
+    total = positive + negative
+    if total == 0:
+        return 0.0
+    share = positive / float(total)
+    return (
+        share + z * z / (2 * total) -
+        z * math.sqrt((share * (1 - share) + z * z / (4 * total)) / total)
+    ) / (1 + z * z / total)
+
+
+def latest_fetch_index():
+    return Viewpoint.select(fn.Max(Viewpoint.fetch_index)).scalar()
+
+
+def fetch_data_date(fetch_index):
+    ''' Get the date of the newest viewpoint or section saved for a fetch. '''
+    dates = [
+        Viewpoint.select(fn.Max(Viewpoint.date)).where(
+            Viewpoint.fetch_index == fetch_index).scalar(convert=True),
+        ViewpointSection.select(fn.Max(ViewpointSection.date)).where(
+            ViewpointSection.fetch_index == fetch_index).scalar(convert=True),
+    ]
+    dates = [date for date in dates if date is not None]
+    return max(dates) if dates else None
+
+
+def ranked_fetch():
+    '''
+    Get the index of the fetch that the saved rankings were computed from, and the
+    date of the newest row of that fetch at the time.  Both are None if there are no
+    rankings.
+    '''
+    ranking = (
+        SlantTopicRanking.select(SlantTopicRanking.fetch_index, SlantTopicRanking.data_date)
+        .order_by(SlantTopicRanking.fetch_index.desc())
+        .first()
+    )
+    return (ranking.fetch_index, ranking.data_date) if ranking is not None else (None, None)
+
+
+def _viewpoint_votes(fetch_index):
+    ''' Map the ID of each viewpoint from a fetch to its votes for and against. '''
+    votes = defaultdict(lambda: [0, 0])
+    sections = (
+        ViewpointSection.select(
+            ViewpointSection.viewpoint,
+            ViewpointSection.is_con,
+            fn.Sum(ViewpointSection.upvotes),
+            fn.Sum(ViewpointSection.downvotes))
+        .join(Viewpoint)
+        .where(Viewpoint.fetch_index == fetch_index)
+        .group_by(ViewpointSection.viewpoint, ViewpointSection.is_con)
+        .tuples()
+    )
+    for viewpoint_id, is_con, upvotes, downvotes in sections:
+        upvotes, downvotes = upvotes or 0, downvotes or 0
+        if is_con:
+            upvotes, downvotes = downvotes, upvotes
+        votes[viewpoint_id][0] += upvotes
+        votes[viewpoint_id][1] += downvotes
+    return votes
+
+
+def rank_topics(fetch_index):
+    '''
+    Rank the viewpoints of each topic from a fetch, best first.
+    Returns a dictionary from each topic's SlantTopic row to its ranked viewpoints.
+    '''
+    votes = _viewpoint_votes(fetch_index)
+    topics = {}
+    viewpoints = defaultdict(list)
+    query = (
+        Viewpoint.select(Viewpoint, SlantTopic)
+        .join(SlantTopic)
+        .where(Viewpoint.fetch_index == fetch_index)
+    )
+    for viewpoint in query:
+        topic = topics.setdefault(viewpoint.topic.topic_id, viewpoint.topic)
+        positive, negative = votes[viewpoint.id]
+        viewpoints[topic.topic_id].append({
+            'title': viewpoint.title,
+            'url_path': viewpoint.url_path,
+            'score': round(wilson_lower_bound(positive, negative), 4),
+            'upvotes': positive,
+            'downvotes': negative,
+            '_index': viewpoint.viewpoint_index,
+        })
+
+    rankings = {}
+    for topic_id, topic in topics.items():
+        # Ties keep the order that Slant lists the viewpoints in.
+        ranked = sorted(viewpoints[topic_id], key=lambda item: (-item['score'], item['_index']))
+        for viewpoint in ranked:
+            del viewpoint['_index']
+        rankings[topic] = ranked
+    return rankings
+
+
+def package_topics(rankings, top_viewpoints=DEFAULT_TOP_VIEWPOINTS):
+    '''
+    Index the ranked topics by the packages they suggest.  Returns a dictionary from
+    each package (a lowercase viewpoint title) to the topics that suggest it.  Each topic
+    lists the package's rank, and the top other viewpoints as its alternatives.
+    '''
+    packages = defaultdict(list)
+    for topic, ranked in rankings.items():
+        for rank, viewpoint in enumerate(ranked, start=1):
+            package = viewpoint['title'].strip().lower()
+            packages[package].append({
+                'topic_id': topic.topic_id,
+                'title': topic.title,
+                'url_path': topic.url_path,
+                'rank': rank,
+                'viewpoints': len(ranked),
+                'alternatives': [
+                    alternative for alternative in ranked[:top_viewpoints + 1]
+                    if alternative is not viewpoint][:top_viewpoints],
+            })
+    for topics in packages.values():
+        topics.sort(key=lambda topic: (topic['rank'], -topic['viewpoints'], topic['topic_id']))
+        del topics[MAX_PACKAGE_TOPICS:]
+    return packages
+
+
+def _insert_rows(model, rows):
+    inserter = BatchInserter(model, INSERT_BATCH_SIZE)
+    for row in rows:
+        inserter.insert(row)
+    inserter.flush()
+
+
+def refresh_rankings(top_viewpoints=DEFAULT_TOP_VIEWPOINTS, force=False):
+    '''
+    Recompute the rankings if there's a fetch of Slant data newer than the one they
+    were computed from, or if rows have been added to that fetch since (or if `force`
+    is set).  The rankings from the last fetch are replaced in one transaction, so
+    readers see either the old or the new rankings.
+    Returns the index of the fetch that the rankings are now from.
+    '''
+    fetch_index = latest_fetch_index()
+    ranked_index, ranked_data_date = ranked_fetch()
+    if fetch_index is None:
+        logger.info("There's no Slant data to rank")
+        return ranked_index
+
+    # A fetch that was still running when it was ranked has newer rows than the rankings.
+    data_date = fetch_data_date(fetch_index)
+    up_to_date = (
+        fetch_index == ranked_index and ranked_data_date is not None and
+        data_date is not None and data_date <= ranked_data_date)
+    if up_to_date and not force:
+        logger.info("Slant rankings are up to date (fetch %s)", ranked_index)
+        return ranked_index
+
+    rankings = rank_topics(fetch_index)
+    packages = package_topics(rankings, top_viewpoints)
+    now = datetime.datetime.now()
+    with db_proxy.atomic():
+        SlantTopicRanking.delete().execute()
+        PackageAlternatives.delete().execute()
+        _insert_rows(SlantTopicRanking, [{
+            'fetch_index': fetch_index,
+            'date': now,
+            'data_date': data_date,
+            'topic_id': topic.topic_id,
+            'title': topic.title,
+            'url_path': topic.url_path,
+            'viewpoint_count': len(ranked),
+            'viewpoints': json.dumps(ranked[:top_viewpoints]),
+        } for topic, ranked in rankings.items()])
+        _insert_rows(PackageAlternatives, [{
+            'fetch_index': fetch_index,
+            'date': now,
+            'package': package,
+            'topics': json.dumps(topics),
+        } for package, topics in packages.items()])
+
+    logger.info("Ranked %d Slant topics and %d packages from fetch %d",
+                len(rankings), len(packages), fetch_index)
+    return fetch_index
+
+
+def topic_ranking(topic_id):
+    ''' Get the top viewpoints of a Slant topic, best first, or None if it hasn't been ranked. '''
+    ranking = SlantTopicRanking.select().where(SlantTopicRanking.topic_id == topic_id).first()
+    return json.loads(ranking.viewpoints) if ranking is not None else None
+
+
+def package_alternatives(package):
+    '''
+    Get the Slant topics that suggest a package, each with the top alternatives to it.
+    Returns an empty list if no topic suggests the package.
+    '''
+    row = PackageAlternatives.select(PackageAlternatives.topics).where(
+        PackageAlternatives.package == package.strip().lower()).first()
+    return json.loads(row.topics) if row is not None else []
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rank the viewpoints of Slant topics")
+    parser.add_argument('--db', default='sqlite', choices=['sqlite', 'postgres'])
+    parser.add_argument('--db-config', help="Postgres credentials file")
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP_VIEWPOINTS,
+                        help="Number of top viewpoints to save for each topic")
+    parser.add_argument('--force', action='store_true',
+                        help="Recompute the rankings even if there's no new fetch")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+    init_database(args.db, args.db_config)
+    db_proxy.create_tables([SlantTopicRanking, PackageAlternatives], safe=True)
+    refresh_rankings(args.top, args.force)
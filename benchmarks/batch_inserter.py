@@ -0,0 +1,139 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Benchmark for the cost of flushing batches of sparse rows with BatchInserter.
+
+Both versions of the inserter are timed end to end, saving the same rows in the same
+batches into an in-memory Sqlite database.  "Before" is the old flush: padding each
+row with a set union and a dictionary copy, and then one multi-row INSERT built by
+Peewee's `insert_many`.  "After" is the current flush, which converts rows to tuples
+of database values and saves them with one prepared INSERT executed for each row.
+The padding and the conversion to tuples are also timed on their own.
+
+The default batch size keeps the old multi-row INSERT under Sqlite's limit on bound
+parameters (32766 since Sqlite 3.32).  Run it from the root of the repository:
+
+    python -m benchmarks.batch_inserter
+'''
+
+from __future__ import unicode_literals, print_function
+import argparse
+import copy
+import datetime
+import random
+import timeit
+
+from peewee import SqliteDatabase
+from models import db_proxy, BatchInserter, Post
+
+
+# Fields of a post that are left out of some rows, to make the rows sparse
+OPTIONAL_FIELDS = [
+    'accepted_answer_id', 'parent_id', 'deletion_date', 'view_count', 'owner_user_id',
+    'owner_display_name', 'last_editor_user_id', 'last_editor_display_name',
+    'last_edit_date', 'title', 'tags', 'answer_count', 'favorite_count',
+    'closed_date', 'community_owned_date',
+]
+
+
+def make_rows(count, seed=0):
+    ''' Make rows for posts where each optional field is only set half of the time. '''
+    random_ = random.Random(seed)
+    now = datetime.datetime(2017, 6, 1)
+    rows = []
+    for post_id in range(1, count + 1):
+        row = {
+            'id': post_id,
+            'post_type_id': 1,
+            'creation_date': now,
+            'score': random_.randint(-5, 100),
+            'body': 'body of post %d' % post_id,
+            'last_activity_date': now,
+            'comment_count': random_.randint(0, 10),
+        }
+        for field_name in OPTIONAL_FIELDS:
+            if random_.random() < 0.5:
+                row[field_name] = now if field_name.endswith('date') else 1
+        rows.append(row)
+    return rows
+
+
+def legacy_pad_data(rows):
+    ''' The padding that BatchInserter did before it used the model's fields. '''
+    field_names = set()
+    for row in rows:
+        field_names = field_names.union(row.keys())
+    default_data = {field_name: None for field_name in field_names}
+    for i, _ in enumerate(rows):
+        updated_data = copy.copy(default_data)
+        updated_data.update(rows[i])
+        rows[i] = updated_data
+
+
+def legacy_flush(rows, batch_size):
+    ''' Save rows like BatchInserter's old flush did, a batch at a time. '''
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        legacy_pad_data(batch)
+        with db_proxy.atomic():
+            Post.insert_many(batch).execute()
+
+
+def current_convert(rows, batch_size):
+    inserter = BatchInserter(Post, batch_size)
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        inserter.fields = inserter._choose_fields(batch)
+        inserter._row_values(batch)
+
+
+def current_flush(rows, batch_size):
+    inserter = BatchInserter(Post, batch_size)
+    for row in rows:
+        inserter.insert(row)
+    inserter.flush()
+
+
+def legacy_pad(rows, batch_size):
+    for start in range(0, len(rows), batch_size):
+        legacy_pad_data(rows[start:start + batch_size])
+
+
+def best_time(function, rows, batch_size, repeat):
+    '''
+    Time a function on fresh copies of the rows, and return the fastest run in seconds.
+    The rows it saves are deleted between runs.
+    '''
+    times = []
+    for _ in range(repeat):
+        rows_copy = [dict(row) for row in rows]
+        times.append(timeit.timeit(lambda: function(rows_copy, batch_size), number=1))
+        Post.delete().execute()
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark BatchInserter flushes")
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    db_proxy.initialize(SqliteDatabase(':memory:'))
+    db_proxy.create_tables([Post])
+    rows = make_rows(args.rows)
+    scale = 10000.0 / args.rows
+
+    results = [
+        ("before: full flush", best_time(legacy_flush, rows, args.batch_size, args.repeat)),
+        ("after: full flush", best_time(current_flush, rows, args.batch_size, args.repeat)),
+        ("before: pad rows only", best_time(legacy_pad, rows, args.batch_size, args.repeat)),
+        ("after: convert rows to tuples only", best_time(current_convert, rows, args.batch_size, args.repeat)),
+    ]
+    for name, seconds in results:
+        print("{name:<40} {ms:8.1f} ms per 10k rows".format(name=name, ms=seconds * scale * 1000))
+
+
+if __name__ == '__main__':
+    main()
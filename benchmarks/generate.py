@@ -0,0 +1,206 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+A generator of synthetic Stack Overflow and GitHub data for benchmarks.
+
+The data is generated from a seed, so the same seed and scale always produce the same
+rows.  The scale is the number of posts.  The other tables are sized relative to it,
+roughly in the proportions of the real data: about a third of posts are questions,
+tags are used with a long-tailed distribution (a few tags are on most questions),
+and the packages with the most popular tags have the most GitHub issues.
+'''
+
+from __future__ import unicode_literals
+import bisect
+import datetime
+import random
+from collections import Counter
+
+from models import BatchInserter, Post, Tag, PostTag, Vote, GitHubProject, Issue, IssueComment
+
+
+SCALES = {
+    '10k': 10000,
+    '1m': 1000000,
+    '10m': 10000000,
+}
+DEFAULT_BATCH_SIZE = 10000
+
+# The most popular tags are named after real packages, so pages can be rendered for them.
+PACKAGE_NAMES = [
+    'django', 'numpy', 'pandas', 'flask', 'react', 'express', 'lodash', 'requests',
+    'jquery', 'angular', 'matplotlib', 'scipy', 'tensorflow', 'webpack', 'moment',
+    'sqlalchemy', 'celery', 'pytest', 'redux', 'vue',
+]
+QUESTION_RATE = 0.35
+ACCEPT_RATE = 0.5
+CLOSE_RATE = 0.7
+# The number of posts for each tag, issue, vote, and comment
+POSTS_PER_TAG = 200
+POSTS_PER_ISSUE = 20
+MAX_VOTES_PER_POST = 4
+MAX_COMMENTS_PER_ISSUE = 6
+MAX_TAGS_PER_QUESTION = 5
+
+START_DATE = datetime.datetime(2008, 8, 1)
+END_DATE = datetime.datetime(2017, 6, 1)
+WORDS = (
+    'how do i use the to with a in my when error function file data list object get '
+    'value return string array class import module install version python javascript '
+    'query table json request response server test build run config type not working'
+).split()
+
+
+class WeightedChoice(object):
+    ''' Picks items with a Zipf-like distribution: the item at rank r has weight 1 / r. '''
+    def __init__(self, items, random_):
+        self.items = items
+        self.random = random_
+        self.cumulative_weights = []
+        total = 0.0
+        for rank in range(1, len(items) + 1):
+            total += 1.0 / rank
+            self.cumulative_weights.append(total)
+
+    def choose(self):
+        position = self.random.random() * self.cumulative_weights[-1]
+        index = bisect.bisect_left(self.cumulative_weights, position)
+        return self.items[min(index, len(self.items) - 1)]
+
+
+def tag_names(count):
+    return PACKAGE_NAMES[:count] + ['tag-%d' % rank for rank in range(len(PACKAGE_NAMES), count)]
+
+
+def _date_of(position, count):
+    ''' Spread dates evenly over the period of the data, in order of position. '''
+    return START_DATE + (END_DATE - START_DATE) * position // max(count, 1)
+
+
+def _text(random_, min_words, max_words):
+    return ' '.join(random_.choice(WORDS) for _ in range(random_.randint(min_words, max_words)))
+
+
+def generate_posts(scale, random_, tags, batch_size):
+    '''
+    Save `scale` posts, with the links to their tags and their votes.
+    Returns the number of questions that use each tag.
+    '''
+    post_inserter = BatchInserter(Post, batch_size)
+    post_tag_inserter = BatchInserter(PostTag, batch_size)
+    vote_inserter = BatchInserter(Vote, batch_size)
+    tag_ids = {name: tag_id for tag_id, name in enumerate(tags.items, start=1)}
+    tag_counts = Counter()
+    question_ids = []
+
+    for post_id in range(1, scale + 1):
+        creation_date = _date_of(post_id, scale)
+        row = {
+            'id': post_id,
+            'creation_date': creation_date,
+            'score': random_.randint(-2, 50),
+            'view_count': random_.randint(0, 10000),
+            'body': '<p>' + _text(random_, 40, 300) + '</p>',
+            'owner_user_id': random_.randint(1, scale // 10 + 1),
+            'last_activity_date': creation_date,
+            'comment_count': random_.randint(0, 8),
+        }
+        if not question_ids or random_.random() < QUESTION_RATE:
+            post_tags = set(tags.choose() for _ in range(random_.randint(1, MAX_TAGS_PER_QUESTION)))
+            row.update({
+                'post_type_id': 1,
+                'title': _text(random_, 5, 15),
+                'tags': ''.join('<' + tag + '>' for tag in sorted(post_tags)),
+                'answer_count': random_.randint(0, 5),
+                'favorite_count': random_.randint(0, 20),
+            })
+            if random_.random() < ACCEPT_RATE and post_id < scale:
+                row['accepted_answer_id'] = random_.randint(post_id + 1, min(post_id + 50, scale))
+            for tag in post_tags:
+                post_tag_inserter.insert({'post_id': post_id, 'tag_id': tag_ids[tag]})
+                tag_counts[tag] += 1
+            question_ids.append(post_id)
+        else:
+            row.update({
+                'post_type_id': 2,
+                # Answers usually go to recent questions.
+                'parent_id': question_ids[-random_.randint(1, min(len(question_ids), 100))],
+            })
+        post_inserter.insert(row)
+
+        for _ in range(random_.randint(0, MAX_VOTES_PER_POST)):
+            vote_inserter.insert({
+                'post_id': post_id,
+                'vote_type_id': random_.choice([2, 2, 2, 3]),
+                'creation_date': creation_date + datetime.timedelta(days=random_.randint(0, 365)),
+            })
+
+    for inserter in (post_inserter, post_tag_inserter, vote_inserter):
+        inserter.flush()
+    return tag_counts
+
+
+def generate_tags(tags, tag_counts, batch_size):
+    inserter = BatchInserter(Tag, batch_size)
+    for tag_id, name in enumerate(tags.items, start=1):
+        inserter.insert({'id': tag_id, 'tag_name': name, 'count': tag_counts[name]})
+    inserter.flush()
+
+
+def generate_issues(scale, random_, batch_size):
+    ''' Save a GitHub project for each package, with issues and comments. '''
+    projects = []
+    for name in PACKAGE_NAMES:
+        projects.append(GitHubProject.create(
+            fetch_index=1, name=name, owner=name, repo=name).id)
+    choose_project = WeightedChoice(projects, random_)
+
+    issue_count = max(1, scale // POSTS_PER_ISSUE)
+    issue_inserter = BatchInserter(Issue, batch_size)
+    comment_inserter = BatchInserter(IssueComment, batch_size)
+    for issue_id in range(1, issue_count + 1):
+        created_at = _date_of(issue_id, issue_count)
+        closed_at = None
+        if random_.random() < CLOSE_RATE:
+            closed_at = created_at + datetime.timedelta(hours=random_.randint(1, 24 * 90))
+        comment_count = random_.randint(0, MAX_COMMENTS_PER_ISSUE)
+        issue_inserter.insert({
+            'id': issue_id,
+            'fetch_index': 1,
+            'github_id': issue_id,
+            'project': choose_project.choose(),
+            'number': issue_id,
+            'created_at': created_at,
+            'updated_at': closed_at or created_at,
+            'closed_at': closed_at,
+            'state': 'closed' if closed_at else 'open',
+            'body': _text(random_, 20, 200),
+            'comments': comment_count,
+            'user_id': random_.randint(1, 10000),
+        })
+        for _ in range(comment_count):
+            comment_date = created_at + datetime.timedelta(hours=random_.randint(1, 24 * 30))
+            comment_inserter.insert({
+                'fetch_index': 1,
+                'github_id': random_.randint(1, 2 ** 31 - 1),
+                'issue': issue_id,
+                'created_at': comment_date,
+                'updated_at': comment_date,
+                'body': _text(random_, 5, 80),
+                'user_id': random_.randint(1, 10000),
+            })
+    issue_inserter.flush()
+    comment_inserter.flush()
+
+
+def generate(scale, seed=0, batch_size=DEFAULT_BATCH_SIZE):
+    '''
+    Fill the database with synthetic data for `scale` posts.  The tables have to exist
+    and be empty.
+    '''
+    random_ = random.Random(seed)
+    tags = WeightedChoice(tag_names(max(len(PACKAGE_NAMES), scale // POSTS_PER_TAG)), random_)
+    tag_counts = generate_posts(scale, random_, tags, batch_size)
+    generate_tags(tags, tag_counts, batch_size)
+    generate_issues(scale, random_, batch_size)
@@ -0,0 +1,191 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Benchmarks for loading data and for the queries behind the app's pages, on a local
+Sqlite database filled with synthetic data (see `benchmarks.generate`).
+
+Results are written as JSON.  Pass the results of an earlier run with `--compare`
+to see how much each benchmark changed; the command fails if any got slower than
+the threshold allows.  Run it from the root of the repository:
+
+    python -m benchmarks.run --scale 10k --output before.json
+    python -m benchmarks.run --scale 10k --output after.json --compare before.json
+
+Generating the larger scales takes a long time.  Use `--reuse` to run the query
+benchmarks again on the database from the last run at a scale.
+'''
+
+from __future__ import unicode_literals, print_function
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import sys
+import time
+
+from models import init_database, create_tables, Post, Tag, PostTag, Vote, Issue, IssueComment, \
+    PackageHealth, PackageHealthCheckpoint
+from migrations import migrate
+from benchmarks.generate import SCALES, PACKAGE_NAMES, DEFAULT_BATCH_SIZE, generate
+
+
+DEFAULT_REPEAT = 5
+# A benchmark has regressed if it's this many times slower than in the baseline.
+DEFAULT_THRESHOLD = 1.2
+BENCHMARK_PACKAGES = PACKAGE_NAMES[:5]
+GENERATED_MODELS = [Post, Tag, PostTag, Vote, Issue, IssueComment]
+
+
+def measure(function, repeat):
+    ''' Run a function `repeat` times.  Returns the fastest and median times in milliseconds. '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return {'min_ms': times[0], 'median_ms': times[len(times) // 2], 'repeat': repeat}
+
+
+def load(scale, seed, batch_size):
+    ''' Create the tables and fill them with synthetic data, timing each step. '''
+    results = {}
+    start = time.perf_counter()
+    create_tables()
+    generate(scale, seed, batch_size)
+    load_ms = (time.perf_counter() - start) * 1000
+    row_count = sum(model.select().count() for model in GENERATED_MODELS)
+    results['bulk_load'] = {
+        'min_ms': load_ms, 'median_ms': load_ms, 'repeat': 1,
+        'rows': row_count, 'rows_per_second': row_count / (load_ms / 1000),
+    }
+
+    start = time.perf_counter()
+    migrate(concurrently=False)
+    index_ms = (time.perf_counter() - start) * 1000
+    results['build_indexes'] = {'min_ms': index_ms, 'median_ms': index_ms, 'repeat': 1}
+    return results
+
+
+def run_queries(repeat):
+    ''' Time the queries behind the app's pages. '''
+    # The app connects to the database when it's imported, so it's imported once the
+    # environment tells it to use the benchmark's database.
+    import hello
+    from tags import find_tag, posts_for_package
+    from pagination import post_page
+    from health import refresh_package_health, package_health
+
+    def look_up_tags():
+        for package in BENCHMARK_PACKAGES:
+            find_tag(package)
+            posts_for_package(package)
+
+    def page_through_posts():
+        for package in BENCHMARK_PACKAGES:
+            _, cursor = post_page(package)
+            post_page(package, cursor)
+
+    def aggregate_health():
+        # The rollups are computed from scratch, as for a new package.
+        PackageHealth.delete().execute()
+        PackageHealthCheckpoint.delete().execute()
+        for package in BENCHMARK_PACKAGES:
+            refresh_package_health(package)
+
+    def read_health():
+        for package in BENCHMARK_PACKAGES:
+            package_health(package)
+
+    def render_pages():
+        # The page cache is skipped, to measure the queries and templates.
+        with hello.app.test_request_context():
+            for package in BENCHMARK_PACKAGES:
+                hello.render_package_page.__wrapped__(package, None)
+
+    return {
+        'tag_lookup': measure(look_up_tags, repeat),
+        'post_pages': measure(page_through_posts, repeat),
+        'health_aggregation': measure(aggregate_health, repeat),
+        'health_read': measure(read_health, repeat),
+        'page_render': measure(render_pages, repeat),
+    }
+
+
+def compare(results, baseline, threshold):
+    '''
+    Print how each benchmark changed since the baseline run.  Fastest times are compared,
+    as they vary the least between runs.  Returns the names of the benchmarks that got
+    slower than the threshold allows.
+    '''
+    regressions = []
+    for name, timing in sorted(results['benchmarks'].items()):
+        baseline_timing = baseline['benchmarks'].get(name)
+        if baseline_timing is None:
+            print("{name:<20} {ms:10.1f} ms   (new)".format(name=name, ms=timing['min_ms']))
+            continue
+        ratio = timing['min_ms'] / max(baseline_timing['min_ms'], 1e-6)
+        regressed = ratio > threshold
+        if regressed:
+            regressions.append(name)
+        print("{name:<20} {ms:10.1f} ms   {ratio:5.2f}x baseline{flag}".format(
+            name=name, ms=timing['min_ms'], ratio=ratio, flag='   REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark data loading and page queries on Sqlite")
+    parser.add_argument('--scale', default='10k', choices=sorted(SCALES.keys()),
+                        help="Number of posts to generate")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--db-file', help="Sqlite database file (default: benchmark-<scale>.db)")
+    parser.add_argument('--reuse', action='store_true',
+                        help="Reuse the database from an earlier run instead of generating data")
+    parser.add_argument('--output', default='benchmark-results.json', help="File to write results to")
+    parser.add_argument('--compare', help="Results of an earlier run to compare with")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="Slowdown relative to the earlier run that counts as a regression")
+    args = parser.parse_args()
+
+    db_file = args.db_file or 'benchmark-{scale}.db'.format(scale=args.scale)
+    if not args.reuse and os.path.exists(db_file):
+        os.remove(db_file)
+    os.environ['DATABASE_TYPE'] = 'sqlite'
+    os.environ['SQLITE_FILENAME'] = db_file
+    init_database('sqlite', sqlite_filename=db_file)
+
+    benchmarks = {}
+    if not args.reuse:
+        benchmarks.update(load(SCALES[args.scale], args.seed, args.batch_size))
+    benchmarks.update(run_queries(args.repeat))
+
+    results = {
+        'scale': args.scale,
+        'posts': SCALES[args.scale],
+        'seed': args.seed,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'benchmarks': benchmarks,
+    }
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('scale') != args.scale:
+            print("Warning: the baseline was run at scale {scale}".format(scale=baseline.get('scale')))
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+    else:
+        for name, timing in sorted(benchmarks.items()):
+            print("{name:<20} {ms:10.1f} ms".format(name=name, ms=timing['median_ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import functools
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from peewee import fn
+from models import FETCH_INDEX_FIELDS, PackageHealthCheckpoint, SlantTopicRanking
+
+
+logger = logging.getLogger('data')
+
+DEFAULT_MAX_ENTRIES = 1024
+# The most entries kept in a shared cache store
+DEFAULT_MAX_STORE_ENTRIES = 10000
+DEFAULT_TTL = 600  # seconds
+# How often to look up whether new data has landed, in seconds
+DEFAULT_VERSION_CHECK_INTERVAL = 5
+
+# The data shown by the app only changes when one of these increases: when there's
+# a new fetch, or when the health rollups or the Slant rankings are recomputed.
+# Rankings can be recomputed from the same fetch, so their date is used.
+DEFAULT_VERSION_FIELDS = FETCH_INDEX_FIELDS + [
+    PackageHealthCheckpoint.compute_index,
+    SlantTopicRanking.date,
+]
+
+_MISSING = object()
+
+
+def data_version(fields):
+    '''
+    Get the newest value of each of a list of fields (e.g., the newest fetch_index).
+    Values other than numbers (e.g., dates) are converted to text, so versions can be
+    saved as JSON.
+    '''
+    values = [field.model_class.select(fn.Max(field)).scalar() for field in fields]
+    return tuple(
+        value if value is None or isinstance(value, (int, float)) else str(value)
+        for value in values)
+
+
+class SqliteCacheStore(object):
+    '''
+    A cache store in a local Sqlite file, which lets the processes of a server
+    (e.g., uWSGI workers) share cached values.  Values are pickled.
+
+    Entries are removed when the data version changes, but the version can stay the
+    same for a long time between fetches.  So expired entries are also removed
+    whenever a value is saved, and the entries that expire soonest are removed
+    beyond `max_entries`, so that the file doesn't keep growing.
+    '''
+    def __init__(self, filename, timeout=5, max_entries=DEFAULT_MAX_STORE_ENTRIES):
+        self.filename = filename
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self._local = threading.local()
+
+    def _connection(self):
+        # Connections can't be shared across threads, or with processes forked after they were opened.
+        if getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.filename, timeout=self.timeout, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, version TEXT, expires REAL, value BLOB)")
+            connection.execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def get(self, key, version):
+        row = self._connection().execute(
+            "SELECT value FROM cache WHERE key = ? AND version = ? AND expires > ?",
+            (key, json.dumps(version), time.time())).fetchone()
+        return _MISSING if row is None else pickle.loads(row[0])
+
+    def set(self, key, version, expires, value):
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO cache (key, version, expires, value) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(version), expires, sqlite3.Binary(pickle.dumps(value))))
+        connection.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+        connection.execute(
+            "DELETE FROM cache WHERE key IN "
+            "(SELECT key FROM cache ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,))
+
+    def prune(self, version):
+        ''' Remove entries that have expired or that are from an older version of the data. '''
+        self._connection().execute(
+            "DELETE FROM cache WHERE version != ? OR expires <= ?",
+            (json.dumps(version), time.time()))
+
+
+class QueryCache(object):
+    '''
+    A least-recently-used cache for query results and rendered pages.
+
+    Entries expire after `ttl` seconds.  They are also invalidated as soon as the
+    newest value of one of the `version_fields` changes (e.g., when a new fetch
+    lands), as every entry is tagged with the version of the data it was computed
+    from.  The version is looked up at most once every `version_check_interval` seconds.
+
+    If a `store` is given (e.g., a SqliteCacheStore), it's used as a second level
+    of caching that can be shared with other processes.
+    '''
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, store=None,
+                 version_fields=None, version_check_interval=DEFAULT_VERSION_CHECK_INTERVAL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.store = store
+        self.version_fields = version_fields if version_fields is not None \
+            else DEFAULT_VERSION_FIELDS
+        self.version_check_interval = version_check_interval
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._version_checked_at = None
+
+    def version(self):
+        ''' Get the version of the data that cached values should have been computed from. '''
+        now = time.time()
+        if self._version_checked_at is not None and \
+                now - self._version_checked_at < self.version_check_interval:
+            return self._version
+
+        version = list(data_version(self.version_fields))
+        with self._lock:
+            if version != self._version:
+                if self._version is not None:
+                    logger.info("Data version changed to %s, clearing cache", version)
+                    if self.store is not None:
+                        self.store.prune(version)
+                self._entries.clear()
+                self._version = version
+            self._version_checked_at = now
+        return version
+
+    def get(self, key, default=None):
+        ''' Look up a cached value.  Returns `default` if there's no fresh value for the key. '''
+        version = self.version()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > time.time():
+                    self._entries.move_to_end(key)
+                    return value
+                del self._entries[key]
+
+        if self.store is not None:
+            value = self.store.get(key, version)
+            if value is not _MISSING:
+                self._remember(key, time.time() + self.ttl, value)
+                return value
+        return default
+
+    def set(self, key, value):
+        version = self.version()
+        expires = time.time() + self.ttl
+        self._remember(key, expires, value)
+        if self.store is not None:
+            try:
+                self.store.set(key, version, expires, value)
+            except (pickle.PicklingError, TypeError, AttributeError):
+                logger.warning("Could not save value for %s to the shared cache", key)
+
+    def _remember(self, key, expires, value):
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def cached(self, namespace):
+        '''
+        A decorator that caches the return values of a function, keyed by `namespace`
+        and the function's arguments.  Arguments must be serializable as JSON.
+        '''
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                key = namespace + ':' + json.dumps([args, kwargs], sort_keys=True, default=str)
+                value = self.get(key, _MISSING)
+                if value is _MISSING:
+                    value = function(*args, **kwargs)
+                    self.set(key, value)
+                return value
+            return wrapper
+        return decorator
@@ -0,0 +1,304 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Export of Stack Overflow posts and votes to columnar files, and activity trends of tags
+computed from them offline.
+
+Trends group hundreds of millions of votes by month and tag, which is slow to do one
+row at a time.  The export saves each column of the posts and votes as a NumPy array
+in its own .npy file, with one directory for each month of the rows' creation dates:
+
+    columns/manifest.json
+    columns/posts/2017-01/{id,post_type_id,parent_id,score,creation_date}.npy
+    columns/votes/2017-01/{post_id,vote_type_id,creation_date}.npy
+    columns/post_tags/{post_id,tag_id}.npy  (sorted by post ID)
+    columns/tags/{tag_id,tag_name}.npy
+
+Columns are memory-mapped when they're read, and trends are computed with vectorized
+operations over a month's columns at a time, so they don't need the database at all.
+NumPy needs to be installed:
+
+    pip install numpy
+    python columnar.py --db postgres --db-config postgres-credentials.json --export columns
+    python columnar.py --columns columns --tag django --tag flask
+'''
+
+from __future__ import unicode_literals, print_function
+import logging
+import argparse
+import datetime
+import json
+import os
+import shutil
+from collections import OrderedDict
+
+from peewee import fn
+from models import init_database, Post, Vote, PostTag, Tag
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+logger = logging.getLogger('data')
+
+DEFAULT_BATCH_SIZE = 100000
+MANIFEST_FILENAME = 'manifest.json'
+QUESTION_POST_TYPE = 1
+ANSWER_POST_TYPE = 2
+UP_VOTE_TYPE = 2
+DOWN_VOTE_TYPE = 3
+
+# The tables that are exported by month: the model, the field whose month a row is
+# saved under, and each column's name, the expression it's read from, and its type.
+# Missing IDs are saved as -1.
+MONTHLY_TABLES = OrderedDict([
+    ('posts', (Post, 'creation_date', OrderedDict([
+        ('id', (Post.id, 'int32')),
+        ('post_type_id', (Post.post_type_id, 'int8')),
+        ('parent_id', (fn.COALESCE(Post.parent_id, -1), 'int32')),
+        ('score', (Post.score, 'int32')),
+        ('creation_date', (Post.creation_date, 'datetime64[s]')),
+    ]))),
+    ('votes', (Vote, 'creation_date', OrderedDict([
+        ('post_id', (Vote.post_id, 'int32')),
+        ('vote_type_id', (Vote.vote_type_id, 'int8')),
+        ('creation_date', (Vote.creation_date, 'datetime64[s]')),
+    ]))),
+])
+
+
+def _require_numpy():
+    if numpy is None:
+        raise RuntimeError("NumPy is needed for columnar exports (pip install numpy)")
+
+
+def _read_batches(model, columns, batch_size):
+    '''
+    Read the rows of a table in batches, in order of ID.  Yields a dictionary from each
+    column's name to an array of its values.
+    '''
+    last_id = -1
+    expressions = [expression for expression, _ in columns.values()]
+    while True:
+        rows = list(
+            model.select(model.id, *expressions)
+            .where(model.id > last_id)
+            .order_by(model.id)
+            .limit(batch_size)
+            .tuples()
+        )
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        yield OrderedDict(
+            (name, numpy.array([row[position] for row in rows], dtype=dtype))
+            for position, (name, (_, dtype)) in enumerate(columns.items(), start=1))
+
+
+def _finish_columns(directory, columns):
+    ''' Convert the raw column files in a directory to .npy files.  Returns the row count. '''
+    row_count = 0
+    for name, (_, dtype) in columns.items():
+        raw_path = os.path.join(directory, name + '.raw')
+        values = numpy.fromfile(raw_path, dtype=dtype)
+        numpy.save(os.path.join(directory, name + '.npy'), values)
+        os.remove(raw_path)
+        row_count = len(values)
+    return row_count
+
+
+def export_monthly_table(directory, name, batch_size=DEFAULT_BATCH_SIZE):
+    '''
+    Save a table's columns into one directory per month.  Each batch's rows are appended
+    to raw files for their months, which are converted to .npy files at the end, so only
+    one batch is held in memory.  Returns the number of rows saved for each month.
+    '''
+    model, date_column, columns = MONTHLY_TABLES[name]
+    table_directory = os.path.join(directory, name)
+    month_directories = {}
+    for batch in _read_batches(model, columns, batch_size):
+        months = batch[date_column].astype('datetime64[M]')
+        for month in numpy.unique(months):
+            month_name = str(month)
+            if month_name not in month_directories:
+                month_directories[month_name] = os.path.join(table_directory, month_name)
+                os.makedirs(month_directories[month_name])
+            in_month = months == month
+            for column, values in batch.items():
+                with open(os.path.join(month_directories[month_name], column + '.raw'), 'ab') as raw_file:
+                    values[in_month].tofile(raw_file)
+
+    row_counts = OrderedDict()
+    for month_name in sorted(month_directories):
+        row_counts[month_name] = _finish_columns(month_directories[month_name], columns)
+    logger.info("Exported %d rows of %s", sum(row_counts.values()), name)
+    return row_counts
+
+
+def export_post_tags(directory, batch_size=DEFAULT_BATCH_SIZE):
+    ''' Save the links between posts and tags, sorted by post ID, and the names of tags. '''
+    columns = OrderedDict([('post_id', (PostTag.post_id, 'int32')), ('tag_id', (PostTag.tag_id, 'int32'))])
+    link_directory = os.path.join(directory, 'post_tags')
+    os.makedirs(link_directory)
+    for column in columns:
+        open(os.path.join(link_directory, column + '.raw'), 'wb').close()
+    for batch in _read_batches(PostTag, columns, batch_size):
+        for column, values in batch.items():
+            with open(os.path.join(link_directory, column + '.raw'), 'ab') as raw_file:
+                values.tofile(raw_file)
+    _finish_columns(link_directory, columns)
+
+    post_ids = numpy.load(os.path.join(link_directory, 'post_id.npy'))
+    order = numpy.argsort(post_ids, kind='mergesort')
+    for column in columns:
+        path = os.path.join(link_directory, column + '.npy')
+        numpy.save(path, numpy.load(path)[order])
+
+    tag_directory = os.path.join(directory, 'tags')
+    os.makedirs(tag_directory)
+    tags = list(Tag.select(Tag.id, Tag.tag_name).order_by(Tag.id).tuples())
+    numpy.save(os.path.join(tag_directory, 'tag_id.npy'),
+               numpy.array([tag_id for tag_id, _ in tags], dtype='int32'))
+    numpy.save(os.path.join(tag_directory, 'tag_name.npy'),
+               numpy.array([tag_name for _, tag_name in tags], dtype='U'))
+    return len(order)
+
+
+def export(directory, batch_size=DEFAULT_BATCH_SIZE):
+    '''
+    Export the posts, votes, and tags to a directory.  The export is written to a
+    temporary directory first, and replaces the old export when it's complete.
+    '''
+    _require_numpy()
+    temporary_directory = directory.rstrip(os.sep) + '.tmp'
+    if os.path.exists(temporary_directory):
+        shutil.rmtree(temporary_directory)
+    os.makedirs(temporary_directory)
+
+    manifest = {'date': datetime.datetime.now().isoformat(), 'tables': {}}
+    for name, (_, _, columns) in MONTHLY_TABLES.items():
+        manifest['tables'][name] = {
+            'columns': OrderedDict((column, dtype) for column, (_, dtype) in columns.items()),
+            'months': export_monthly_table(temporary_directory, name, batch_size),
+        }
+    manifest['post_tags'] = export_post_tags(temporary_directory, batch_size)
+    with open(os.path.join(temporary_directory, MANIFEST_FILENAME), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.rename(temporary_directory, directory)
+    return manifest
+
+
+class ColumnStore(object):
+    ''' An export, read through memory-mapped columns. '''
+    def __init__(self, directory):
+        _require_numpy()
+        self.directory = directory
+        with open(os.path.join(directory, MANIFEST_FILENAME)) as manifest_file:
+            self.manifest = json.load(manifest_file)
+
+    def months(self, table, start=None, end=None):
+        '''
+        The months that a table has rows for, from the month of `start` up to the month
+        of `end` (both dates, and both optional).
+        '''
+        return [
+            month for month in sorted(self.manifest['tables'][table]['months'])
+            if (start is None or month >= start.strftime('%Y-%m')) and
+            (end is None or month <= end.strftime('%Y-%m'))]
+
+    def column(self, table, month, column):
+        return numpy.load(os.path.join(self.directory, table, month, column + '.npy'), mmap_mode='r')
+
+    def post_tags(self, column):
+        return numpy.load(os.path.join(self.directory, 'post_tags', column + '.npy'), mmap_mode='r')
+
+    def tag_id(self, tag_name):
+        ''' Look up a tag's ID by its name, or return None if there's no such tag. '''
+        names = numpy.load(os.path.join(self.directory, 'tags', 'tag_name.npy'))
+        positions = numpy.flatnonzero(names == tag_name)
+        if not len(positions):
+            return None
+        return int(numpy.load(os.path.join(self.directory, 'tags', 'tag_id.npy'))[positions[0]])
+
+
+def tag_activity(store, tag_id, start=None, end=None):
+    '''
+    Compute the monthly activity of a tag: the questions with the tag that were asked,
+    the answers to them, the score of both, and the up and down votes they got in
+    each month between `start` and `end`.  Returns an OrderedDict of arrays, where
+    'months' holds each month and the other arrays hold the counts for each month.
+    '''
+    post_ids = store.post_tags('post_id')
+    questions = numpy.unique(post_ids[store.post_tags('tag_id') == tag_id])
+
+    # Votes in the window can be for answers from before it, so all answers are found.
+    window_months = set(store.months('posts', start, end)) | set(store.months('votes', start, end))
+    months = sorted(window_months)
+    position = {month: index for index, month in enumerate(months)}
+    activity = OrderedDict([('months', numpy.array(months, dtype='datetime64[M]'))])
+    for name in ('questions', 'answers', 'score', 'up_votes', 'down_votes'):
+        activity[name] = numpy.zeros(len(months), dtype='int64')
+
+    answer_ids = []
+    for month in store.months('posts'):
+        ids = store.column('posts', month, 'id')
+        post_types = store.column('posts', month, 'post_type_id')
+        is_question = (post_types == QUESTION_POST_TYPE) & numpy.isin(ids, questions)
+        is_answer = (post_types == ANSWER_POST_TYPE) & numpy.isin(
+            store.column('posts', month, 'parent_id'), questions)
+        answer_ids.append(ids[is_answer])
+        if month in position:
+            index = position[month]
+            scores = store.column('posts', month, 'score')
+            activity['questions'][index] = numpy.count_nonzero(is_question)
+            activity['answers'][index] = numpy.count_nonzero(is_answer)
+            activity['score'][index] = scores[is_question | is_answer].sum()
+
+    tag_posts = numpy.union1d(questions, numpy.concatenate(answer_ids) if answer_ids else questions)
+    for month in store.months('votes', start, end):
+        index = position[month]
+        for_tag = numpy.isin(store.column('votes', month, 'post_id'), tag_posts)
+        vote_types = store.column('votes', month, 'vote_type_id')[for_tag]
+        activity['up_votes'][index] = numpy.count_nonzero(vote_types == UP_VOTE_TYPE)
+        activity['down_votes'][index] = numpy.count_nonzero(vote_types == DOWN_VOTE_TYPE)
+    return activity
+
+
+def print_activity(tag_name, activity):
+    print(','.join(['tag'] + list(activity.keys())))
+    for index in range(len(activity['months'])):
+        print(','.join([tag_name] + [str(values[index]) for values in activity.values()]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export posts and votes to columns, and compute tag trends")
+    parser.add_argument('--db', default='sqlite', choices=['sqlite', 'postgres'])
+    parser.add_argument('--db-config', help="Postgres credentials file")
+    parser.add_argument('--export', metavar='DIRECTORY', help="Export the database to this directory")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--columns', metavar='DIRECTORY', help="Compute trends from this export")
+    parser.add_argument('--tag', action='append', default=[], help="Tag to compute the trend of")
+    parser.add_argument('--start', help="First month of trends (YYYY-MM)")
+    parser.add_argument('--end', help="Last month of trends (YYYY-MM)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+    if args.export:
+        init_database(args.db, args.db_config)
+        export(args.export, args.batch_size)
+    if args.columns:
+        store = ColumnStore(args.columns)
+        start = datetime.datetime.strptime(args.start, '%Y-%m') if args.start else None
+        end = datetime.datetime.strptime(args.end, '%Y-%m') if args.end else None
+        for tag_name in args.tag:
+            tag_id = store.tag_id(tag_name)
+            if tag_id is None:
+                logger.warning("There is no tag named %s", tag_name)
+                continue
+            print_activity(tag_name, tag_activity(store, tag_id, start, end))
@@ -0,0 +1,175 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Summaries of a package's community from each data source, for comparing packages.
+
+The summaries for each source are computed by separate queries, which are run
+concurrently in a pool of threads.  Each thread borrows its own connection from
+the connection pool, so comparing several packages takes about as long as the
+slowest query, rather than as long as all of them together.
+'''
+
+from __future__ import unicode_literals
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from peewee import fn, OperationalError, InterfaceError
+from models import open_connection, close_connection, reading_from_replicas, Post, PostTag, \
+    GitHubProject, Issue, IssueEvent, Viewpoint, ViewpointSection
+from tags import find_tag
+
+
+logger = logging.getLogger('data')
+
+# This should be less than the size of the connection pool, as each thread holds a connection.
+DEFAULT_MAX_WORKERS = 8
+MAX_COMPARED_PACKAGES = 10
+
+QUESTION_POST_TYPE = 1
+
+
+def stack_overflow_summary(package):
+    ''' Count the Stack Overflow questions with a package's tag, and how many were answered. '''
+    tag = find_tag(package)
+    if tag is None:
+        return None
+    question_count, answered_count, accepted_count, latest_question = (
+        Post.select(
+            fn.Count(Post.id),
+            # Count skips nulls, so this only counts questions with answers.
+            fn.Count(fn.NULLIF(Post.answer_count, 0)),
+            fn.Count(Post.accepted_answer_id),
+            fn.Max(Post.creation_date))
+        .join(PostTag, on=(PostTag.post_id == Post.id))
+        .where((PostTag.tag_id == tag.id) & (Post.post_type_id == QUESTION_POST_TYPE))
+        .tuples()
+        .get()
+    )
+    return {
+        'questions': question_count,
+        'answered_questions': answered_count,
+        'accepted_questions': accepted_count,
+        'latest_question': latest_question,
+    }
+
+
+def github_summary(package):
+    ''' Count the issues and issue events of a package's GitHub project from its newest fetch. '''
+    fetch_index = GitHubProject.select(fn.Max(GitHubProject.fetch_index)).where(
+        GitHubProject.name == package).scalar()
+    if fetch_index is None:
+        return None
+    projects = GitHubProject.select(GitHubProject.id).where(
+        (GitHubProject.name == package) & (GitHubProject.fetch_index == fetch_index))
+
+    issue_count, closed_count, latest_issue = (
+        Issue.select(fn.Count(Issue.id), fn.Count(Issue.closed_at), fn.Max(Issue.created_at))
+        .where(Issue.project << projects)
+        .tuples()
+        .get()
+    )
+    event_count, latest_event = (
+        IssueEvent.select(fn.Count(IssueEvent.id), fn.Max(IssueEvent.created_at))
+        .join(Issue)
+        .where(Issue.project << projects)
+        .tuples()
+        .get()
+    )
+    return {
+        'issues': issue_count,
+        'open_issues': issue_count - closed_count,
+        'closed_issues': closed_count,
+        'latest_issue': latest_issue,
+        'issue_events': event_count,
+        'latest_issue_event': latest_event,
+    }
+
+
+def slant_summary(package):
+    ''' Count the Slant topics that suggest a package, and the pros and cons listed for it. '''
+    fetch_index = Viewpoint.select(fn.Max(Viewpoint.fetch_index)).scalar()
+    if fetch_index is None:
+        return None
+    viewpoints = Viewpoint.select(Viewpoint.id).where(
+        (fn.Lower(Viewpoint.title) == package.lower()) & (Viewpoint.fetch_index == fetch_index))
+
+    topic_count = (
+        Viewpoint.select(fn.Count(fn.Distinct(Viewpoint.topic)))
+        .where(Viewpoint.id << viewpoints)
+        .scalar()
+    )
+    if not topic_count:
+        return None
+    section_count, con_count, upvotes, downvotes = (
+        ViewpointSection.select(
+            fn.Count(ViewpointSection.id),
+            fn.Count(fn.NULLIF(ViewpointSection.is_con, False)),
+            fn.Sum(ViewpointSection.upvotes),
+            fn.Sum(ViewpointSection.downvotes))
+        .where(ViewpointSection.viewpoint << viewpoints)
+        .tuples()
+        .get()
+    )
+    return {
+        'topics': topic_count,
+        'pros': section_count - con_count,
+        'cons': con_count,
+        'upvotes': upvotes or 0,
+        'downvotes': downvotes or 0,
+    }
+
+
+# Each source, and the function that summarizes a package with the source's data
+SOURCES = OrderedDict([
+    ('stack_overflow', stack_overflow_summary),
+    ('github', github_summary),
+    ('slant', slant_summary),
+])
+
+
+def _summarize(summary_function, package):
+    '''
+    Run a summary from a worker thread, with connections of the thread's own.
+    Summaries only read data, so they read from replicas if there are any.
+    '''
+    open_connection()
+    failed = False
+    try:
+        with reading_from_replicas():
+            return summary_function(package)
+    except (OperationalError, InterfaceError):
+        failed = True
+        raise
+    finally:
+        close_connection(discard=failed)
+
+
+def compare_packages(packages, max_workers=DEFAULT_MAX_WORKERS):
+    '''
+    Summarize each package with the data from each source.  The queries for all
+    packages and sources run concurrently.  Yields a (package, summaries) pair for
+    each package as soon as all of its summaries are ready, where `summaries` maps
+    each source to its summary (None if the source has no data for the package).
+    If a source's queries fail, its summary is replaced by an 'error' entry.
+    '''
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for package in packages:
+            for source, summary_function in SOURCES.items():
+                future = executor.submit(_summarize, summary_function, package)
+                futures[future] = (package, source)
+
+        summaries = {package: OrderedDict() for package in packages}
+        for future in as_completed(futures):
+            package, source = futures[future]
+            try:
+                summaries[package][source] = future.result()
+            except Exception:
+                logger.exception("Could not summarize %s data for package %s", source, package)
+                summaries[package][source] = {'error': "Could not load data"}
+
+            if len(summaries[package]) == len(SOURCES):
+                yield package, OrderedDict(
+                    (source, summaries[package][source]) for source in SOURCES)
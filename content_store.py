@@ -0,0 +1,191 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Content-addressed storage for the text of web pages.
+
+Each distinct text is compressed and saved once as a ContentBlob, under the digest of
+its text, and WebPageContent rows refer to it by digest.  Pages that haven't changed
+between fetches share one blob, and checking whether a page has changed only means
+comparing digests.  Texts are compressed with zstandard if it's installed, or with
+zlib otherwise.  Blobs record how they were compressed, so they can be read either way.
+
+To move the text of older rows into blobs, after applying the migrations that add
+content blobs (see `migrations`):
+
+    python content_store.py --db postgres --db-config postgres-credentials.json
+'''
+
+from __future__ import unicode_literals
+import logging
+import argparse
+import base64
+import hashlib
+import zlib
+from functools import lru_cache
+
+from peewee import IntegrityError
+from models import init_database, db_proxy, ContentBlob, WebPageContent, WebPageVersion
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = logging.getLogger('data')
+
+DEFAULT_COMPRESSION = 'zstd' if zstandard is not None else 'zlib'
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 10
+# The number of decompressed texts kept in memory
+CACHE_SIZE = 128
+DEFAULT_BATCH_SIZE = 500
+
+
+def content_digest(text):
+    '''
+    Compute the digest of a text: the base 32 encoding of its SHA-1 hash.  This has the
+    format of the Wayback Machine's digests, but those hash the archived response's
+    bytes, so they don't match the digests of the text saved here.
+    '''
+    return base64.b32encode(hashlib.sha1(text.encode('utf-8')).digest()).decode('ascii')
+
+
+def compress(data, compression):
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    if compression == 'zlib':
+        return zlib.compress(data, ZLIB_LEVEL)
+    return data
+
+
+def decompress(data, compression):
+    if compression == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("The zstandard package is needed to read this content")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if compression == 'zlib':
+        return zlib.decompress(data)
+    return data
+
+
+def store_content(text, compression=DEFAULT_COMPRESSION):
+    '''
+    Save a text as a content blob, unless a blob with the same text already exists.
+    Returns the text's digest.  If compression doesn't make a text smaller, it's
+    saved uncompressed.
+    '''
+    digest = content_digest(text)
+    if ContentBlob.select().where(ContentBlob.digest == digest).exists():
+        return digest
+
+    data = text.encode('utf-8')
+    compressed = compress(data, compression)
+    if len(compressed) >= len(data):
+        compression, compressed = 'none', data
+    try:
+        with db_proxy.atomic():
+            ContentBlob.create(
+                digest=digest, compression=compression, size=len(data), data=compressed)
+    except IntegrityError:
+        # Another process saved the same text in the meantime.
+        pass
+    return digest
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def load_content(digest):
+    ''' Get the text saved under a digest.  Returns None if there's no such content blob. '''
+    row = (
+        ContentBlob.select(ContentBlob.compression, ContentBlob.data)
+        .where(ContentBlob.digest == digest)
+        .tuples()
+        .first()
+    )
+    if row is None:
+        return None
+    compression, data = row
+    # Postgres drivers return binary data as a memoryview.
+    return decompress(bytes(data), compression).decode('utf-8')
+
+
+def save_web_page(url, text, **fields):
+    ''' Save the contents at a URL, storing the text as a content blob.  Returns the new row. '''
+    return WebPageContent.create(url=url, digest=store_content(text), **fields)
+
+
+def page_changed(url, text):
+    ''' Check whether a text differs from the last contents saved for a URL. '''
+    latest_digest = (
+        WebPageContent.select(WebPageContent.digest)
+        .where(WebPageContent.url == url)
+        .order_by(WebPageContent.date.desc(), WebPageContent.id.desc())
+        .scalar()
+    )
+    return latest_digest != content_digest(text)
+
+
+def changed_versions(url):
+    '''
+    Get the versions of a URL archived by the Wayback Machine whose contents differ from
+    the version archived before them, oldest first.  Only these versions need to be fetched.
+    '''
+    versions = (
+        WebPageVersion.select()
+        .where(WebPageVersion.url == url)
+        .order_by(WebPageVersion.timestamp, WebPageVersion.id)
+    )
+    changed = []
+    last_digest = None
+    for version in versions:
+        if version.digest != last_digest:
+            changed.append(version)
+        last_digest = version.digest
+    return changed
+
+
+def deduplicate_contents(batch_size=DEFAULT_BATCH_SIZE):
+    '''
+    Move the text of rows that were saved before content blobs were introduced into
+    content blobs.  Rows are converted in batches, each in its own transaction, so this
+    can be stopped and restarted.  Returns the number of rows that were converted.
+    On Postgres, run VACUUM on the table afterwards to reuse the space that was freed.
+    '''
+    row_count = 0
+    last_id = 0
+    while True:
+        batch = list(
+            WebPageContent.select(WebPageContent.id, WebPageContent.content)
+            .where(
+                (WebPageContent.id > last_id) &
+                WebPageContent.digest.is_null() &
+                WebPageContent.content.is_null(False))
+            .order_by(WebPageContent.id)
+            .limit(batch_size)
+            .tuples()
+        )
+        if not batch:
+            break
+
+        with db_proxy.atomic():
+            for row_id, text in batch:
+                WebPageContent.update(digest=store_content(text), content=None).where(
+                    WebPageContent.id == row_id).execute()
+        row_count += len(batch)
+        last_id = batch[-1][0]
+        logger.info("Moved the contents of %d web pages into content blobs", row_count)
+    return row_count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Move the contents of web pages into compressed, deduplicated content blobs")
+    parser.add_argument('--db', default='sqlite', choices=['sqlite', 'postgres'])
+    parser.add_argument('--db-config', help="Postgres credentials file")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+    init_database(args.db, args.db_config)
+    deduplicate_contents(args.batch_size)
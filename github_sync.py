@@ -0,0 +1,362 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Incremental sync of the issues, comments, and events of GitHub projects.
+
+A full fetch saves a new copy of every issue of a project each time.  A sync keeps one
+row for each project instead, and only asks the API for what changed since the last
+sync: issues and comments updated after the newest 'updated_at' that was saved, and
+events created after the newest event.  Changed rows are upserted on their GitHub IDs
+in bulk, and rows that are already up to date aren't rewritten.  Each page of the API's
+responses is saved in its own transaction, with the sync's progress, so that no
+transaction stays open while the API is read and a sync that stops partway resumes
+after the last page it saved.
+
+When anything changed, the project's row gets the sync's fetch index, so the health
+rollups and caches that watch fetch indexes pick up the changes.
+
+The API is read through a client object with `issues`, `issue_comments`, and
+`issue_events` methods, which yield pages of results.  `GitHubClient` reads the real API, and `FixtureClient`
+reads responses saved in a local JSON file, for trying out syncs without the API.
+
+    python github_sync.py --db postgres --db-config postgres-credentials.json \\
+        --token-file github-token.txt --project requests/requests/requests
+'''
+
+from __future__ import unicode_literals
+import logging
+import argparse
+import datetime
+import json
+import re
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from peewee import fn
+from models import init_database, db_proxy, GitHubProject, GitHubSyncState, \
+    Issue, IssueComment, IssueEvent
+from partitions import PartitionedBatchInserter
+
+
+logger = logging.getLogger('data')
+
+GITHUB_API_URL = 'https://api.github.com'
+GITHUB_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+PAGE_SIZE = 100
+DEFAULT_BATCH_SIZE = 500
+
+NEXT_LINK_PATTERN = re.compile(r'<([^>]+)>;\s*rel="next"')
+ISSUE_NUMBER_PATTERN = re.compile(r'/issues/(\d+)$')
+
+
+def parse_date(text):
+    return datetime.datetime.strptime(text, GITHUB_DATE_FORMAT) if text else None
+
+
+def format_date(date):
+    return date.strftime(GITHUB_DATE_FORMAT)
+
+
+class GitHubClient(object):
+    '''
+    Reads issues, comments, and events from the GitHub API, following its pagination.
+    Each method yields the API's responses, as lists of dictionaries.
+    '''
+    def __init__(self, token=None, api_url=GITHUB_API_URL):
+        self.token = token
+        self.api_url = api_url
+
+    def _get_pages(self, path, params):
+        url = self.api_url + path + '?' + urlencode(params)
+        while url is not None:
+            request = Request(url, headers={'Accept': 'application/vnd.github.v3+json'})
+            if self.token:
+                request.add_header('Authorization', 'token ' + self.token)
+            with urlopen(request) as response:
+                link = response.headers.get('Link') or ''
+                page = json.loads(response.read().decode('utf-8'))
+            yield page
+            match = NEXT_LINK_PATTERN.search(link)
+            url = match.group(1) if match else None
+
+    def issues(self, owner, repo, since=None):
+        ''' Yield pages of a repository's issues updated at or after `since`, in the order they were updated. '''
+        params = {'state': 'all', 'sort': 'updated', 'direction': 'asc', 'per_page': PAGE_SIZE}
+        if since is not None:
+            params['since'] = format_date(since)
+        return self._get_pages('/repos/{owner}/{repo}/issues'.format(owner=owner, repo=repo), params)
+
+    def issue_comments(self, owner, repo, since=None):
+        ''' Yield pages of the comments on a repository's issues updated at or after `since`. '''
+        params = {'sort': 'updated', 'direction': 'asc', 'per_page': PAGE_SIZE}
+        if since is not None:
+            params['since'] = format_date(since)
+        return self._get_pages(
+            '/repos/{owner}/{repo}/issues/comments'.format(owner=owner, repo=repo), params)
+
+    def issue_events(self, owner, repo):
+        ''' Yield pages of the events of a repository's issues, newest first. '''
+        return self._get_pages(
+            '/repos/{owner}/{repo}/issues/events'.format(owner=owner, repo=repo),
+            {'per_page': PAGE_SIZE})
+
+
+class FixtureClient(object):
+    '''
+    Serves issues, comments, and events from a JSON file instead of the API.  The file
+    maps 'owner/repo' to an object with 'issues', 'comments', and 'events' lists, with
+    the same fields as the API's responses.  They're filtered, ordered, and split into
+    pages like the API's.
+    '''
+    def __init__(self, filename, page_size=PAGE_SIZE):
+        with open(filename) as fixture_file:
+            self.repositories = json.load(fixture_file)
+        self.page_size = page_size
+
+    def _items(self, owner, repo, key):
+        return self.repositories.get(owner + '/' + repo, {}).get(key, [])
+
+    def _pages(self, items):
+        for start in range(0, len(items), self.page_size):
+            yield items[start:start + self.page_size]
+
+    def _updated_since(self, items, since):
+        items = [item for item in items if since is None or parse_date(item['updated_at']) >= since]
+        return self._pages(sorted(items, key=lambda item: item['updated_at']))
+
+    def issues(self, owner, repo, since=None):
+        return self._updated_since(self._items(owner, repo, 'issues'), since)
+
+    def issue_comments(self, owner, repo, since=None):
+        return self._updated_since(self._items(owner, repo, 'comments'), since)
+
+    def issue_events(self, owner, repo):
+        return self._pages(sorted(self._items(owner, repo, 'events'),
+                                  key=lambda event: event['created_at'], reverse=True))
+
+
+def sync_project_row(name, owner, repo, fetch_index):
+    '''
+    Get the row that a project is synced into.  The newest row for the project is
+    reused (e.g., the one from its last full fetch), so syncing starts from its issues.
+    '''
+    project = (
+        GitHubProject.select()
+        .where((GitHubProject.owner == owner) & (GitHubProject.repo == repo))
+        .order_by(GitHubProject.fetch_index.desc(), GitHubProject.id.desc())
+        .first()
+    )
+    if project is None:
+        project = GitHubProject.create(fetch_index=fetch_index, name=name, owner=owner, repo=repo)
+    return project
+
+
+def _saved_github_ids(ModelType, date_field, date, project):
+    '''
+    Get the GitHub IDs of a project's saved issues, comments, or events with a date
+    (e.g., the newest 'updated_at' that was synced).
+    '''
+    if date is None:
+        return set()
+    query = ModelType.select(ModelType.github_id).where(date_field == date)
+    if ModelType is Issue:
+        query = query.where(Issue.project == project)
+    else:
+        query = query.join(Issue).where(Issue.project == project)
+    return set(github_id for github_id, in query.tuples())
+
+
+def _save_page(inserter, rows, project, state, fetch_index):
+    '''
+    Save the changed rows from a page of the API's responses, in one transaction with the
+    sync state that the page advanced.  If any rows changed, the project's row is given
+    `fetch_index`.
+    '''
+    with db_proxy.atomic():
+        for row in rows:
+            inserter.insert(row)
+        inserter.flush()
+        if rows:
+            project.fetch_index = fetch_index
+            project.date = datetime.datetime.now()
+            project.save()
+        state.date = datetime.datetime.now()
+        state.save()
+
+
+def _sync_issues(client, project, state, fetch_index, batch_size):
+    inserter = PartitionedBatchInserter(
+        Issue, batch_size, conflict_fields=['project', 'github_id'], newer_field='updated_at')
+    since = state.issues_updated_at
+    # Other issues can be updated in the same second as the newest saved one, after it
+    # was synced, so only the issues saved with that 'updated_at' are skipped.
+    saved_ids = _saved_github_ids(Issue, Issue.updated_at, since, project)
+    count = 0
+    for page in client.issues(project.owner, project.repo, since=since):
+        rows = []
+        for issue in page:
+            updated_at = parse_date(issue['updated_at'])
+            if since is not None and (
+                    updated_at < since or (updated_at == since and issue['id'] in saved_ids)):
+                continue
+            rows.append({
+                'fetch_index': fetch_index,
+                'github_id': issue['id'],
+                'project': project.id,
+                'number': issue['number'],
+                'created_at': parse_date(issue['created_at']),
+                'updated_at': updated_at,
+                'closed_at': parse_date(issue.get('closed_at')),
+                'state': issue['state'],
+                'body': issue.get('body'),
+                'comments': issue.get('comments', 0),
+                'user_id': (issue.get('user') or {}).get('id'),
+            })
+            if state.issues_updated_at is None or updated_at > state.issues_updated_at:
+                state.issues_updated_at = updated_at
+        _save_page(inserter, rows, project, state, fetch_index)
+        count += len(rows)
+    return count
+
+
+def _issue_ids(project):
+    ''' Map the number of each of a project's saved issues to its ID. '''
+    return dict(Issue.select(Issue.number, Issue.id).where(Issue.project == project).tuples())
+
+
+def _sync_comments(client, project, state, fetch_index, issue_ids, batch_size):
+    inserter = PartitionedBatchInserter(
+        IssueComment, batch_size, conflict_fields=['issue', 'github_id', 'created_at'],
+        newer_field='updated_at')
+    since = state.comments_updated_at
+    saved_ids = _saved_github_ids(IssueComment, IssueComment.updated_at, since, project)
+    count = 0
+    for page in client.issue_comments(project.owner, project.repo, since=since):
+        rows = []
+        for comment in page:
+            updated_at = parse_date(comment['updated_at'])
+            if since is not None and (
+                    updated_at < since or (updated_at == since and comment['id'] in saved_ids)):
+                continue
+            match = ISSUE_NUMBER_PATTERN.search(comment['issue_url'])
+            issue_id = issue_ids.get(int(match.group(1))) if match else None
+            if issue_id is None:
+                logger.warning("Skipping comment %s on an issue that hasn't been synced", comment['id'])
+                continue
+            rows.append({
+                'fetch_index': fetch_index,
+                'github_id': comment['id'],
+                'issue': issue_id,
+                'created_at': parse_date(comment['created_at']),
+                'updated_at': updated_at,
+                'body': comment.get('body') or '',
+                'user_id': (comment.get('user') or {}).get('id'),
+            })
+            if state.comments_updated_at is None or updated_at > state.comments_updated_at:
+                state.comments_updated_at = updated_at
+        _save_page(inserter, rows, project, state, fetch_index)
+        count += len(rows)
+    return count
+
+
+def _sync_events(client, project, state, fetch_index, issue_ids, batch_size):
+    # Events never change, so events that were already saved are skipped.
+    inserter = PartitionedBatchInserter(
+        IssueEvent, batch_size, conflict_fields=['issue', 'github_id', 'created_at'],
+        update_on_conflict=False)
+    since = state.events_created_at
+    saved_ids = _saved_github_ids(IssueEvent, IssueEvent.created_at, since, project)
+    newest = since
+    count = 0
+    for page in client.issue_events(project.owner, project.repo):
+        rows = []
+        # Events are listed newest first, so the rest have been saved already.
+        done = False
+        for event in page:
+            created_at = parse_date(event['created_at'])
+            if since is not None:
+                if created_at < since:
+                    done = True
+                    break
+                if created_at == since and event['id'] in saved_ids:
+                    continue
+            issue_id = issue_ids.get((event.get('issue') or {}).get('number'))
+            if issue_id is None:
+                continue
+            rows.append({
+                'fetch_index': fetch_index,
+                'github_id': event['id'],
+                'issue': issue_id,
+                'created_at': created_at,
+                'event': event['event'],
+            })
+            newest = max(newest, created_at) if newest is not None else created_at
+        _save_page(inserter, rows, project, state, fetch_index)
+        count += len(rows)
+        if done:
+            break
+    # The newest events come first, so the watermark only moves once all of the new
+    # events are saved.  A sync that stops before then lists them again, and the events
+    # that were saved are left as they are.
+    state.events_created_at = newest
+    _save_page(inserter, [], project, state, fetch_index)
+    return count
+
+
+def sync_project(client, name, owner, repo, fetch_index, batch_size=DEFAULT_BATCH_SIZE):
+    '''
+    Save the changes to a GitHub project's issues, comments, and events since its last
+    sync.  Returns the number of issues, comments, and events saved.  If there were any,
+    the project's row is given `fetch_index`.
+    '''
+    with db_proxy.atomic():
+        project = sync_project_row(name, owner, repo, fetch_index)
+        state, _ = GitHubSyncState.get_or_create(project=project)
+
+    issue_count = _sync_issues(client, project, state, fetch_index, batch_size)
+    issue_ids = _issue_ids(project)
+    comment_count = _sync_comments(client, project, state, fetch_index, issue_ids, batch_size)
+    event_count = _sync_events(client, project, state, fetch_index, issue_ids, batch_size)
+
+    logger.info("Synced %s/%s: %d issues, %d comments, %d events changed",
+                owner, repo, issue_count, comment_count, event_count)
+    return issue_count, comment_count, event_count
+
+
+def next_fetch_index():
+    return (GitHubProject.select(fn.Max(GitHubProject.fetch_index)).scalar() or 0) + 1
+
+
+def sync_projects(client, projects, batch_size=DEFAULT_BATCH_SIZE):
+    '''
+    Sync several projects, given as (name, owner, repo) tuples.  All of the projects
+    that changed get the same new fetch index, which is returned.
+    '''
+    fetch_index = next_fetch_index()
+    for name, owner, repo in projects:
+        sync_project(client, name, owner, repo, fetch_index, batch_size)
+    return fetch_index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sync the issues of GitHub projects")
+    parser.add_argument('--db', default='sqlite', choices=['sqlite', 'postgres'])
+    parser.add_argument('--db-config', help="Postgres credentials file")
+    parser.add_argument('--token-file', help="File with a GitHub API token")
+    parser.add_argument('--fixture', help="Read responses from this JSON file instead of the API")
+    parser.add_argument('--project', action='append', required=True,
+                        help="A project to sync, as package/owner/repo (can be repeated)")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+    init_database(args.db, args.db_config)
+    db_proxy.create_tables([GitHubProject, Issue, IssueComment, IssueEvent, GitHubSyncState], safe=True)
+
+    token = None
+    if args.token_file:
+        with open(args.token_file) as token_file:
+            token = token_file.read().strip()
+    client = FixtureClient(args.fixture) if args.fixture else GitHubClient(token)
+    sync_projects(client, [tuple(project.split('/', 2)) for project in args.project], args.batch_size)
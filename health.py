@@ -0,0 +1,284 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import argparse
+import datetime
+from collections import defaultdict, Counter
+
+from peewee import fn
+from models import init_database, db_proxy, reading_from_replicas, \
+    Post, PostTag, Vote, GitHubProject, Issue, IssueComment, PackageHealth, PackageHealthCheckpoint
+from tags import find_tag
+
+
+logger = logging.getLogger('data')
+
+# The number of posts whose accepted answers are looked up in one query
+ANSWER_LOOKUP_BATCH_SIZE = 500
+
+QUESTION_POST_TYPE = 1
+ANSWER_POST_TYPE = 2
+ACCEPT_VOTE_TYPE = 1
+QUESTION_FIELDS = [
+    'question_count', 'answered_question_count', 'accepted_question_count', 'accept_hours_total']
+GITHUB_FIELDS = ['issues_opened', 'issues_closed', 'close_hours_total', 'issue_comment_count']
+
+
+def _month(date):
+    return datetime.datetime(date.year, date.month, 1)
+
+
+def _hours_between(start, end):
+    return (end - start).total_seconds() / 3600.0
+
+
+def next_compute_index():
+    ''' Get a compute index that is newer than that of all existing health rollups. '''
+    latest = PackageHealthCheckpoint.select(fn.Max(PackageHealthCheckpoint.compute_index)).scalar()
+    return (latest or 0) + 1
+
+
+def _next_month(month):
+    return datetime.datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def _tag_questions(tag, query):
+    ''' Restrict a query of posts to the questions with a tag. '''
+    return query.join(PostTag, on=(PostTag.post_id == Post.id)).where(
+        (PostTag.tag_id == tag.id) & (Post.post_type_id == QUESTION_POST_TYPE))
+
+
+def _changed_question_months(tag, last_post_id, last_vote_id, max_post_id, max_vote_id):
+    '''
+    Find the months in which the questions with a tag were asked that have changed
+    since the checkpoint: months with new questions, with questions that got new
+    answers, or with questions whose answers were accepted since.  Posts and votes up
+    to `max_post_id` and `max_vote_id` are considered.
+    '''
+    Question = Post.alias()
+    new_questions = _tag_questions(tag, Post.select(Post.creation_date)).where(
+        (Post.id > last_post_id) & (Post.id <= max_post_id))
+    answered_questions = (
+        Question.select(Question.creation_date)
+        .join(Post, on=(Post.parent_id == Question.id))
+        .switch(Question)
+        .join(PostTag, on=(PostTag.post_id == Question.id))
+        .where(
+            (PostTag.tag_id == tag.id) &
+            (Post.post_type_id == ANSWER_POST_TYPE) &
+            (Post.id > last_post_id) & (Post.id <= max_post_id))
+    )
+    accepted_questions = (
+        Question.select(Question.creation_date)
+        .join(Post, on=(Post.parent_id == Question.id))
+        .join(Vote, on=(Vote.post_id == Post.id))
+        .switch(Question)
+        .join(PostTag, on=(PostTag.post_id == Question.id))
+        .where(
+            (PostTag.tag_id == tag.id) &
+            (Vote.vote_type_id == ACCEPT_VOTE_TYPE) &
+            (Vote.id > last_vote_id) & (Vote.id <= max_vote_id))
+    )
+
+    months = set()
+    for query in (new_questions, answered_questions, accepted_questions):
+        for creation_date, in query.tuples().iterator():
+            months.add(_month(creation_date))
+    return months
+
+
+def _question_metrics(tag, months):
+    '''
+    Compute the metrics for the questions with a tag that were asked in some months.
+    Answers and accepted answers are looked up from the answers themselves, so the
+    metrics are right even if the questions' answer counts weren't updated.
+    Returns a dictionary from each month to its metrics.
+    '''
+    metrics = {month: Counter() for month in months}
+    if not months:
+        return metrics
+    questions = _tag_questions(
+        tag, Post.select(Post.id, Post.creation_date, Post.accepted_answer_id)).where(
+            (Post.creation_date >= min(months)) & (Post.creation_date < _next_month(max(months))))
+    questions = [
+        question for question in questions.tuples().iterator()
+        if _month(question[1]) in metrics]
+
+    for start in range(0, len(questions), ANSWER_LOOKUP_BATCH_SIZE):
+        batch = questions[start:start + ANSWER_LOOKUP_BATCH_SIZE]
+        question_ids = [question[0] for question in batch]
+        answer_dates = {}
+        answered = set()
+        answers = Post.select(Post.id, Post.parent_id, Post.creation_date).where(
+            (Post.parent_id << question_ids) & (Post.post_type_id == ANSWER_POST_TYPE))
+        for answer_id, question_id, answered_date in answers.tuples():
+            answer_dates[answer_id] = answered_date
+            answered.add(question_id)
+        # The accepted answer is also recorded by an accept vote, in case the question wasn't updated.
+        accepted = dict(
+            Post.select(Post.parent_id, Post.id)
+            .join(Vote, on=(Vote.post_id == Post.id))
+            .where((Post.parent_id << question_ids) & (Vote.vote_type_id == ACCEPT_VOTE_TYPE))
+            .tuples())
+
+        for question_id, asked_date, accepted_answer_id in batch:
+            bucket = metrics[_month(asked_date)]
+            bucket['question_count'] += 1
+            if question_id in answered:
+                bucket['answered_question_count'] += 1
+            # The time until an answer was accepted is measured until the accepted answer was posted.
+            accepted_answer_id = accepted_answer_id or accepted.get(question_id)
+            if accepted_answer_id in answer_dates:
+                bucket['accepted_question_count'] += 1
+                bucket['accept_hours_total'] += _hours_between(
+                    asked_date, answer_dates[accepted_answer_id])
+    return metrics
+
+
+def _roll_up_questions(tag, checkpoint):
+    '''
+    Recompute the metrics of the months whose questions with a tag have changed since
+    the checkpoint.  Questions can be answered or have an answer accepted long after
+    they're asked, so a month's metrics are replaced rather than added to.
+    Returns a dictionary from each changed month to its metrics, and the IDs of the
+    last post and vote that were considered.
+    '''
+    max_post_id = Post.select(fn.Max(Post.id)).scalar() or 0
+    max_vote_id = Vote.select(fn.Max(Vote.id)).scalar() or 0
+    if checkpoint.last_vote_id is None:
+        # The first rollup (or the first since votes were recorded) covers every month.
+        months = set(
+            _month(creation_date) for creation_date, in
+            _tag_questions(tag, Post.select(Post.creation_date)).where(
+                Post.id <= max_post_id).tuples().iterator())
+    else:
+        months = _changed_question_months(
+            tag, checkpoint.last_post_id, checkpoint.last_vote_id, max_post_id, max_vote_id)
+    return _question_metrics(tag, months), max_post_id, max_vote_id
+
+
+def _roll_up_issues(package, fetch_index, buckets):
+    '''
+    Add the metrics for the issues of a package's GitHub project, as of one fetch, to the
+    monthly buckets.  The issues are those of the project rows with that fetch index.
+    A synced project keeps one row, and its issues can be from earlier syncs.
+    '''
+    projects = GitHubProject.select(GitHubProject.id).where(
+        (GitHubProject.name == package) & (GitHubProject.fetch_index == fetch_index))
+
+    issues = Issue.select(Issue.created_at, Issue.closed_at).where(
+        Issue.project << projects).tuples()
+    for created_at, closed_at in issues.iterator():
+        buckets[_month(created_at)]['issues_opened'] += 1
+        if closed_at is not None:
+            bucket = buckets[_month(closed_at)]
+            bucket['issues_closed'] += 1
+            bucket['close_hours_total'] += _hours_between(created_at, closed_at)
+
+    comments = (
+        IssueComment.select(IssueComment.created_at)
+        .join(Issue)
+        .where(Issue.project << projects)
+        .tuples()
+    )
+    for created_at, in comments.iterator():
+        buckets[_month(created_at)]['issue_comment_count'] += 1
+
+
+def refresh_package_health(package, compute_index=None):
+    '''
+    Bring the health rollup for a package up to date.
+
+    Only data that has changed since the last refresh is read: the Stack Overflow
+    questions of months with new questions, answers, or accepted answers, and GitHub
+    issues if there is a newer fetch of the package's project.  If neither exists,
+    this doesn't touch the rollup.
+
+    The data is read from replicas if there are any.  A replica that is behind only
+    delays new data until the next refresh, as the checkpoint records what was read.
+    '''
+    compute_index = compute_index if compute_index is not None else next_compute_index()
+    checkpoint, _ = PackageHealthCheckpoint.get_or_create(
+        package=package, defaults={'compute_index': compute_index})
+
+    question_months = {}
+    buckets = defaultdict(Counter)
+    last_post_id, last_vote_id = checkpoint.last_post_id, checkpoint.last_vote_id
+    with reading_from_replicas():
+        tag = find_tag(package)
+        if tag is not None:
+            question_months, last_post_id, last_vote_id = _roll_up_questions(tag, checkpoint)
+
+        github_fetch_index = GitHubProject.select(fn.Max(GitHubProject.fetch_index)).where(
+            GitHubProject.name == package).scalar()
+        # A replica that is behind can have an older fetch than the one rolled up, which
+        # mustn't replace it.  The fetch's issues are read from the same replica.
+        new_github_fetch = (
+            github_fetch_index is not None and
+            (checkpoint.github_fetch_index is None or
+             github_fetch_index > checkpoint.github_fetch_index))
+        if new_github_fetch:
+            _roll_up_issues(package, github_fetch_index, buckets)
+
+    if not question_months and not buckets and not new_github_fetch:
+        if tag is not None:
+            checkpoint.last_post_id, checkpoint.last_vote_id = last_post_id, last_vote_id
+            checkpoint.save()
+        return
+
+    with db_proxy.atomic():
+
+        # Issues from a new fetch replace the issues from the last fetch, rather than add to them.
+        if new_github_fetch:
+            PackageHealth.update(
+                compute_index=compute_index,
+                **{field: 0 for field in GITHUB_FIELDS}
+            ).where(PackageHealth.package == package).execute()
+
+        for month in set(question_months) | set(buckets):
+            row, _ = PackageHealth.get_or_create(
+                package=package, month=month, defaults={'compute_index': compute_index})
+            if month in question_months:
+                for field in QUESTION_FIELDS:
+                    setattr(row, field, question_months[month][field])
+            for field, increment in buckets[month].items():
+                setattr(row, field, getattr(row, field) + increment)
+            row.compute_index = compute_index
+            row.date = datetime.datetime.now()
+            row.save()
+
+        checkpoint.last_post_id = last_post_id
+        checkpoint.last_vote_id = last_vote_id
+        if new_github_fetch:
+            checkpoint.github_fetch_index = github_fetch_index
+        checkpoint.compute_index = compute_index
+        checkpoint.date = datetime.datetime.now()
+        checkpoint.save()
+
+
+def package_health(package):
+    ''' Fetch the monthly health metrics for a package, oldest month first. '''
+    return list(
+        PackageHealth.select()
+        .where(PackageHealth.package == package)
+        .order_by(PackageHealth.month)
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Refresh the health rollups of packages")
+    parser.add_argument('packages', nargs='+')
+    parser.add_argument('--db', default='sqlite', choices=['sqlite', 'postgres'])
+    parser.add_argument('--db-config', help="Postgres credentials file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+    init_database(args.db, args.db_config)
+    db_proxy.create_tables([PackageHealth, PackageHealthCheckpoint], safe=True)
+
+    compute_index = next_compute_index()
+    for package in args.packages:
+        logger.info("Refreshing health of package %s", package)
+        refresh_package_health(package, compute_index)
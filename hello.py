@@ -1,17 +1,197 @@
-from flask import Flask, render_template
+import datetime
+import json
+import os
+from flask import Flask, Response, render_template, request, jsonify, abort
 from flask_bootstrap import Bootstrap
-from models import init_database, Post
+from peewee import OperationalError, InterfaceError
+from models import init_database, open_connection, close_connection, read_from_replicas
+from pagination import post_page, issue_page, issue_comment_page, InvalidCursor, \
+    DEFAULT_PAGE_SIZE
+from health import package_health
+from compare import compare_packages, MAX_COMPARED_PACKAGES
+from snapshots import question_growth, tag_growth
+from post_graph import load_graph
+from alternatives import package_alternatives
+from search import search_posts
+from tags import find_tag
+from cache import QueryCache, SqliteCacheStore
+import instrumentation
 
 app = Flask(__name__)
 Bootstrap(app)
-init_database('postgres', 'postgres-credentials.json')
+# The database can be changed through the environment (e.g., DATABASE_TYPE=sqlite for benchmarks).
+init_database(
+    os.environ.get('DATABASE_TYPE', 'postgres'),
+    os.environ.get('DATABASE_CONFIG', 'postgres-credentials.json'),
+    pooled=True,
+    sqlite_filename=os.environ.get('SQLITE_FILENAME'))
+instrumentation.install(
+    slow_query_ms=float(os.environ.get('SLOW_QUERY_MS', instrumentation.DEFAULT_SLOW_QUERY_MS)),
+    explain_slow_queries=os.environ.get('EXPLAIN_SLOW_QUERIES') == '1')
+
+DEFAULT_PACKAGE = 'django'
+# Rendered pages are shared by all of the server's worker processes through this file.
+PAGE_CACHE_FILENAME = 'page-cache.db'
+
+page_cache = QueryCache(store=SqliteCacheStore(PAGE_CACHE_FILENAME))
+
+
+# Each request borrows a connection from the pool and gives it back when it's done.
+# A connection that failed is thrown away, so the next request gets a fresh one.
+# Pages only read data, so they read from replicas if there are any.
+@app.before_request
+def open_database_connection():
+    instrumentation.start_request()
+    open_connection()
+    read_from_replicas(True)
+
+
+@app.teardown_request
+def close_database_connection(exception):
+    read_from_replicas(False)
+    close_connection(discard=isinstance(exception, (OperationalError, InterfaceError)))
+    instrumentation.finish_request(request.endpoint)
+
 
 @app.route('/')
 def hello_world():
     #return 'Not dead. Yet.'
-    ten = Post.select().where(Post.title.contains('Django')).limit(10)
-    print(ten[0].title)
-    return render_template('index.html',results=ten)
+    package = request.args.get('package', DEFAULT_PACKAGE)
+    try:
+        return render_package_page(package, request.args.get('cursor'))
+    except InvalidCursor:
+        abort(400)
+
+
+@page_cache.cached('index')
+def render_package_page(package, cursor):
+    ten, next_cursor = post_page(package, cursor, per_page=10)
+    health = package_health(package)
+    return render_template('index.html',results=ten, package=package, health=health,
+                           next_cursor=next_cursor)
+
+
+def _json_value(value):
+    return value.isoformat() if isinstance(value, datetime.datetime) else value
+
+
+def _json_page(page_function, key):
+    '''
+    Respond with one page of records as JSON.  The response's 'next' token can be passed
+    back as the 'cursor' parameter to get the next page.
+    '''
+    per_page = request.args.get('per_page', DEFAULT_PAGE_SIZE, type=int)
+    try:
+        rows, next_cursor = page_function(key, request.args.get('cursor'), per_page)
+    except InvalidCursor:
+        abort(400)
+    return jsonify(
+        results=[
+            {field: _json_value(value) for field, value in row._asdict().items()}
+            for row in rows],
+        next=next_cursor,
+    )
+
+
+@app.route('/api/posts')
+def api_posts():
+    return _json_page(post_page, request.args.get('package', DEFAULT_PACKAGE))
+
+
+@app.route('/api/search')
+def api_search():
+    ''' Search the titles and bodies of posts for the words in the 'q' parameter, best matches first. '''
+    return _json_page(search_posts, request.args.get('q', ''))
+
+
+@app.route('/api/issues')
+def api_issues():
+    return _json_page(issue_page, request.args.get('package', DEFAULT_PACKAGE))
+
+
+@app.route('/api/issues/<int:issue_id>/comments')
+def api_issue_comments(issue_id):
+    return _json_page(issue_comment_page, issue_id)
+
+
+@app.route('/api/health')
+def api_health():
+    '''
+    Compare the health of several packages, given as a comma-separated 'packages' parameter.
+    The response has one line of JSON for each package, which is sent as soon as its
+    summaries are ready, so packages may not be listed in the order they were requested.
+    '''
+    packages = [
+        package.strip() for package in request.args.get('packages', DEFAULT_PACKAGE).split(',')
+        if package.strip()]
+    if not packages or len(packages) > MAX_COMPARED_PACKAGES:
+        abort(400)
+
+    def generate():
+        for package, summaries in compare_packages(packages):
+            yield json.dumps({'package': package, 'sources': summaries}, default=_json_value) + '\n'
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+def _date_arg(name):
+    ''' Read a date parameter, formatted as YYYY-MM-DD. '''
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        abort(400)
+
+
+@app.route('/api/questions/<int:question_id>/growth')
+def api_question_growth(question_id):
+    ''' How much a question's views, score, and answers grew between 'start' and 'end'. '''
+    return jsonify(question_id=question_id, growth=question_growth(
+        question_id, _date_arg('start'), _date_arg('end')))
+
+
+@app.route('/api/tags/<tag_name>/growth')
+def api_tag_growth(tag_name):
+    ''' How much the views, score, and answers of a tag's questions grew between 'start' and 'end'. '''
+    tag = find_tag(tag_name)
+    if tag is None:
+        abort(404)
+    return jsonify(tag=tag.tag_name, growth=tag_growth(tag.id, _date_arg('start'), _date_arg('end')))
+
+
+@app.route('/api/canonical-questions')
+def api_canonical_questions():
+    ''' The questions that a package's questions are most often marked as duplicates of. '''
+    tag = find_tag(request.args.get('package', DEFAULT_PACKAGE))
+    if tag is None:
+        abort(404)
+    try:
+        graph = load_graph()
+    except OSError:
+        # The graph hasn't been built yet.
+        abort(503)
+    return jsonify(results=[
+        {'question_id': question_id, 'questions': count}
+        for question_id, count in graph.canonical_questions(tag.id)])
+
+
+@app.route('/api/alternatives')
+def api_alternatives():
+    ''' The Slant topics that suggest a package, with the top-ranked alternatives in each. '''
+    package = request.args.get('package', DEFAULT_PACKAGE)
+    return jsonify(package=package, topics=package_alternatives(package))
+
+
+@app.route('/metrics')
+def metrics():
+    '''
+    Query metrics for this worker process, in the Prometheus text format.  They're only
+    served to local scrapers that connect directly, not to requests proxied by nginx.
+    '''
+    if request.remote_addr not in ('127.0.0.1', '::1') or 'X-Forwarded-For' in request.headers:
+        abort(404)
+    return Response(instrumentation.render_metrics(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == "__main__":
     app.run()
@@ -0,0 +1,281 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import argparse
+import datetime
+import os.path
+import re
+import uuid
+from collections import OrderedDict
+from multiprocessing import Pool
+from xml.etree import ElementTree
+
+from peewee import fn, IntegerField, DateTimeField, BooleanField, UUIDField
+from models import init_database, db_proxy, BatchInserter, \
+    Post, PostHistory, PostLink, Vote, Comment, Badge, User, Tag
+
+
+logger = logging.getLogger('data')
+
+DEFAULT_BATCH_SIZE = 10000
+LOG_INTERVAL = 100000
+
+# Each file in the Stack Exchange data dump, and the model that its rows are saved as.
+# Tables are listed in the order they'll be imported when they aren't imported in parallel.
+DUMP_FILES = OrderedDict([
+    ('Tags', Tag),
+    ('Users', User),
+    ('Badges', Badge),
+    ('Posts', Post),
+    ('PostLinks', PostLink),
+    ('PostHistory', PostHistory),
+    ('Comments', Comment),
+    ('Votes', Vote),
+])
+
+# Attribute names in the dump that don't convert directly to the name of a model field
+ATTRIBUTE_FIELD_NAMES = {
+    'Class': 'class_',
+}
+
+DATE_FORMATS = ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S']
+
+
+def _field_name(attribute):
+    ''' Convert a dump attribute name (e.g., "PostTypeId") to a field name (e.g., "post_type_id"). '''
+    if attribute in ATTRIBUTE_FIELD_NAMES:
+        return ATTRIBUTE_FIELD_NAMES[attribute]
+    return re.sub(r'(?<=[a-z0-9])(?=[A-Z])', '_', attribute).lower()
+
+
+def _parse_date(value):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    raise ValueError("Unrecognized date: %s" % value)
+
+
+def _converter(field):
+    ''' Get a function that converts the text of a dump attribute into a value for a field. '''
+    if isinstance(field, IntegerField):
+        return int
+    if isinstance(field, DateTimeField):
+        return _parse_date
+    if isinstance(field, BooleanField):
+        return lambda value: value == 'True'
+    if isinstance(field, UUIDField):
+        return uuid.UUID
+    return lambda value: value
+
+
+class RowConverter(object):
+    '''
+    Converts the attributes of rows in a dump file into rows for a model.
+    Attributes that don't correspond to a field of the model are dropped.
+    The mapping from each attribute to a field is only looked up once.
+    '''
+    def __init__(self, ModelType):
+        self.ModelType = ModelType
+        self.attributes = {}
+
+    def _lookup(self, attribute):
+        field = self.ModelType._meta.fields.get(_field_name(attribute))
+        if field is None:
+            logger.debug("Ignoring attribute %s of %s", attribute, self.ModelType.__name__)
+            self.attributes[attribute] = None
+        else:
+            self.attributes[attribute] = (field.name, _converter(field))
+        return self.attributes[attribute]
+
+    def convert(self, attributes):
+        row = {}
+        for attribute, value in attributes.items():
+            mapping = self.attributes[attribute] if attribute in self.attributes \
+                else self._lookup(attribute)
+            if mapping is not None:
+                field_name, convert = mapping
+                row[field_name] = convert(value)
+        return row
+
+
+def iterate_rows(path):
+    '''
+    Yield the attributes of each row of a dump file.  Elements are removed from the
+    parsed tree as soon as they have been read, so that memory use stays flat no
+    matter how large the file is.
+    '''
+    context = ElementTree.iterparse(path, events=('start', 'end'))
+    _, root = next(context)
+    for event, element in context:
+        if event == 'end' and element.tag == 'row':
+            yield element.attrib
+            root.clear()
+
+
+def shard_ranges(path, shard_count):
+    ''' Split a file into byte ranges of about the same size, one for each shard. '''
+    size = os.path.getsize(path)
+    return [
+        (size * shard // shard_count, size * (shard + 1) // shard_count)
+        for shard in range(shard_count)]
+
+
+def iterate_shard_rows(path, start, end):
+    '''
+    Yield the attributes of the rows of a dump file that start between two byte offsets.
+    This relies on each row being on a line of its own, as it is in the data dump, so
+    that a shard can start reading in the middle of the file.
+    '''
+    with open(path, 'rb') as dump_file:
+        if start > 0:
+            # Skip the rest of the line that the shard starts in, which belongs to the last shard.
+            dump_file.seek(start - 1)
+            dump_file.readline()
+        while dump_file.tell() < end:
+            line = dump_file.readline()
+            if not line:
+                break
+            line = line.strip()
+            if line.startswith(b'<row'):
+                yield ElementTree.fromstring(line).attrib
+
+
+def _shard_name(table, shard):
+    return table if shard is None else '{table}.{index}-of-{count}'.format(
+        table=table, index=shard[0], count=shard[1])
+
+
+def _first_row_id(path, offset):
+    ''' Get the ID of the first row that a shard starting at a byte offset would read, or None. '''
+    for attributes in iterate_shard_rows(path, offset, float('inf')):
+        return int(attributes['Id'])
+    return None
+
+
+def saved_row_id(ModelType, first_id=None, end_id=None):
+    '''
+    Get the ID of the last row in a range of IDs (from `first_id` up to, but not
+    including, `end_id`) that is saved in a table, or None if none are saved.
+    '''
+    query = ModelType.select(fn.Max(ModelType.id))
+    if first_id is not None:
+        query = query.where(ModelType.id >= first_id)
+    if end_id is not None:
+        query = query.where(ModelType.id < end_id)
+    return query.scalar()
+
+
+def _resume_point(ModelType, path, shard):
+    '''
+    Find the last row of a file (or of a shard of it) that has already been saved.
+    Rows are in order of their IDs in the dump, so a shard's rows are those with IDs
+    from its first row's ID up to the first row of the next shard.
+    '''
+    if shard is None:
+        return saved_row_id(ModelType)
+    ranges = shard_ranges(path, shard[1])
+    first_id = _first_row_id(path, ranges[shard[0]][0])
+    if first_id is None:
+        return None
+    end_id = _first_row_id(path, ranges[shard[0]][1]) if shard[0] + 1 < shard[1] else None
+    return saved_row_id(ModelType, first_id, end_id)
+
+
+def import_table(table, dump_dir, batch_size=DEFAULT_BATCH_SIZE, resume=False, shard=None):
+    '''
+    Import one file of the data dump into its table.
+    Rows are saved in order of their IDs, as they appear in the dump.  If `resume` is
+    set, rows up to and including the last one that the table already has are skipped,
+    so that an import that was interrupted can continue where it stopped.  The resume
+    point is read from the table, so it always agrees with the batches that were saved.
+    If `shard` is given as (index, count), only that shard of the file is imported,
+    so that several processes can import parts of one large file at once.
+    Returns the number of rows that were saved.
+    '''
+    ModelType = DUMP_FILES[table]
+    path = os.path.join(dump_dir, table + '.xml')
+    converter = RowConverter(ModelType)
+    inserter = BatchInserter(ModelType, batch_size, fill_missing_fields=True)
+    name = _shard_name(table, shard)
+    if shard is None:
+        rows = iterate_rows(path)
+    else:
+        rows = iterate_shard_rows(path, *shard_ranges(path, shard[1])[shard[0]])
+
+    last_id = _resume_point(ModelType, path, shard) if resume else None
+    if last_id is not None:
+        logger.info("Resuming import of %s after row %d", name, last_id)
+
+    row_count = 0
+    for attributes in rows:
+        if last_id is not None and int(attributes['Id']) <= last_id:
+            continue
+
+        inserter.insert(converter.convert(attributes))
+        row_count += 1
+        if row_count % LOG_INTERVAL == 0:
+            logger.info("Imported %d rows of %s", row_count, name)
+    inserter.flush()
+
+    logger.info("Finished importing %d rows of %s", row_count, name)
+    return row_count
+
+
+def _import_table_in_process(arguments):
+    ''' Import a table from a worker process, which needs its own database connection. '''
+    table, dump_dir, db_type, db_config, batch_size, resume = arguments
+    init_database(db_type, db_config)
+    return table, import_table(table, dump_dir, batch_size, resume)
+
+
+def import_dump(dump_dir, tables=None, db_type='sqlite', db_config=None,
+                batch_size=DEFAULT_BATCH_SIZE, resume=False, processes=1):
+    '''
+    Import the data dump in a directory.  If `processes` is more than 1, tables
+    are imported in parallel, each by its own process.  This is meant for Postgres;
+    Sqlite only allows one writer at a time.
+    Returns a dictionary from each table name to the number of rows imported.
+    '''
+    tables = tables or list(DUMP_FILES.keys())
+    init_database(db_type, db_config)
+    db_proxy.create_tables([DUMP_FILES[table] for table in tables], safe=True)
+
+    if processes > 1:
+        pool = Pool(processes)
+        try:
+            results = pool.map(_import_table_in_process, [
+                (table, dump_dir, db_type, db_config, batch_size, resume)
+                for table in tables])
+        finally:
+            pool.close()
+            pool.join()
+        return dict(results)
+
+    return {
+        table: import_table(table, dump_dir, batch_size, resume)
+        for table in tables
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Import the Stack Exchange data dump")
+    parser.add_argument('dump_dir', help="Directory containing the dump's XML files")
+    parser.add_argument('--tables', nargs='+', choices=list(DUMP_FILES.keys()),
+                        help="Tables to import (default: all)")
+    parser.add_argument('--db', default='sqlite', choices=['sqlite', 'postgres'])
+    parser.add_argument('--db-config', help="Postgres credentials file")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue an interrupted import after the last rows that were saved")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="Number of tables to import in parallel")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+    import_dump(
+        args.dump_dir, args.tables, args.db, args.db_config,
+        args.batch_size, args.resume, args.processes)
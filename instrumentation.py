@@ -0,0 +1,256 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Metrics for the queries the app runs, and a log of slow queries.
+
+Once `install` is called, every statement run through the database behind `db_proxy`,
+or through one of its read replicas, is timed.  Statements are grouped by their
+normalized SQL, with literal values replaced by '?', so that the same query with
+different values is counted once.
+The statements run while handling each request are counted too, which shows pages
+that run a query for each item in a list.  BatchInserter's flushes are timed as well.
+
+Statements slower than a threshold are logged, optionally with their query plans.
+Metrics are kept by each process, and are formatted for Prometheus by `render_metrics`.
+'''
+
+from __future__ import unicode_literals
+import logging
+import re
+import threading
+import time
+from collections import defaultdict
+
+import models
+from models import db_proxy, using_postgres
+
+
+logger = logging.getLogger('data')
+
+DEFAULT_SLOW_QUERY_MS = 500
+# Statements beyond this many distinct ones are counted together, to bound memory use.
+MAX_STATEMENTS = 500
+OTHER_STATEMENTS = '<other>'
+
+STRING_LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'")
+NUMBER_PATTERN = re.compile(r'\b\d+(?:\.\d+)?\b')
+PLACEHOLDER_PATTERN = re.compile(r'%s|\?')
+PLACEHOLDER_LIST_PATTERN = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+def normalize_sql(sql):
+    '''
+    Replace the values in a SQL statement with '?', and lists of values (e.g., for 'IN')
+    with '(...)', so that statements that only differ in their values are the same.
+    '''
+    sql = STRING_LITERAL_PATTERN.sub('?', sql)
+    sql = NUMBER_PATTERN.sub('?', sql)
+    sql = PLACEHOLDER_PATTERN.sub('?', sql)
+    sql = PLACEHOLDER_LIST_PATTERN.sub('(...)', sql)
+    return WHITESPACE_PATTERN.sub(' ', sql).strip()
+
+
+class StatementStats(object):
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+
+class QueryMetrics(object):
+    ''' Counters for the statements, requests, and batch inserts of this process. '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.statements = defaultdict(StatementStats)
+        # For each endpoint: the number of requests, statements, and the most statements in one request
+        self.requests = defaultdict(lambda: [0, 0, 0])
+        self.request_seconds = defaultdict(float)
+        # For each model: the number of flushes, rows, and seconds spent saving them
+        self.flushes = defaultdict(lambda: [0, 0, 0.0])
+        self.slow_queries = 0
+
+    def record_statement(self, sql, seconds, slow):
+        statement = normalize_sql(sql)
+        with self._lock:
+            if statement not in self.statements and len(self.statements) >= MAX_STATEMENTS:
+                statement = OTHER_STATEMENTS
+            self.statements[statement].add(seconds)
+            if slow:
+                self.slow_queries += 1
+
+    def record_request(self, endpoint, statement_count, seconds):
+        with self._lock:
+            counts = self.requests[endpoint]
+            counts[0] += 1
+            counts[1] += statement_count
+            counts[2] = max(counts[2], statement_count)
+            self.request_seconds[endpoint] += seconds
+
+    def record_flush(self, ModelType, row_count, seconds):
+        logger.debug("Saved %d rows of %s in %.3f s (%.0f rows per second)",
+                     row_count, ModelType.__name__, seconds, row_count / max(seconds, 1e-9))
+        with self._lock:
+            counts = self.flushes[ModelType.__name__]
+            counts[0] += 1
+            counts[1] += row_count
+            counts[2] += seconds
+
+    def reset(self):
+        with self._lock:
+            self.statements.clear()
+            self.requests.clear()
+            self.request_seconds.clear()
+            self.flushes.clear()
+            self.slow_queries = 0
+
+
+metrics = QueryMetrics()
+_settings = {
+    'slow_query_seconds': DEFAULT_SLOW_QUERY_MS / 1000.0,
+    'explain_slow_queries': False,
+}
+# The statement count and time of the request being handled by each thread
+_local = threading.local()
+
+
+def _explain(database, sql, params):
+    '''
+    Get the query plan for a statement from the database that ran it (the primary or a
+    replica).  Only SELECT statements are explained.
+    '''
+    if not sql.lstrip().upper().startswith('SELECT'):
+        return None
+    prefix = 'EXPLAIN ' if using_postgres() else 'EXPLAIN QUERY PLAN '
+    _local.explaining = True
+    try:
+        cursor = database.execute_sql(prefix + sql, params)
+        return '\n'.join(str(row[-1]) for row in cursor.fetchall())
+    except Exception:
+        logger.debug("Could not explain slow query", exc_info=True)
+        return None
+    finally:
+        _local.explaining = False
+
+
+def _record(database, sql, params, seconds):
+    if getattr(_local, 'explaining', False):
+        return
+    slow = seconds >= _settings['slow_query_seconds']
+    metrics.record_statement(sql, seconds, slow)
+    if getattr(_local, 'statement_count', None) is not None:
+        _local.statement_count += 1
+
+    if slow:
+        plan = _explain(database, sql, params) if _settings['explain_slow_queries'] else None
+        logger.warning("Slow query (%.0f ms): %s %r%s", seconds * 1000, sql, params,
+                       '\n' + plan if plan else '')
+
+
+def instrument_database(database):
+    ''' Time every statement run by a database. '''
+    if getattr(database.execute_sql, 'instrumented', False):
+        return
+    execute_sql = database.execute_sql
+
+    def timed_execute_sql(sql, params=None, require_commit=True):
+        start = time.time()
+        try:
+            return execute_sql(sql, params, require_commit)
+        finally:
+            _record(database, sql, params, time.time() - start)
+
+    timed_execute_sql.instrumented = True
+    database.execute_sql = timed_execute_sql
+
+
+def install(slow_query_ms=DEFAULT_SLOW_QUERY_MS, explain_slow_queries=False):
+    '''
+    Start collecting metrics for the database behind `db_proxy` and its read replicas,
+    and for any databases they're replaced with later.  Statements that take at least
+    `slow_query_ms` are logged, with their query plans if `explain_slow_queries` is set.
+    '''
+    _settings['slow_query_seconds'] = slow_query_ms / 1000.0
+    _settings['explain_slow_queries'] = explain_slow_queries
+    if db_proxy.obj is not None:
+        instrument_database(db_proxy.obj)
+    if instrument_database not in db_proxy._callbacks:
+        db_proxy.attach_callback(instrument_database)
+    # Pages read from replicas, so their statements have to be timed too.
+    for database in models.replica_databases():
+        instrument_database(database)
+    if instrument_database not in models.replica_listeners:
+        models.replica_listeners.append(instrument_database)
+    if metrics.record_flush not in models.flush_listeners:
+        models.flush_listeners.append(metrics.record_flush)
+
+
+def start_request():
+    ''' Start counting the statements run for a request by the current thread. '''
+    _local.statement_count = 0
+    _local.request_start = time.time()
+
+
+def finish_request(endpoint):
+    ''' Record the statements run for the current thread's request. '''
+    statement_count = getattr(_local, 'statement_count', None)
+    if statement_count is None:
+        return
+    metrics.record_request(endpoint or 'unknown', statement_count, time.time() - _local.request_start)
+    _local.statement_count = None
+
+
+def _label(value):
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+
+def render_metrics():
+    ''' Format this process's metrics in the Prometheus text format. '''
+    lines = []
+
+    def metric(name, metric_type, help_text, samples):
+        lines.append('# HELP {name} {help}'.format(name=name, help=help_text))
+        lines.append('# TYPE {name} {type}'.format(name=name, type=metric_type))
+        for labels, value in samples:
+            label_text = ','.join('{key}={value}'.format(key=key, value=_label(label))
+                                  for key, label in labels)
+            lines.append('{name}{labels} {value}'.format(
+                name=name, labels='{' + label_text + '}' if label_text else '',
+                value=repr(float(value))))
+
+    with metrics._lock:
+        statements = sorted(metrics.statements.items())
+        requests = sorted(metrics.requests.items())
+        request_seconds = dict(metrics.request_seconds)
+        flushes = sorted(metrics.flushes.items())
+        slow_queries = metrics.slow_queries
+
+    metric('db_statements_total', 'counter', "Statements run, by normalized SQL",
+           [((('statement', sql),), stats.count) for sql, stats in statements])
+    metric('db_statement_seconds_total', 'counter', "Time spent running statements",
+           [((('statement', sql),), stats.seconds) for sql, stats in statements])
+    metric('db_statement_seconds_max', 'gauge', "Longest time a statement took",
+           [((('statement', sql),), stats.max_seconds) for sql, stats in statements])
+    metric('db_slow_statements_total', 'counter', "Statements slower than the slow query threshold",
+           [((), slow_queries)])
+    metric('http_requests_total', 'counter', "Requests handled, by endpoint",
+           [((('endpoint', endpoint),), counts[0]) for endpoint, counts in requests])
+    metric('http_request_seconds_total', 'counter', "Time spent handling requests",
+           [((('endpoint', endpoint),), request_seconds[endpoint]) for endpoint, _ in requests])
+    metric('http_request_statements_total', 'counter', "Statements run while handling requests",
+           [((('endpoint', endpoint),), counts[1]) for endpoint, counts in requests])
+    metric('http_request_statements_max', 'gauge', "Most statements run while handling one request",
+           [((('endpoint', endpoint),), counts[2]) for endpoint, counts in requests])
+    metric('batch_inserter_flushes_total', 'counter', "Batches saved by BatchInserter",
+           [((('model', model),), counts[0]) for model, counts in flushes])
+    metric('batch_inserter_rows_total', 'counter', "Rows saved by BatchInserter",
+           [((('model', model),), counts[1]) for model, counts in flushes])
+    metric('batch_inserter_seconds_total', 'counter', "Time spent saving batches",
+           [((('model', model),), counts[2]) for model, counts in flushes])
+    return '\n'.join(lines) + '\n'
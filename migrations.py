@@ -0,0 +1,336 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Versioned migrations that add the indexes queries need to the database, and that
+bring the tables of existing databases up to date with the models.
+
+`create_tables` creates tables for new databases, but it skips tables that already
+exist, and it doesn't create the indexes that the Stack Overflow tables need for
+joins.  Those indexes are added here instead, so that they can be built after the
+data dump is loaded, rather than slowing down every insert during the load.
+On Postgres, indexes are built concurrently, so that the tables can still be
+written to while the indexes are built.
+
+Run this after loading data:
+
+    python migrations.py --db postgres --db-config postgres-credentials.json
+    python migrations.py --db postgres --db-config postgres-credentials.json --check
+'''
+
+from __future__ import unicode_literals
+import logging
+import argparse
+import datetime
+import sys
+from collections import namedtuple
+from contextlib import contextmanager
+
+from peewee import fn
+from playhouse import migrate as schema
+from models import init_database, db_proxy, using_postgres, SchemaMigration, \
+    Post, PostTag, PostHistory, PostLink, Vote, Comment, Issue, IssueComment, IssueEvent, \
+    ContentBlob, WebPageContent, GitHubSyncState, QuestionSnapshot, QuestionSnapshotDelta, \
+    SlantTopicRanking, PackageAlternatives, PackageHealthCheckpoint
+from partitions import is_partitioned
+
+
+logger = logging.getLogger('data')
+
+# An index over some columns of a model's table.  If `where` is given, the index is
+# partial: it only includes the rows that match the condition.
+Index = namedtuple('Index', ['name', 'model', 'columns', 'where', 'unique'])
+Index.__new__.__defaults__ = (False,)
+# Changes to tables, which are applied before a migration's indexes are built.
+# Each change is skipped if the database already has it (e.g., if the table was
+# created after the model was changed).
+AddTable = namedtuple('AddTable', ['model'])
+# Only nullable fields can be added as columns.  Their indexes are added as Indexes.
+AddColumn = namedtuple('AddColumn', ['model', 'field_name'])
+DropNotNull = namedtuple('DropNotNull', ['model', 'field_name'])
+# Existing values are cast to the field's column type, so they have to be valid for it.
+ChangeColumnType = namedtuple('ChangeColumnType', ['model', 'field_name'])
+Migration = namedtuple('Migration', ['version', 'name', 'indexes', 'changes'])
+Migration.__new__.__defaults__ = ((),)
+
+QUESTION_POST_TYPE = 1
+
+MIGRATIONS = [
+    # Tables created before PostTag declared this index don't have it.
+    Migration(1, 'post-tag-covering-index', [
+        Index('posttag_tag_id_post_id', PostTag, ['tag_id', 'post_id'], None),
+    ]),
+    Migration(2, 'stack-overflow-join-indexes', [
+        Index('post_parent_id', Post, ['parent_id'], 'parent_id IS NOT NULL'),
+        Index('post_accepted_answer_id', Post, ['accepted_answer_id'],
+              'accepted_answer_id IS NOT NULL'),
+        Index('post_owner_user_id', Post, ['owner_user_id'], None),
+        Index('post_question_creation_date', Post, ['creation_date', 'id'],
+              'post_type_id = %d' % QUESTION_POST_TYPE),
+        Index('posthistory_post_id', PostHistory, ['post_id'], None),
+        Index('postlink_post_id', PostLink, ['post_id'], None),
+        Index('postlink_related_post_id', PostLink, ['related_post_id'], None),
+        Index('vote_post_id_creation_date', Vote, ['post_id', 'creation_date'], None),
+        Index('comment_post_id', Comment, ['post_id'], None),
+    ]),
+    Migration(3, 'keyset-pagination-indexes', [
+        Index('issue_created_at_id', Issue, ['created_at', 'id'], None),
+        Index('issuecomment_issue_id_created_at_id', IssueComment,
+              ['issue_id', 'created_at', 'id'], None),
+    ]),
+    Migration(4, 'content-blobs', [
+        Index('webpagecontent_digest', WebPageContent, ['digest'], None),
+    ], changes=[
+        AddTable(ContentBlob),
+        AddColumn(WebPageContent, 'digest'),
+        DropNotNull(WebPageContent, 'content'),
+    ]),
+    # The keys that synced issues, comments, and events are upserted on
+    Migration(5, 'github-sync', [
+        Index('issue_project_id_github_id', Issue, ['project_id', 'github_id'], None, unique=True),
+        Index('issuecomment_issue_id_github_id_created_at', IssueComment,
+              ['issue_id', 'github_id', 'created_at'], None, unique=True),
+        Index('issueevent_issue_id_github_id_created_at', IssueEvent,
+              ['issue_id', 'github_id', 'created_at'], None, unique=True),
+    ], changes=[
+        AddTable(GitHubSyncState),
+    ]),
+    # Series of question snapshots are read by question and date (see `snapshots`).
+    Migration(6, 'question-snapshot-deltas', [
+        Index('questionsnapshot_question_id_date', QuestionSnapshot, ['question_id', 'date'], None),
+        Index('questionsnapshotdelta_question_id_date', QuestionSnapshotDelta,
+              ['question_id', 'date'], None),
+    ], changes=[
+        AddTable(QuestionSnapshotDelta),
+    ]),
+    # Precomputed rankings of Slant viewpoints (see `alternatives`)
+    Migration(7, 'slant-alternatives', [], changes=[
+        AddTable(SlantTopicRanking),
+        AddTable(PackageAlternatives),
+    ]),
+    # The dump's revision GUIDs didn't fit in the 16-character column they had.
+    Migration(8, 'post-history-revision-uuid', [], changes=[
+        ChangeColumnType(PostHistory, 'revision_guid'),
+    ]),
+    # Rankings record how new their data was, so a fetch that grows is ranked again.
+    Migration(9, 'slant-ranking-data-date', [], changes=[
+        AddColumn(SlantTopicRanking, 'data_date'),
+    ]),
+    # Health rollups read accept votes, so that answers accepted later are counted.
+    Migration(10, 'package-health-last-vote-id', [], changes=[
+        AddColumn(PackageHealthCheckpoint, 'last_vote_id'),
+    ]),
+]
+
+
+def _quote(name):
+    return db_proxy.quote_char + name + db_proxy.quote_char
+
+
+def index_sql(index, concurrently=False):
+    sql = 'CREATE {unique}INDEX {concurrently}IF NOT EXISTS {name} ON {table} ({columns})'.format(
+        unique='UNIQUE ' if index.unique else '',
+        concurrently='CONCURRENTLY ' if concurrently else '',
+        name=_quote(index.name),
+        table=_quote(index.model._meta.db_table),
+        columns=', '.join(_quote(column) for column in index.columns))
+    if index.where:
+        sql += ' WHERE ' + index.where
+    return sql
+
+
+@contextmanager
+def _autocommit():
+    '''
+    Run statements outside of a transaction on Postgres.  This is required for
+    building indexes concurrently.
+    '''
+    connection = db_proxy.get_conn()
+    connection.commit()
+    autocommit = connection.autocommit
+    connection.autocommit = True
+    try:
+        yield
+    finally:
+        connection.autocommit = autocommit
+
+
+def _drop_invalid_index(index):
+    '''
+    If building an index concurrently fails, Postgres leaves behind an invalid index.
+    It has to be dropped, or 'IF NOT EXISTS' would skip building it again.
+    '''
+    cursor = db_proxy.execute_sql(
+        "SELECT NOT indisvalid FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+        "WHERE pg_class.relname = %s", (index.name,))
+    row = cursor.fetchone()
+    if row is not None and row[0]:
+        logger.warning("Dropping invalid index %s", index.name)
+        db_proxy.execute_sql('DROP INDEX CONCURRENTLY IF EXISTS ' + _quote(index.name))
+
+
+def create_index(index, concurrently=True):
+    '''
+    Build an index, if it doesn't exist yet.  Concurrent builds are only used on Postgres,
+    and not for partitioned tables, which Postgres can't index concurrently.
+    '''
+    logger.info("Building index %s", index.name)
+    if using_postgres() and concurrently and not is_partitioned(index.model):
+        with _autocommit():
+            _drop_invalid_index(index)
+            db_proxy.execute_sql(index_sql(index, concurrently=True))
+    else:
+        db_proxy.execute_sql(index_sql(index))
+
+
+def _column(model, field_name):
+    ''' Get the metadata of the column for a field, or None if the table doesn't have it. '''
+    column_name = model._meta.fields[field_name].db_column
+    for column in db_proxy.get_columns(model._meta.db_table):
+        if column.name == column_name:
+            return column
+    return None
+
+
+def apply_change(change):
+    ''' Apply a change to a table, unless the table already has it. '''
+    migrator = schema.SchemaMigrator.from_database(db_proxy.obj)
+    if isinstance(change, AddTable):
+        logger.info("Creating table %s", change.model._meta.db_table)
+        change.model.create_table(fail_silently=True)
+        return
+
+    table = change.model._meta.db_table
+    field = change.model._meta.fields[change.field_name]
+    column = _column(change.model, change.field_name)
+    if isinstance(change, AddColumn) and column is None:
+        logger.info("Adding column %s to %s", field.db_column, table)
+        schema.migrate(migrator.alter_add_column(table, field.db_column, field))
+    elif isinstance(change, DropNotNull) and column is not None and not column.null:
+        logger.info("Making column %s of %s nullable", field.db_column, table)
+        schema.migrate(migrator.drop_not_null(table, field.db_column))
+    elif isinstance(change, ChangeColumnType) and column is not None and using_postgres():
+        # Sqlite doesn't enforce column types, so its columns are left as they are.
+        column_type = db_proxy.compiler().get_column_type(field.get_db_field())
+        if column.data_type.lower() != column_type.lower():
+            logger.info("Changing the type of column %s of %s to %s", field.db_column, table, column_type)
+            db_proxy.execute_sql(
+                'ALTER TABLE {table} ALTER COLUMN {column} TYPE {type} USING {column}::{type}'.format(
+                    table=_quote(table), column=_quote(field.db_column), type=column_type))
+
+
+def current_version():
+    ''' Get the version of the newest migration applied to the database (0 if there's none). '''
+    db_proxy.create_tables([SchemaMigration], safe=True)
+    return SchemaMigration.select(fn.Max(SchemaMigration.version)).scalar() or 0
+
+
+def migrate(target_version=None, concurrently=True):
+    '''
+    Apply all migrations newer than the database's version, up to `target_version`
+    (by default, all of them).  Returns the migrations that were applied.
+    '''
+    version = current_version()
+    applied = []
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            continue
+        if target_version is not None and migration.version > target_version:
+            break
+
+        logger.info("Applying migration %d (%s)", migration.version, migration.name)
+        with db_proxy.atomic():
+            for change in migration.changes:
+                apply_change(change)
+        for index in migration.indexes:
+            create_index(index, concurrently)
+        SchemaMigration.create(version=migration.version, name=migration.name)
+        applied.append(migration)
+    return applied
+
+
+# Queries that the app and the health rollups rely on, and the index each of them should use
+KEY_QUERIES = [
+    ("posts with a tag", 'posttag_tag_id_post_id', lambda: (
+        PostTag.select(PostTag.post_id).where(PostTag.tag_id == 1)
+        .order_by(PostTag.post_id.desc()))),
+    ("page of posts with a tag", 'posttag_tag_id_post_id', lambda: (
+        Post.select(PostTag.post_id, Post.title)
+        .join(PostTag, on=(PostTag.post_id == Post.id))
+        .where((PostTag.tag_id == 1) & (PostTag.post_id < 1000))
+        .order_by(PostTag.post_id.desc())
+        .limit(11))),
+    ("answers to a question", 'post_parent_id', lambda: (
+        Post.select(Post.id).where(Post.parent_id == 1))),
+    ("accepted answer of a question", 'post_accepted_answer_id', lambda: (
+        Post.select(Post.id).where(Post.accepted_answer_id == 1))),
+    ("questions asked since a date", 'post_question_creation_date', lambda: (
+        Post.select(Post.id).where(
+            (Post.post_type_id == QUESTION_POST_TYPE) &
+            (Post.creation_date >= datetime.datetime(2017, 1, 1))))),
+    ("votes on a post", 'vote_post_id_creation_date', lambda: (
+        Vote.select(Vote.creation_date).where(Vote.post_id == 1))),
+    ("comments on a post", 'comment_post_id', lambda: (
+        Comment.select(Comment.id).where(Comment.post_id == 1))),
+    ("history of a post", 'posthistory_post_id', lambda: (
+        PostHistory.select(PostHistory.id).where(PostHistory.post_id == 1))),
+    ("posts linked to a post", 'postlink_related_post_id', lambda: (
+        PostLink.select(PostLink.post_id).where(PostLink.related_post_id == 1))),
+    ("comments on an issue", 'issuecomment_issue_id_created_at_id', lambda: (
+        IssueComment.select(IssueComment.id).where(IssueComment.issue == 1)
+        .order_by(IssueComment.created_at, IssueComment.id))),
+]
+
+
+def explain(query):
+    ''' Get the database's query plan for a query, as text. '''
+    sql, params = query.sql()
+    if using_postgres():
+        cursor = db_proxy.execute_sql('EXPLAIN ' + sql, params)
+        return '\n'.join(row[0] for row in cursor.fetchall())
+    cursor = db_proxy.execute_sql('EXPLAIN QUERY PLAN ' + sql, params)
+    return '\n'.join(row[-1] for row in cursor.fetchall())
+
+
+def check_query_plans():
+    '''
+    Check that each of the key queries uses the index it needs, based on the database's
+    query plans.  On Postgres, sequential scans are disabled while checking, so that the
+    check shows whether the index can be used, even if a table is too small for it to
+    be worth using.  Returns a list of (description, index name, whether it's used, plan).
+    '''
+    results = []
+    with db_proxy.atomic():
+        if using_postgres():
+            db_proxy.execute_sql('SET LOCAL enable_seqscan = off')
+        for description, index_name, make_query in KEY_QUERIES:
+            plan = explain(make_query())
+            results.append((description, index_name, index_name in plan, plan))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Add indexes to the database")
+    parser.add_argument('--db', default='sqlite', choices=['sqlite', 'postgres'])
+    parser.add_argument('--db-config', help="Postgres credentials file")
+    parser.add_argument('--to-version', type=int, help="Stop after applying this migration")
+    parser.add_argument('--no-concurrently', action='store_true',
+                        help="Lock tables while building indexes on Postgres, which is faster")
+    parser.add_argument('--check', action='store_true',
+                        help="Instead of migrating, check that key queries use their indexes")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+    init_database(args.db, args.db_config)
+
+    if args.check:
+        failures = 0
+        for description, index_name, used, plan in check_query_plans():
+            print("{status:4} {description} ({index})".format(
+                status='ok' if used else 'FAIL', description=description, index=index_name))
+            if not used:
+                failures += 1
+                print('    ' + plan.replace('\n', '\n    '))
+        sys.exit(1 if failures else 0)
+
+    migrate(args.to_version, concurrently=not args.no_concurrently)
@@ -5,16 +5,35 @@ from __future__ import unicode_literals
 import logging
 import datetime
 import json
-import copy
-from peewee import Model, SqliteDatabase, Proxy, PostgresqlDatabase, \
-    CharField, IntegerField, ForeignKeyField, DateTimeField, TextField, BooleanField
+import io
+import random
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from peewee import Model, SqliteDatabase, Proxy, PostgresqlDatabase, FieldDescriptor, \
+    DatabaseError, CharField, IntegerField, ForeignKeyField, DateTimeField, TextField, BooleanField, \
+    FloatField, BlobField, UUIDField, SQL, Clause, EnclosedClause
+from playhouse.pool import PooledDatabase, PooledPostgresqlDatabase
 
 
 logger = logging.getLogger('data')
 
 POSTGRES_CONFIG_NAME = 'postgres-credentials.json'
 DATABASE_NAME = 'fetcher'
+# Defaults for pooled Postgres connections, which can be overridden in the config file
+DEFAULT_MAX_CONNECTIONS = 20
+DEFAULT_STALE_TIMEOUT = 300  # seconds
+# How often to check whether read replicas have caught up with the primary, in seconds
+DEFAULT_REPLICA_CHECK_INTERVAL = 30
 db_proxy = Proxy()
+# Functions that are called after BatchInserter saves a batch, with the model,
+# the number of rows saved, and the time it took in seconds (e.g., to record metrics).
+flush_listeners = []
+# Functions that are called with each read replica's database when the replicas are
+# configured (e.g., to record metrics for the replicas' queries too).
+replica_listeners = []
 
 
 class BatchInserter(object):
@@ -27,17 +46,30 @@ class BatchInserter(object):
 
     Assumes all models have been initialized to connect to db_proxy.
     '''
-    def __init__(self, ModelType, batch_size, fill_missing_fields=False):
+    def __init__(self, ModelType, batch_size, fill_missing_fields=False,
+                 conflict_fields=None, update_on_conflict=True, newer_field=None):
         '''
         ModelType is the Peewee model to which you want to save the data.
-        If the rows you save will have fields missing for some of the records,
-        set `fill_missing_fields` to true so that all rows will be augmented
-        with all fields to prevent Peewee from crashing.
+        Rows don't all need to have the same fields.  Every row is saved with all of
+        the model's fields, and fields that are missing from a row are set to their
+        default value, or NULL if they have no default.  `fill_missing_fields` is
+        accepted for compatibility, as missing fields are now always filled.
+
+        If `conflict_fields` is given, rows are upserted: a row with the same values
+        for those fields as a saved row (which a unique index has to enforce) replaces
+        the saved row, or is skipped if `update_on_conflict` is False.  If `newer_field`
+        is also given, a saved row is only replaced by a row with a greater value for
+        that field (e.g., 'updated_at'), so rows that haven't changed aren't rewritten.
         '''
         self.rows = []
         self.ModelType = ModelType
         self.batch_size = batch_size
         self.pad_data = fill_missing_fields
+        self.conflict_fields = conflict_fields
+        self.update_on_conflict = update_on_conflict
+        self.newer_field = newer_field
+        # The fields saved for each row of the last batch.  These are decided for each batch.
+        self.fields = None
 
     def insert(self, row):
         '''
@@ -50,40 +82,253 @@ class BatchInserter(object):
             self.flush()
 
     def flush(self):
-        if self.pad_data:
-            self._pad_data(self.rows)
+        '''
+        Save all rows that haven't been saved yet.
+        On Postgres, rows are streamed to the database with COPY, which is much faster
+        than INSERT for large loads.  Otherwise, they're saved with one prepared INSERT
+        statement that's executed for each row.  Upserts can't use COPY, so on Postgres
+        they're sent as multi-row INSERT ... ON CONFLICT statements instead.
+        '''
+        if not self.rows:
+            return
+        self.fields = self._choose_fields(self.rows)
+
+        start = time.time()
+        values = self._row_values(self.rows)
         with db_proxy.atomic():
-            self.ModelType.insert_many(self.rows).execute()
+            with db_proxy.exception_wrapper:
+                if self.conflict_fields:
+                    self._upsert_rows(self.fields, values)
+                elif using_postgres():
+                    self._copy_rows(self.fields, values)
+                else:
+                    self._execute_many(self.fields, values)
+
+        seconds = time.time() - start
+        for listener in flush_listeners:
+            listener(self.ModelType, len(values), seconds)
         self.rows = []
 
-    def _pad_data(self, rows):
+    def _choose_fields(self, rows):
+        '''
+        Decide which fields will be saved for each row of a batch, in order.  This includes
+        all of the model's fields.  The only exception is an auto-incrementing primary key:
+        it is only saved if the rows set it (e.g., the IDs of posts in the Stack Overflow
+        data dump).  Either all of the rows in a batch set it, or none of them.
+        '''
+        meta = self.ModelType._meta
+        primary_key = meta.primary_key
+        if meta.auto_increment:
+            key_count = sum(1 for row in rows if primary_key.name in row)
+            if 0 < key_count < len(rows):
+                raise ValueError("Only some of the rows of %s set %s" % (
+                    self.ModelType.__name__, primary_key.name))
+            if key_count == 0:
+                return [field for field in meta.sorted_fields if field is not primary_key]
+        return list(meta.sorted_fields)
+
+    def _row_values(self, rows):
         '''
-        Before we can bulk insert rows using Peewee, they all need to have the same
-        fields.  This method adds the missing fields to all rows to make
-        sure they all describe the same fields.  It does this destructively
-        to the rows provided as input.
+        Convert rows into tuples of database values for the inserter's fields.
+        Defaults are computed once per batch (e.g., all rows in a batch share a 'date').
+        Raises ValueError if a row has a key that isn't a field of the model.
         '''
-        # Collect the union of all field names
-        field_names = set()
+        field_names = self.ModelType._meta.fields.keys()
         for row in rows:
-            field_names = field_names.union(row.keys())
+            if not row.keys() <= field_names:
+                raise ValueError("%s has no fields named %s" % (
+                    self.ModelType.__name__, ', '.join(sorted(row.keys() - field_names))))
+
+        columns = []
+        for field in self.fields:
+            default = field.default() if callable(field.default) else field.default
+            columns.append((field.name, field.db_value, default))
+
+        return [
+            tuple([db_value(row.get(name, default)) for name, db_value, default in columns])
+            for row in rows
+        ]
+
+    def _columns_sql(self, fields):
+        quote = db_proxy.quote_char
+        table = quote + self.ModelType._meta.db_table + quote
+        columns = ', '.join(quote + field.db_column + quote for field in fields)
+        return table, columns
+
+    def _copy_rows(self, fields, values):
+        ''' Stream rows into a Postgres table through COPY, using psycopg2's `copy_expert`. '''
+        buffer = io.StringIO()
+        for row_values in values:
+            buffer.write('\t'.join(_copy_text(value) for value in row_values))
+            buffer.write('\n')
+        buffer.seek(0)
+
+        table, columns = self._columns_sql(fields)
+        cursor = db_proxy.get_cursor()
+        cursor.copy_expert('COPY {table} ({columns}) FROM STDIN'.format(
+            table=table, columns=columns), buffer)
+
+    def _execute_many(self, fields, values):
+        ''' Insert rows by executing one prepared INSERT statement for all of them. '''
+        table, columns = self._columns_sql(fields)
+        params = ', '.join([db_proxy.interpolation] * len(fields))
+        cursor = db_proxy.get_cursor()
+        cursor.executemany('INSERT INTO {table} ({columns}) VALUES ({params})'.format(
+            table=table, columns=columns, params=params), values)
+
+    def _upsert_rows(self, fields, values):
+        '''
+        Insert rows, resolving conflicts on the conflict fields with ON CONFLICT.
+        Postgres 9.5 and Sqlite 3.24 support the same syntax.  Older versions of Sqlite
+        update the rows that exist, and then insert the rest, skipping conflicts.
+        '''
+        quote = db_proxy.quote_char
+        meta = self.ModelType._meta
+        table, columns = self._columns_sql(fields)
+        conflict_columns = [meta.fields[name].db_column for name in self.conflict_fields]
+        updated_columns = [
+            field.db_column for field in fields
+            if field.db_column not in conflict_columns and field is not meta.primary_key]
+        newer_column = meta.fields[self.newer_field].db_column if self.newer_field else None
+
+        if not using_postgres() and sqlite3.sqlite_version_info < (3, 24, 0):
+            self._update_then_insert(fields, values, conflict_columns, updated_columns, newer_column)
+            return
+
+        if self.update_on_conflict:
+            action = 'DO UPDATE SET ' + ', '.join(
+                '{column} = EXCLUDED.{column}'.format(column=quote + column + quote)
+                for column in updated_columns)
+            if newer_column:
+                action += ' WHERE {table}.{column} < EXCLUDED.{column}'.format(
+                    table=table, column=quote + newer_column + quote)
+        else:
+            action = 'DO NOTHING'
+        sql = 'INSERT INTO {table} ({columns}) VALUES {values} ON CONFLICT ({conflict}) {action}'.format(
+            table=table, columns=columns,
+            values='%s' if using_postgres() else '(' + ', '.join(['?'] * len(fields)) + ')',
+            conflict=', '.join(quote + column + quote for column in conflict_columns),
+            action=action)
+
+        cursor = db_proxy.get_cursor()
+        if using_postgres():
+            from psycopg2.extras import execute_values
+            execute_values(cursor, sql, values, page_size=len(values))
+        else:
+            cursor.executemany(sql, values)
+
+    def _update_then_insert(self, fields, values, conflict_columns, updated_columns, newer_column):
+        quote = db_proxy.quote_char
+        table, columns = self._columns_sql(fields)
+        column_names = [field.db_column for field in fields]
+        cursor = db_proxy.get_cursor()
+
+        if self.update_on_conflict:
+            condition = ' AND '.join(quote + column + quote + ' = ?' for column in conflict_columns)
+            if newer_column:
+                condition += ' AND {column} < ?'.format(column=quote + newer_column + quote)
+            sql = 'UPDATE {table} SET {updates} WHERE {condition}'.format(
+                table=table, condition=condition,
+                updates=', '.join(quote + column + quote + ' = ?' for column in updated_columns))
+            value_columns = updated_columns + conflict_columns + ([newer_column] if newer_column else [])
+            positions = [column_names.index(column) for column in value_columns]
+            cursor.executemany(sql, [
+                tuple(row_values[position] for position in positions) for row_values in values])
+
+        cursor.executemany('INSERT OR IGNORE INTO {table} ({columns}) VALUES ({params})'.format(
+            table=table, columns=columns, params=', '.join(['?'] * len(fields))), values)
+
+
+def _copy_text(value):
+    '''
+    Format a value for Postgres's COPY text format.  NULL is written as '\\N', and
+    backslashes and the characters that separate columns and rows are escaped.
+    Binary data (which BlobField wraps with psycopg2's `Binary`) is written in hex.
+    '''
+    if value is None:
+        return '\\N'
+    binary = getattr(value, 'adapted', value)
+    if isinstance(binary, (bytes, bytearray, memoryview)):
+        return '\\\\x' + bytes(binary).hex()
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return ('%s' % value).replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
+class DeferredFieldDescriptor(FieldDescriptor):
+    '''
+    Gives access to a deferred field.  If the field was left out of the query that
+    loaded a record, its value is fetched from the database the first time it's read.
+    '''
+    def __get__(self, instance, instance_type=None):
+        if instance is None:
+            return self.field
+        if self.att_name not in instance._data:
+            primary_key = instance._get_pk_value()
+            if primary_key is not None:
+                ModelType = self.field.model_class
+                instance._data[self.att_name] = (
+                    ModelType.select(self.field)
+                    .where(ModelType._meta.primary_key == primary_key)
+                    .scalar())
+        return instance._data.get(self.att_name)
+
+
+class DeferredTextField(TextField):
+    '''
+    A text field for large values that list views don't need (e.g., the body of a post).
+    `light_select` leaves these fields out of queries.  The column is the same as that
+    of a TextField, so declaring a field as deferred doesn't change the schema.
+    '''
+    def add_to_class(self, model_class, name):
+        super(DeferredTextField, self).add_to_class(model_class, name)
+        setattr(model_class, name, DeferredFieldDescriptor(self))
 
-        # We'll enforce that default for all unspecified fields is NULL
-        default_data = {field_name: None for field_name in field_names}
 
-        # Pad each row with the missing fields
-        for i, _ in enumerate(rows):
-            updated_data = copy.copy(default_data)
-            updated_data.update(rows[i])
-            rows[i] = updated_data
+class StoredContentDescriptor(DeferredFieldDescriptor):
+    '''
+    Gives access to the text of a web page.  If the text is saved as a content blob
+    rather than in the row itself, it's loaded and decompressed when it's first read.
+    '''
+    def __get__(self, instance, instance_type=None):
+        value = super(StoredContentDescriptor, self).__get__(instance, instance_type)
+        if instance is None or value is not None or instance.digest is None:
+            return value
+        # The content store depends on the models defined here, so it's imported late.
+        from content_store import load_content
+        return load_content(instance.digest)
+
+
+class StoredContentField(DeferredTextField):
+    '''
+    A deferred text field whose value may instead be saved as a content blob,
+    referenced by the 'digest' field of the same model.
+    '''
+    def add_to_class(self, model_class, name):
+        super(StoredContentField, self).add_to_class(model_class, name)
+        setattr(model_class, name, StoredContentDescriptor(self))
 
 
 class ProxyModel(Model):
-    ''' A peewee model that is connected to the proxy defined in this module. '''
+    '''
+    A peewee model that is connected to the proxy defined in this module.
+    Queries run inside `reading_from_replicas` read from a replica, if there is one.
+    '''
 
     class Meta:
         database = db_proxy
 
+    @classmethod
+    def select(cls, *selection):
+        query = super(ProxyModel, cls).select(*selection)
+        replica = read_replica()
+        if replica is not None:
+            query.database = replica
+        return query
+
 
 class Seed(ProxyModel):
     ''' An initial query given by a user for which autocomplete results are shown. '''
@@ -141,12 +386,31 @@ class SearchResult(ProxyModel):
     rank = IntegerField()
 
 
-class WebPageContent(ProxyModel):
-    ''' The contents at a web URL at a point in time. '''
+class ContentBlob(ProxyModel):
+    '''
+    The compressed text of a web page.  Each distinct text is saved once, under its
+    digest, no matter how many times it was fetched.  Digests are base 32 SHA-1 hashes
+    of the text (see `content_store.content_digest`).
+    '''
+    digest = CharField(unique=True)
+    # How 'data' is compressed: 'zlib', 'zstd', or 'none'
+    compression = CharField()
+    # The size of the text in bytes, before compression
+    size = IntegerField()
+    data = BlobField()
 
+
+class WebPageContent(ProxyModel):
+    '''
+    The contents at a web URL at a point in time.
+    Contents are saved as a ContentBlob that the row refers to by its digest
+    (see `content_store`).  Rows saved before content blobs were introduced have
+    their text in the 'content' column instead.  Either way, 'content' gives the text.
+    '''
     date = DateTimeField(index=True, default=datetime.datetime.now)
     url = TextField(index=True)
-    content = TextField()
+    digest = CharField(index=True, null=True)
+    content = StoredContentField(null=True)
 
 
 class SearchResultContent(ProxyModel):
@@ -232,6 +496,24 @@ class QuestionSnapshot(ProxyModel):
     body = TextField()
 
 
+class QuestionSnapshotDelta(ProxyModel):
+    '''
+    The changes to a question's counters since its previous snapshot, for polls that
+    didn't need a full QuestionSnapshot (see `snapshots`).  'changes' is an array of
+    (counter position, difference) pairs of 64-bit integers, in native byte order.
+    '''
+    fetch_index = IntegerField(index=True)
+    date = DateTimeField(default=datetime.datetime.now)
+    question_id = IntegerField()
+    changes = BlobField()
+
+    class Meta:
+        # A question's deltas are read in order of date, to rebuild its series.
+        indexes = (
+            (('question_id', 'date'), False),
+        )
+
+
 class QuestionSnapshotTag(ProxyModel):
     ''' A link between one snapshot of a Stack Overflow question and one of its tags. '''
     # Both IDs are indexed to allow fast lookup of question snapshot for a given tag and vice versa.
@@ -250,9 +532,10 @@ class Post(ProxyModel):
     Each of these models has an implicit "id" field that will correspond to
     its original ID in the Stack Overflow data dump.
 
-    While some of fields refer to entries in other tables, we don't use indexes or
-    foreign keys for the first iteration of these models.
-    We don't yet know what queries we have to optimize for.
+    While some of fields refer to entries in other tables, we don't declare indexes or
+    foreign keys on these models.  Indexes would slow down loading the data dump, so the
+    indexes that queries need are added by the `migrations` module after the data is loaded.
+    We don't use foreign keys, as the dump refers to some posts that it doesn't include.
 
     I enabled some of the fields to be 'null' based on the ones that were not
     defined in a subset of the data to be imported.  It could be that other
@@ -277,7 +560,7 @@ class Post(ProxyModel):
     deletion_date = DateTimeField(null=True)
     score = IntegerField()
     view_count = IntegerField(null=True)
-    body = TextField()
+    body = DeferredTextField()
     owner_user_id = IntegerField(null=True)
     owner_display_name = CharField(max_length=80, null=True)
     last_editor_user_id = IntegerField(null=True)
@@ -308,16 +591,17 @@ class PostHistory(ProxyModel):
 
     'uniqueidentifier' is described to be a 16-byte GUID here:
     https://msdn.microsoft.com/en-us/library/ms187942.aspx
-    So, we store the uniqueidentifier of the revision_guid field in a 16-byte character field.
+    So, we store the uniqueidentifier of the revision_guid field as a UUID, which Postgres
+    stores in 16 bytes.  The dump writes it as 36 characters of text, which don't fit in 16.
     '''
     post_history_type_id = IntegerField()
     post_id = IntegerField()
-    revision_guid = CharField(max_length=16)
+    revision_guid = UUIDField()
     creation_date = DateTimeField()
     user_id = IntegerField(null=True)
     user_display_name = CharField(max_length=80, null=True)
     comment = TextField(null=True)
-    text = TextField()
+    text = DeferredTextField()
 
 
 class PostLink(ProxyModel):
@@ -341,7 +625,7 @@ class Comment(ProxyModel):
     ''' Comment on a Stack Overflow post. '''
     post_id = IntegerField()
     score = IntegerField()
-    text = TextField()
+    text = DeferredTextField()
     creation_date = DateTimeField()
     user_display_name = CharField(max_length=60, null=True)
     user_id = IntegerField(null=True)
@@ -380,6 +664,12 @@ class PostTag(ProxyModel):
     post_id = IntegerField(index=True)
     tag_id = IntegerField(index=True)
 
+    class Meta:
+        # The posts for a tag can be found from this index alone, without visiting the table.
+        indexes = (
+            (('tag_id', 'post_id'), False),
+        )
+
 
 class SnippetPattern(ProxyModel):
     ''' A regular expression pattern describing a rule for detecting a snippet. '''
@@ -474,6 +764,12 @@ class Issue(ProxyModel):
     comments = IntegerField()
     user_id = IntegerField(index=True, null=True, default=None)
 
+    class Meta:
+        # Synced issues are upserted on this key (see `github_sync`).
+        indexes = (
+            (('project', 'github_id'), True),
+        )
+
 
 class IssueEvent(ProxyModel):
     ''' An event (e.g., "closed") for an issue for a GitHub project. '''
@@ -486,6 +782,12 @@ class IssueEvent(ProxyModel):
     created_at = DateTimeField(index=True)
     event = TextField()
 
+    class Meta:
+        # The key for upserts includes 'created_at', as the table can be partitioned on it.
+        indexes = (
+            (('issue', 'github_id', 'created_at'), True),
+        )
+
 
 class IssueComment(ProxyModel):
     ''' A comment on a GitHub issue. '''
@@ -500,6 +802,24 @@ class IssueComment(ProxyModel):
     body = TextField()
     user_id = IntegerField(index=True, null=True, default=None)
 
+    class Meta:
+        indexes = (
+            (('issue', 'github_id', 'created_at'), True),
+        )
+
+
+class GitHubSyncState(ProxyModel):
+    '''
+    How far the issues, comments, and events of a GitHub project have been synced.
+    Each is the newest 'updated_at' (or 'created_at', for events) that has been saved,
+    so the next sync only asks the API for what changed after it.
+    '''
+    project = ForeignKeyField(GitHubProject, unique=True)
+    date = DateTimeField(default=datetime.datetime.now)
+    issues_updated_at = DateTimeField(null=True)
+    comments_updated_at = DateTimeField(null=True)
+    events_created_at = DateTimeField(null=True)
+
 
 class SlantTopic(ProxyModel):
     ''' A topic of discussion on the Slant website. '''
@@ -543,7 +863,133 @@ class ViewpointSection(ProxyModel):
     downvotes = IntegerField()
 
 
-def init_database(db_type, config_filename=None):
+class SlantTopicRanking(ProxyModel):
+    '''
+    The top viewpoints of a Slant topic, ranked by the votes on their pros and cons
+    (see `alternatives`).  There's one row for each topic, from the newest fetch of
+    Slant data; `fetch_index` is the index of the fetch it was ranked from, and
+    `data_date` is the date of the newest row of that fetch when it was ranked.
+    '''
+    fetch_index = IntegerField(index=True)
+    date = DateTimeField(index=True, default=datetime.datetime.now)
+    data_date = DateTimeField(null=True)
+
+    topic_id = IntegerField(unique=True)
+    title = TextField()
+    url_path = TextField()
+    viewpoint_count = IntegerField()
+    # A JSON list of the top viewpoints, best first
+    viewpoints = TextField()
+
+
+class PackageAlternatives(ProxyModel):
+    '''
+    The Slant topics that suggest a package, with the top viewpoints of each, so that
+    the alternatives to a package can be shown from one row.  Packages are matched to
+    viewpoints by their lowercase titles.  Rows are replaced along with the rankings.
+    '''
+    fetch_index = IntegerField(index=True)
+    date = DateTimeField(index=True, default=datetime.datetime.now)
+
+    package = TextField(unique=True)
+    # A JSON list of topics, each with the package's rank and the top viewpoints
+    topics = TextField()
+
+
+class PackageHealth(ProxyModel):
+    '''
+    Health metrics for a package over one month, rolled up from Stack Overflow posts
+    and GitHub issues so that pages don't have to aggregate the raw tables.
+
+    Durations are stored as totals rather than averages, so that a month can be
+    updated by adding the durations from new data.  To get an average, divide
+    a total by its count (e.g., `accept_hours_total / accepted_question_count`).
+    '''
+
+    compute_index = IntegerField(index=True)
+    date = DateTimeField(index=True, default=datetime.datetime.now)
+
+    package = TextField(index=True)
+    month = DateTimeField(index=True)
+
+    # Stack Overflow questions asked during the month
+    question_count = IntegerField(default=0)
+    answered_question_count = IntegerField(default=0)
+    accepted_question_count = IntegerField(default=0)
+    accept_hours_total = FloatField(default=0)
+
+    # GitHub issues and comments created during the month, from the latest fetch of the project
+    issues_opened = IntegerField(default=0)
+    issues_closed = IntegerField(default=0)
+    close_hours_total = FloatField(default=0)
+    issue_comment_count = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (('package', 'month'), True),
+        )
+
+
+class PackageHealthCheckpoint(ProxyModel):
+    '''
+    A record of how much of the raw data has been rolled up into PackageHealth for a package.
+    Stack Overflow posts and votes come from a data dump, and are read in order of ID:
+    the months whose questions have new answers or accepted answers are recomputed.
+    GitHub data is re-fetched periodically, so the issues from a package's newest fetch
+    replace the issues from the fetch that was rolled up before.
+    '''
+
+    compute_index = IntegerField(index=True)
+    date = DateTimeField(index=True, default=datetime.datetime.now)
+
+    package = TextField(unique=True)
+    last_post_id = IntegerField(default=0)
+    # NULL until the votes have been read, in which case every month is recomputed.
+    last_vote_id = IntegerField(null=True)
+    github_fetch_index = IntegerField(null=True)
+
+
+class SchemaMigration(ProxyModel):
+    ''' A record of a migration from the `migrations` module that was applied to the database. '''
+    version = IntegerField(unique=True)
+    name = TextField()
+    applied_at = DateTimeField(default=datetime.datetime.now)
+
+
+def _postgres_database(pg_config, pooled):
+    config = {}
+    config['user'] = pg_config['dbusername']
+    if 'dbpassword' in pg_config:
+        config['password'] = pg_config['dbpassword']
+    if 'host' in pg_config:
+        config['host'] = pg_config['host']
+    if 'port' in pg_config:
+        config['port'] = pg_config['port']
+
+    if pooled:
+        return PooledPostgresqlDatabase(
+            DATABASE_NAME,
+            max_connections=pg_config.get('max_connections', DEFAULT_MAX_CONNECTIONS),
+            stale_timeout=pg_config.get('stale_timeout', DEFAULT_STALE_TIMEOUT),
+            **config)
+    return PostgresqlDatabase(DATABASE_NAME, **config)
+
+
+def init_database(db_type, config_filename=None, pooled=False, sqlite_filename=None):
+    '''
+    Connect the models to a database.  If `pooled` is set, connections to Postgres are
+    kept in a pool and reused.  The size of the pool and the time after which an unused
+    connection is considered stale can be set in the config file with the keys
+    'max_connections' and 'stale_timeout' (in seconds).
+    Sqlite databases are saved to `sqlite_filename` (by default, 'fetcher.db').
+
+    The Postgres config can also list read replicas under the key 'replicas'.  Each
+    replica is described by the keys that differ from the primary's (e.g., 'host').
+    See `configure_replicas` for the keys 'replica_max_fetch_lag' and
+    'replica_check_interval'.
+    '''
+    replicas = []
+    replica_options = {}
 
     if db_type == 'postgres':
 
@@ -553,56 +999,289 @@ def init_database(db_type, config_filename=None):
         with open(config_filename) as pg_config_file:
             pg_config = json.load(pg_config_file)
 
-        config = {}
-        config['user'] = pg_config['dbusername']
-        if 'dbpassword' in pg_config:
-            config['password'] = pg_config['dbpassword']
-        if 'host' in pg_config:
-            config['host'] = pg_config['host']
-
-        db = PostgresqlDatabase(DATABASE_NAME, **config)
+        db = _postgres_database(pg_config, pooled)
+        for replica_config in pg_config.get('replicas', []):
+            replica_pg_config = dict(pg_config)
+            replica_pg_config.update(replica_config)
+            replicas.append(_postgres_database(replica_pg_config, pooled))
+        if 'replica_max_fetch_lag' in pg_config:
+            replica_options['max_fetch_lag'] = pg_config['replica_max_fetch_lag']
+        if 'replica_check_interval' in pg_config:
+            replica_options['check_interval'] = pg_config['replica_check_interval']
 
     # Sqlite is the default type of database.
     elif db_type == 'sqlite' or not db_type:
-        db = SqliteDatabase(DATABASE_NAME + '.db')
+        db = SqliteDatabase(sqlite_filename or DATABASE_NAME + '.db')
 
     db_proxy.initialize(db)
+    configure_replicas(replicas, **replica_options)
+
+
+# The read replicas, and which of them have caught up with the primary
+_replicas = {
+    'databases': [],
+    'max_fetch_lag': 0,
+    'check_interval': DEFAULT_REPLICA_CHECK_INTERVAL,
+    'fresh': [],
+    'checked_at': None,
+}
+_replica_lock = threading.Lock()
+# Whether the current thread reads from replicas
+_thread_state = threading.local()
+
+
+def configure_replicas(databases, max_fetch_lag=0, check_interval=DEFAULT_REPLICA_CHECK_INTERVAL):
+    '''
+    Set the databases that are read replicas of the primary database behind `db_proxy`.
+
+    A replica is only read from while it's fresh: while the newest fetch index of each
+    kind of fetched data on the replica is at most `max_fetch_lag` behind the primary's
+    (see FETCH_INDEX_FIELDS).  With the default of 0, a replica is only read from once
+    it has the newest fetch.  Freshness is checked at most every `check_interval` seconds.
+    '''
+    with _replica_lock:
+        _replicas['databases'] = list(databases)
+        _replicas['max_fetch_lag'] = max_fetch_lag
+        _replicas['check_interval'] = check_interval
+        _replicas['fresh'] = []
+        _replicas['checked_at'] = None
+    for database in databases:
+        for listener in replica_listeners:
+            listener(database)
+
+
+def replica_databases():
+    ''' Get the databases that are configured as read replicas. '''
+    return list(_replicas['databases'])
 
 
-def create_tables():
-    db_proxy.create_tables([
-        Query,
-        Seed,
-        Search,
-        SearchResult,
-        WebPageContent,
-        Code,
-        SearchResultContent,
-        WebPageVersion,
-        QuestionSnapshot,
-        QuestionSnapshotTag,
-        Post,
-        Tag,
-        PostHistory,
-        PostLink,
-        Vote,
-        Comment,
-        Badge,
-        User,
-        PostTag,
-        SnippetPattern,
-        PostSnippet,
-        PostNpmInstallPackage,
-        Task,
-        TaskNoun,
-        TaskVerb,
-        Noun,
-        Verb,
-        GitHubProject,
-        Issue,
-        IssueComment,
-        IssueEvent,
-        SlantTopic,
-        Viewpoint,
-        ViewpointSection,
-    ], safe=True)
+def read_from_replicas(enabled=True):
+    '''
+    Set whether the current thread reads from replicas.  Writes, and reads in
+    transactions, always go to the primary.  Reads that writes depend on should be
+    made from the primary too, as replicas can be behind.  Returns the last setting.
+    '''
+    previous = getattr(_thread_state, 'use_replicas', False)
+    _thread_state.use_replicas = enabled
+    return previous
+
+
+@contextmanager
+def reading_from_replicas():
+    ''' Read from replicas in the current thread while in this context. '''
+    previous = read_from_replicas(True)
+    try:
+        yield
+    finally:
+        read_from_replicas(previous)
+
+
+def _newest_fetch_indexes(database):
+    return [
+        database.execute_sql('SELECT MAX({column}) FROM {table}'.format(
+            column=field.db_column, table=field.model_class._meta.db_table)).fetchone()[0]
+        for field in FETCH_INDEX_FIELDS
+    ]
+
+
+def _is_fresh(primary_indexes, replica_indexes, max_fetch_lag):
+    for primary_index, replica_index in zip(primary_indexes, replica_indexes):
+        if primary_index is None:
+            continue
+        if replica_index is None or primary_index - replica_index > max_fetch_lag:
+            return False
+    return True
+
+
+def fresh_replicas():
+    '''
+    Get the replicas that have caught up with the primary.  The last check is reused
+    until it's older than the check interval.  Replicas that can't be reached are skipped.
+    '''
+    with _replica_lock:
+        if not _replicas['databases']:
+            return []
+        checked_at = _replicas['checked_at']
+        if checked_at is not None and time.time() - checked_at < _replicas['check_interval']:
+            return _replicas['fresh']
+        # Other threads keep using the last check while this one checks again.
+        _replicas['checked_at'] = time.time()
+        databases = _replicas['databases']
+        max_fetch_lag = _replicas['max_fetch_lag']
+
+    primary_indexes = _newest_fetch_indexes(db_proxy)
+    fresh = []
+    for database in databases:
+        try:
+            replica_indexes = _newest_fetch_indexes(database)
+        except DatabaseError:
+            logger.warning("Could not reach read replica %s", database.database, exc_info=True)
+            continue
+        if _is_fresh(primary_indexes, replica_indexes, max_fetch_lag):
+            fresh.append(database)
+        else:
+            logger.info("Read replica is behind the primary (%s < %s)", replica_indexes, primary_indexes)
+
+    with _replica_lock:
+        _replicas['fresh'] = fresh
+    return fresh
+
+
+def read_replica():
+    '''
+    Choose the replica that the current thread should read from, or None if it should
+    read from the primary: if it isn't reading from replicas, if it's in a transaction
+    on the primary, or if no replica is fresh.
+    '''
+    if not getattr(_thread_state, 'use_replicas', False) or not _replicas['databases']:
+        return None
+    if db_proxy.obj is None or db_proxy.transaction_depth() > 0:
+        return None
+    replicas = fresh_replicas()
+    return random.choice(replicas) if replicas else None
+
+
+def open_connection():
+    ''' Open a database connection for the current thread, unless one is already open. '''
+    if db_proxy.is_closed():
+        db_proxy.connect()
+
+
+def close_connection(discard=False):
+    '''
+    Close the current thread's database connections to the primary and to any replicas.
+    For a pooled database, this returns the connection to the pool.  Set `discard` if the
+    connection may be broken (e.g., the server dropped it), and it will be closed for good
+    instead of being reused.
+    '''
+    for database in [db_proxy.obj] + _replicas['databases']:
+        if database.is_closed():
+            continue
+        if discard and isinstance(database, PooledDatabase):
+            database.manual_close()
+        else:
+            database.close()
+
+
+def light_select(ModelType):
+    '''
+    Select all of a model's fields except for its deferred text fields.  This is for
+    list views, which would otherwise transfer large text values that they never show.
+    '''
+    return ModelType.select(*[
+        field for field in ModelType._meta.sorted_fields
+        if not isinstance(field, DeferredTextField)])
+
+
+_row_types = {}
+
+
+def as_namedtuples(query):
+    '''
+    Evaluate a query once, and return its rows as a list of named tuples, which are
+    much cheaper to create than model instances.  Each tuple has an attribute
+    for each field that was selected.
+    '''
+    names = tuple(getattr(node, '_alias', None) or node.name for node in query._select)
+    if names not in _row_types:
+        _row_types[names] = namedtuple('Row', names)
+    Row = _row_types[names]
+    return [Row(*row) for row in query.tuples()]
+
+
+def using_postgres():
+    ''' Check whether the database behind the proxy is a Postgres database. '''
+    return isinstance(db_proxy.obj, PostgresqlDatabase)
+
+
+# The fields whose newest values show how up to date a database is.  There's a new
+# value each time data is fetched.
+FETCH_INDEX_FIELDS = [
+    GitHubProject.fetch_index,
+    QuestionSnapshot.fetch_index,
+    QuestionSnapshotDelta.fetch_index,
+    SlantTopic.fetch_index,
+]
+
+# All models, in an order in which their tables can be created
+MODELS = [
+    Query,
+    Seed,
+    Search,
+    SearchResult,
+    ContentBlob,
+    WebPageContent,
+    Code,
+    SearchResultContent,
+    WebPageVersion,
+    QuestionSnapshot,
+    QuestionSnapshotDelta,
+    QuestionSnapshotTag,
+    Post,
+    Tag,
+    PostHistory,
+    PostLink,
+    Vote,
+    Comment,
+    Badge,
+    User,
+    PostTag,
+    SnippetPattern,
+    PostSnippet,
+    PostNpmInstallPackage,
+    Task,
+    TaskNoun,
+    TaskVerb,
+    Noun,
+    Verb,
+    GitHubProject,
+    Issue,
+    IssueComment,
+    IssueEvent,
+    GitHubSyncState,
+    SlantTopic,
+    Viewpoint,
+    ViewpointSection,
+    SlantTopicRanking,
+    PackageAlternatives,
+    PackageHealth,
+    PackageHealthCheckpoint,
+    SchemaMigration,
+]
+
+
+def create_table_without_indexes(model):
+    '''
+    Create a model's table with only its columns and primary key.  Its indexes, unique
+    constraints, and foreign keys are added after its data is loaded.
+    '''
+    compiler = db_proxy.compiler()
+    meta = model._meta
+    columns = [compiler.field_definition(field) for field in meta.declared_fields]
+    constraints = []
+    if meta.composite_key:
+        constraints.append(Clause(SQL('PRIMARY KEY'), EnclosedClause(
+            *[meta.fields[name].as_entity() for name in meta.primary_key.field_names])))
+    db_proxy.execute(Clause(
+        SQL('CREATE TABLE IF NOT EXISTS'), model.as_entity(), EnclosedClause(*(columns + constraints))))
+
+
+def create_tables(partitioned=False):
+    '''
+    Create the tables for all models that don't have tables yet.
+    If `partitioned` is set and the database is Postgres, the append-only tables for
+    periodic fetches are created as tables partitioned by month (see `partitions`).
+    '''
+    # These modules depend on the models defined here, so they're imported late.
+    from partitions import PARTITIONED_MODELS, create_partitioned_table
+    from search import create_search_index
+
+    if partitioned and using_postgres():
+        db_proxy.create_tables(
+            [model for model in MODELS if model not in PARTITIONED_MODELS], safe=True)
+        for model in PARTITIONED_MODELS:
+            create_partitioned_table(model)
+    else:
+        db_proxy.create_tables(MODELS, safe=True)
+
+    create_search_index()
@@ -0,0 +1,159 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import base64
+import binascii
+import datetime
+import json
+
+from peewee import fn
+from models import as_namedtuples, Post, PostTag, GitHubProject, Issue, IssueComment
+from tags import find_tag
+
+
+DEFAULT_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 100
+
+DATE_FORMATS = ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S']
+
+# The fields that are fetched for each record in a list.  Posts and issues are listed without their bodies.
+POST_LIST_FIELDS = [
+    Post.id, Post.title, Post.score, Post.answer_count, Post.comment_count, Post.creation_date,
+]
+ISSUE_LIST_FIELDS = [
+    Issue.id, Issue.number, Issue.state, Issue.comments, Issue.created_at, Issue.closed_at,
+]
+ISSUE_COMMENT_LIST_FIELDS = [
+    IssueComment.id, IssueComment.user_id, IssueComment.created_at, IssueComment.body,
+]
+
+
+class InvalidCursor(ValueError):
+    ''' Raised when a continuation token can't be decoded. '''
+
+
+def encode_cursor(date, row_id):
+    '''
+    Make an opaque continuation token that points just past a row.
+    Rows are identified by their date and ID, as dates alone may not be unique.
+    The date is None for rows that are paged through by their IDs alone.
+    '''
+    payload = json.dumps([date.isoformat() if date is not None else None, row_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    ''' Get the date and ID of the row a continuation token points past. '''
+    try:
+        padding = '=' * (-len(token) % 4)
+        date_text, row_id = json.loads(
+            base64.urlsafe_b64decode((token + padding).encode('ascii')).decode('utf-8'))
+    except (binascii.Error, UnicodeError, ValueError, TypeError):
+        raise InvalidCursor("Malformed continuation token")
+
+    if date_text is None:
+        try:
+            return None, int(row_id)
+        except (ValueError, TypeError):
+            raise InvalidCursor("Malformed continuation token")
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(date_text, date_format), int(row_id)
+        except (ValueError, TypeError):
+            continue
+    raise InvalidCursor("Malformed continuation token")
+
+
+def _row_attribute(query, field):
+    ''' Get the name of the attribute that a field selected by a query has in its named tuples. '''
+    for node in query._select:
+        if getattr(node, 'model_class', None) is field.model_class and \
+                getattr(node, 'name', None) == field.name:
+            return getattr(node, '_alias', None) or node.name
+    return field.name
+
+
+def keyset_page(query, date_field, id_field, cursor=None, per_page=DEFAULT_PAGE_SIZE,
+                descending=True):
+    '''
+    Fetch one page of a query's results, ordered by date and then by ID.
+    If `date_field` is None, the results are ordered by ID alone.
+
+    Instead of skipping rows with OFFSET, which gets slower the deeper you page,
+    a page starts right after the row that the `cursor` points to.  This lets the
+    database find the start of each page with an index on the date.
+    Rows are returned as named tuples, so the query has to select the date and ID fields.
+    Returns the rows on the page, and a cursor for the next page (None if this is the last page).
+    '''
+    per_page = max(1, min(per_page, MAX_PAGE_SIZE))
+
+    if cursor is not None:
+        date, row_id = decode_cursor(cursor)
+        if date_field is None:
+            query = query.where(id_field < row_id if descending else id_field > row_id)
+        elif date is None:
+            raise InvalidCursor("Continuation token is missing its date")
+        # The first condition lets the database use a range scan over the date index.
+        elif descending:
+            query = query.where(
+                (date_field <= date) & ((date_field < date) | (id_field < row_id)))
+        else:
+            query = query.where(
+                (date_field >= date) & ((date_field > date) | (id_field > row_id)))
+
+    order_fields = [id_field] if date_field is None else [date_field, id_field]
+    if descending:
+        query = query.order_by(*[field.desc() for field in order_fields])
+    else:
+        query = query.order_by(*order_fields)
+
+    # One extra row is fetched to find out if there's another page.
+    rows = as_namedtuples(query.limit(per_page + 1))
+    if len(rows) <= per_page:
+        return rows, None
+
+    rows = rows[:per_page]
+    last_row = rows[-1]
+    date = getattr(last_row, _row_attribute(query, date_field)) if date_field is not None else None
+    return rows, encode_cursor(date, getattr(last_row, _row_attribute(query, id_field)))
+
+
+def post_page(package_name, cursor=None, per_page=DEFAULT_PAGE_SIZE):
+    '''
+    Fetch a page of the posts with a package's tag, newest first.
+    Posts are numbered in the order they were created, so they're paged through by
+    their IDs.  This lets each page be found in the (tag_id, post_id) index of PostTag,
+    rather than reading every post with the tag to sort them by date.
+    '''
+    tag = find_tag(package_name)
+    if tag is None:
+        return [], None
+    # The posts' IDs are read from PostTag, so that they come from the index too.
+    fields = [PostTag.post_id.alias('id')] + [
+        field for field in POST_LIST_FIELDS if field is not Post.id]
+    query = (
+        Post.select(*fields)
+        .join(PostTag, on=(PostTag.post_id == Post.id))
+        .where(PostTag.tag_id == tag.id)
+    )
+    return keyset_page(query, None, PostTag.post_id, cursor, per_page)
+
+
+def issue_page(package_name, cursor=None, per_page=DEFAULT_PAGE_SIZE):
+    ''' Fetch a page of the issues of a package's GitHub project from its newest fetch, newest first. '''
+    fetch_index = GitHubProject.select(fn.Max(GitHubProject.fetch_index)).where(
+        GitHubProject.name == package_name).scalar()
+    if fetch_index is None:
+        return [], None
+    projects = GitHubProject.select(GitHubProject.id).where(
+        (GitHubProject.name == package_name) & (GitHubProject.fetch_index == fetch_index))
+    query = Issue.select(*ISSUE_LIST_FIELDS).where(Issue.project << projects)
+    return keyset_page(query, Issue.created_at, Issue.id, cursor, per_page)
+
+
+def issue_comment_page(issue_id, cursor=None, per_page=DEFAULT_PAGE_SIZE):
+    ''' Fetch a page of the comments on an issue, in the order they were written. '''
+    query = IssueComment.select(*ISSUE_COMMENT_LIST_FIELDS).where(IssueComment.issue == issue_id)
+    return keyset_page(
+        query, IssueComment.created_at, IssueComment.id, cursor, per_page, descending=False)
@@ -0,0 +1,276 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Range partitioning by month for the append-only tables that grow with each periodic fetch.
+
+On Postgres, these tables can be created as partitioned tables (see `create_tables`),
+with one partition for each month of the partitioning column.  Queries that are limited
+to a time window on that column (e.g., `snapshots.read_series`) only read the partitions
+for that window, and old months can be detached from a table without deleting rows one
+by one.
+
+`PartitionedBatchInserter` creates the partitions for the rows it saves, and
+`ensure_partitions` does the same for other code that writes to these tables.  Rows for
+months without a partition (e.g., rows saved with `Model.create` or by the fetchers) go
+to a default partition, so that no write fails.  Creating a month's partition moves its
+rows out of the default partition, and `split_default_partitions` does this for all of
+the months in it:
+
+    python partitions.py --db postgres --db-config postgres-credentials.json
+
+Partitioning requires Postgres 11 or newer.  On other databases, the tables are regular
+tables and all of these helpers do nothing.
+'''
+
+from __future__ import unicode_literals
+import logging
+import argparse
+import datetime
+from collections import OrderedDict
+
+from peewee import SQL, Clause, EnclosedClause, ForeignKeyField
+from models import init_database, db_proxy, using_postgres, BatchInserter, \
+    QuestionSnapshot, QuestionSnapshotDelta, WebPageVersion, IssueEvent, IssueComment
+
+
+logger = logging.getLogger('data')
+
+# Partitioned models, and the name of the field each one is partitioned on
+PARTITIONED_MODELS = OrderedDict([
+    (QuestionSnapshot, 'date'),
+    (QuestionSnapshotDelta, 'date'),
+    (WebPageVersion, 'date'),
+    (IssueEvent, 'created_at'),
+    (IssueComment, 'created_at'),
+])
+
+# The names of the partitions of each table that are known to exist.  This saves
+# looking up the partitions every time rows are saved.
+_known_partitions = {}
+
+
+def _quote(name):
+    return db_proxy.quote_char + name + db_proxy.quote_char
+
+
+def month_start(date):
+    return datetime.datetime(date.year, date.month, 1)
+
+
+def next_month(month):
+    return datetime.datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def partition_name(model, month):
+    return '{table}_p{month:%Y%m}'.format(table=model._meta.db_table, month=month)
+
+
+def default_partition_name(model):
+    return model._meta.db_table + '_default'
+
+
+def is_partitioned(model):
+    ''' Check whether the table for a model was created as a partitioned table. '''
+    if not using_postgres():
+        return False
+    cursor = db_proxy.execute_sql(
+        "SELECT 1 FROM pg_partitioned_table "
+        "JOIN pg_class ON pg_class.oid = pg_partitioned_table.partrelid "
+        "WHERE pg_class.relname = %s", (model._meta.db_table,))
+    return cursor.fetchone() is not None
+
+
+def create_partitioned_table(model):
+    '''
+    Create a table for a model, partitioned by month on its partitioning field.
+    Postgres requires that the primary key of a partitioned table includes the
+    partitioning column, so the primary key is (id, partitioning column).
+    '''
+    compiler = db_proxy.compiler()
+    meta = model._meta
+    partition_field = meta.fields[PARTITIONED_MODELS[model]]
+
+    columns = []
+    for field in meta.sorted_fields:
+        column_type = compiler.get_column_type(field.get_db_field())
+        ddl = [field.as_entity(), field.__ddl_column__(column_type)]
+        if not field.null:
+            ddl.append(SQL('NOT NULL'))
+        columns.append(Clause(*ddl))
+    constraints = [Clause(
+        SQL('PRIMARY KEY'),
+        EnclosedClause(meta.primary_key.as_entity(), partition_field.as_entity()))]
+    for field in meta.sorted_fields:
+        if isinstance(field, ForeignKeyField):
+            constraints.append(compiler.foreign_key_constraint(field))
+
+    db_proxy.execute(Clause(
+        SQL('CREATE TABLE IF NOT EXISTS'),
+        model.as_entity(),
+        EnclosedClause(*(columns + constraints)),
+        SQL('PARTITION BY RANGE'),
+        EnclosedClause(partition_field.as_entity())))
+
+    # Indexes created on a partitioned table are created on each of its partitions too.
+    for fields, unique in model._index_data():
+        fields = [meta.fields[field] if not hasattr(field, 'db_column') else field
+                  for field in fields]
+        db_proxy.execute_sql('CREATE {unique}INDEX IF NOT EXISTS {name} ON {table} ({columns})'.format(
+            unique='UNIQUE ' if unique else '',
+            name=_quote(compiler.index_name(meta.db_table, [field.db_column for field in fields])),
+            table=_quote(meta.db_table),
+            columns=', '.join(_quote(field.db_column) for field in fields)))
+
+    # Rows for months that don't have partitions are saved to the default partition.
+    db_proxy.execute_sql("CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {table} DEFAULT".format(
+        partition=_quote(default_partition_name(model)), table=_quote(meta.db_table)))
+
+    # Partitions for the current month and the next are created up front.
+    this_month = month_start(datetime.datetime.now())
+    ensure_partitions(model, [this_month, next_month(this_month)])
+
+
+def list_partitions(model):
+    ''' Get the names of the partitions of a model's table. '''
+    cursor = db_proxy.execute_sql(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE parent.relname = %s", (model._meta.db_table,))
+    return set(row[0] for row in cursor.fetchall())
+
+
+def ensure_partitions(model, dates):
+    '''
+    Make sure a partitioned table has partitions for the months of all of the dates given.
+    This does nothing for tables that aren't partitioned.
+    '''
+    table = model._meta.db_table
+    if table not in _known_partitions:
+        _known_partitions[table] = list_partitions(model) if is_partitioned(model) else None
+    partitions = _known_partitions[table]
+    if partitions is None:
+        return
+
+    for month in sorted(set(month_start(date) for date in dates)):
+        name = partition_name(model, month)
+        if name in partitions:
+            continue
+        logger.info("Creating partition %s", name)
+        _create_partition(model, month)
+        partitions.add(name)
+
+
+def _create_partition(model, month):
+    '''
+    Create the partition for a month.  Postgres won't create a partition for rows that
+    are in the default partition, so any rows of the month are moved out of the default
+    partition into a new table first, which is then attached as the month's partition.
+    '''
+    table = _quote(model._meta.db_table)
+    name = _quote(partition_name(model, month))
+    default = _quote(default_partition_name(model))
+    column = _quote(model._meta.fields[PARTITIONED_MODELS[model]].db_column)
+    bounds = (month, next_month(month))
+    # Postgres 10 and 11 only accept literals as partition bounds, not parameters.
+    # The bounds are datetimes made here, so they're safe to write into the SQL.
+    for_values = "FOR VALUES FROM ('{0}') TO ('{1}')".format(*(bound.isoformat() for bound in bounds))
+    in_month = "{column} >= %s AND {column} < %s".format(column=column)
+
+    with db_proxy.atomic():
+        cursor = db_proxy.execute_sql(
+            "SELECT 1 FROM {default} WHERE {in_month} LIMIT 1".format(default=default, in_month=in_month),
+            bounds)
+        if cursor.fetchone() is None:
+            db_proxy.execute_sql(
+                "CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {table} {for_values}".format(
+                    partition=name, table=table, for_values=for_values))
+            return
+
+        logger.info("Moving rows from %s to %s", default, name)
+        db_proxy.execute_sql("CREATE TABLE {partition} (LIKE {table} INCLUDING DEFAULTS)".format(
+            partition=name, table=table))
+        db_proxy.execute_sql(
+            "WITH moved AS (DELETE FROM {default} WHERE {in_month} RETURNING *) "
+            "INSERT INTO {partition} SELECT * FROM moved".format(
+                default=default, in_month=in_month, partition=name),
+            bounds)
+        # The table's indexes and foreign keys are added to the partition when it's attached.
+        db_proxy.execute_sql(
+            "ALTER TABLE {table} ATTACH PARTITION {partition} {for_values}".format(
+                table=table, partition=name, for_values=for_values))
+
+
+def split_default_partitions(model):
+    '''
+    Move the rows in a table's default partition into partitions for their months.
+    This does nothing for tables that aren't partitioned.  Returns the months moved.
+    '''
+    if not is_partitioned(model):
+        return []
+    cursor = db_proxy.execute_sql(
+        "SELECT DISTINCT date_trunc('month', {column}) FROM {default}".format(
+            column=_quote(model._meta.fields[PARTITIONED_MODELS[model]].db_column),
+            default=_quote(default_partition_name(model))))
+    months = sorted(row[0] for row in cursor.fetchall())
+    # The partitions are looked up again, in case another process created some.
+    _known_partitions.pop(model._meta.db_table, None)
+    ensure_partitions(model, months)
+    return months
+
+
+def detach_partitions(model, before, drop=False):
+    '''
+    Detach the partitions for all months before a date from a partitioned table.
+    Detached partitions become regular tables, which can be archived.  If `drop` is
+    set, they're dropped instead.  Returns the names of the partitions that were detached.
+    '''
+    if not is_partitioned(model):
+        return []
+
+    table = model._meta.db_table
+    detached = []
+    for name in sorted(list_partitions(model) - {default_partition_name(model)}):
+        month = datetime.datetime.strptime(name[len(table) + 2:], '%Y%m')
+        if next_month(month) > before:
+            continue
+        logger.info("Detaching partition %s", name)
+        db_proxy.execute_sql("ALTER TABLE {table} DETACH PARTITION {partition}".format(
+            table=_quote(table), partition=_quote(name)))
+        if drop:
+            db_proxy.execute_sql("DROP TABLE {partition}".format(partition=_quote(name)))
+        detached.append(name)
+
+    _known_partitions.pop(table, None)
+    return detached
+
+
+class PartitionedBatchInserter(BatchInserter):
+    '''
+    A batch inserter that creates the monthly partitions that a batch of rows needs
+    before saving it.  For models that aren't partitioned, it acts like a BatchInserter.
+    '''
+    def flush(self):
+        field_name = PARTITIONED_MODELS.get(self.ModelType)
+        if field_name is not None and self.rows:
+            default = self.ModelType._meta.fields[field_name].default
+            dates = [row.get(field_name) or (default() if callable(default) else default)
+                     for row in self.rows]
+            ensure_partitions(self.ModelType, dates)
+        super(PartitionedBatchInserter, self).flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Move the rows in the default partitions of partitioned tables into monthly partitions")
+    parser.add_argument('--db', default='sqlite', choices=['sqlite', 'postgres'])
+    parser.add_argument('--db-config', help="Postgres credentials file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+    init_database(args.db, args.db_config)
+    for model in PARTITIONED_MODELS:
+        months = split_default_partitions(model)
+        if months:
+            logger.info("Moved %d months of %s out of its default partition", len(months), model.__name__)
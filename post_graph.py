@@ -0,0 +1,380 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+An index of the graph of Stack Overflow posts: questions and their answers, duplicate
+links, and related links, and the questions with each tag.
+
+Finding which canonical questions a package's questions are duplicates of takes
+recursive queries over the database.  This index is built once from Post, PostLink,
+and PostTag instead, and saved to a file as compact arrays of integers in compressed
+sparse row (CSR) form: for each post, its neighbors are a slice of one array of
+targets, between two offsets.  Posts are numbered by their position in a sorted array
+of post IDs, so the arrays don't have gaps for missing IDs.
+
+The file is memory-mapped when it's loaded, so all of the server's worker processes
+share one copy of it in the page cache, and lookups are done without any queries.
+Arrays are saved in the machine's native byte order, so the file should be built on
+the same kind of machine that reads it.
+
+    python post_graph.py --db postgres --db-config postgres-credentials.json
+'''
+
+from __future__ import unicode_literals
+import logging
+import argparse
+import bisect
+import heapq
+import mmap
+import os
+import struct
+from array import array
+from collections import Counter, OrderedDict
+
+from models import init_database, Post, PostLink, PostTag
+
+
+logger = logging.getLogger('data')
+
+GRAPH_FILENAME = 'post-graph.bin'
+MAGIC = b'POSTGRF1'
+HEADER_FORMAT = '<8sI4x'
+# Each section has a name, an array type code, and the position and length of its array.
+NAME_SIZE = 32
+SECTION_FORMAT = '<%ds8sQQ' % NAME_SIZE
+ALIGNMENT = 8
+
+# Values of PostLink.link_type_id
+LINKED_TYPE = 1
+DUPLICATE_TYPE = 3
+
+NO_NODE = -1
+
+# The arrays saved in the file, and their types.  'offsets' arrays have one more
+# entry than there are rows, and row i's neighbors are between offsets i and i + 1.
+SECTIONS = OrderedDict([
+    ('post_ids', 'i'),            # The ID of each post, in increasing order
+    ('accepted', 'i'),            # The accepted answer of each question, or NO_NODE
+    ('canonical', 'i'),           # The canonical question of each post's duplicate cluster, or NO_NODE
+    ('answer_offsets', 'q'),      # Question -> answers
+    ('answer_targets', 'i'),
+    ('duplicate_offsets', 'q'),   # Duplicate -> the questions it duplicates
+    ('duplicate_targets', 'i'),
+    ('original_offsets', 'q'),    # Question -> the questions that duplicate it
+    ('original_targets', 'i'),
+    ('link_offsets', 'q'),        # Post <-> related posts, in both directions
+    ('link_targets', 'i'),
+    ('tag_ids', 'i'),             # The ID of each tag, in increasing order
+    ('tag_offsets', 'q'),         # Tag -> questions
+    ('tag_targets', 'i'),
+])
+
+
+def _zeros(typecode, length):
+    values = array(typecode)
+    values.frombytes(bytes(values.itemsize * length))
+    return values
+
+
+def build_csr(row_count, sources, targets):
+    ''' Build the offsets and targets arrays of a CSR graph from lists of edges. '''
+    offsets = _zeros('q', row_count + 1)
+    for source in sources:
+        offsets[source + 1] += 1
+    for row in range(row_count):
+        offsets[row + 1] += offsets[row]
+
+    positions = array('q', offsets[:-1])
+    adjacency = _zeros('i', len(targets))
+    for source, target in zip(sources, targets):
+        adjacency[positions[source]] = target
+        positions[source] += 1
+    return offsets, adjacency
+
+
+def _canonical_questions(node_count, duplicate_sources, duplicate_targets):
+    '''
+    Group posts into clusters of duplicates, and find the canonical question of each
+    cluster: the one that the most posts in the cluster are marked as duplicates of
+    (the one with the lowest ID if there's a tie).  Posts that aren't linked as
+    duplicates aren't in any cluster.
+    '''
+    parents = array('i', range(node_count))
+
+    def root(node):
+        while parents[node] != node:
+            parents[node] = parents[parents[node]]
+            node = parents[node]
+        return node
+
+    for source, target in zip(duplicate_sources, duplicate_targets):
+        source_root, target_root = root(source), root(target)
+        if source_root != target_root:
+            parents[max(source_root, target_root)] = min(source_root, target_root)
+
+    incoming = Counter(duplicate_targets)
+    best = {}
+    for node in set(duplicate_sources) | set(duplicate_targets):
+        cluster = root(node)
+        # Nodes are numbered in order of post ID, so lower numbers win ties.
+        if cluster not in best or (incoming[node], -node) > (incoming[best[cluster]], -best[cluster]):
+            best[cluster] = node
+
+    canonical = array('i', [NO_NODE]) * node_count
+    for node in set(duplicate_sources) | set(duplicate_targets):
+        canonical[node] = best[root(node)]
+    return canonical
+
+
+def _write_graph(filename, arrays):
+    '''
+    Save arrays to a file: a header that lists each array's name, type, position, and
+    length, followed by the arrays.  The file is replaced in one step, so processes
+    that are reading the old file are never given a partly written one.
+    '''
+    header_size = struct.calcsize(HEADER_FORMAT) + struct.calcsize(SECTION_FORMAT) * len(arrays)
+    position = header_size
+    sections = []
+    for name, values in arrays.items():
+        if len(name) > NAME_SIZE:
+            raise ValueError("Section name %s is too long" % name)
+        position += -position % ALIGNMENT
+        sections.append(struct.pack(
+            SECTION_FORMAT, name.encode('ascii'), values.typecode.encode('ascii'),
+            position, len(values)))
+        position += len(values) * values.itemsize
+
+    temporary_filename = filename + '.tmp'
+    with open(temporary_filename, 'wb') as graph_file:
+        graph_file.write(struct.pack(HEADER_FORMAT, MAGIC, len(arrays)))
+        for section in sections:
+            graph_file.write(section)
+        for values in arrays.values():
+            graph_file.write(b'\0' * (-graph_file.tell() % ALIGNMENT))
+            values.tofile(graph_file)
+    os.replace(temporary_filename, filename)
+
+
+def build_graph(filename=GRAPH_FILENAME):
+    ''' Build the index from the posts, links, and tags in the database, and save it to a file. '''
+    post_ids = array('i')
+    parent_ids = array('i')
+    accepted_ids = array('i')
+    posts = Post.select(Post.id, Post.parent_id, Post.accepted_answer_id).order_by(Post.id).tuples()
+    for post_id, parent_id, accepted_answer_id in posts.iterator():
+        post_ids.append(post_id)
+        parent_ids.append(parent_id if parent_id is not None else NO_NODE)
+        accepted_ids.append(accepted_answer_id if accepted_answer_id is not None else NO_NODE)
+    node_count = len(post_ids)
+    logger.info("Read %d posts", node_count)
+
+    def node(post_id):
+        position = bisect.bisect_left(post_ids, post_id)
+        return position if position < node_count and post_ids[position] == post_id else NO_NODE
+
+    answer_sources, answer_targets = array('i'), array('i')
+    accepted = array('i', [NO_NODE]) * node_count
+    for answer, parent_id in enumerate(parent_ids):
+        question = node(parent_id) if parent_id != NO_NODE else NO_NODE
+        if question != NO_NODE:
+            answer_sources.append(question)
+            answer_targets.append(answer)
+    for question, accepted_id in enumerate(accepted_ids):
+        if accepted_id != NO_NODE:
+            accepted[question] = node(accepted_id)
+    del parent_ids, accepted_ids
+
+    duplicate_sources, duplicate_targets = array('i'), array('i')
+    link_sources, link_targets = array('i'), array('i')
+    links = PostLink.select(PostLink.post_id, PostLink.related_post_id, PostLink.link_type_id).tuples()
+    for post_id, related_post_id, link_type_id in links.iterator():
+        source, target = node(post_id), node(related_post_id)
+        if source == NO_NODE or target == NO_NODE or source == target:
+            continue
+        if link_type_id == DUPLICATE_TYPE:
+            duplicate_sources.append(source)
+            duplicate_targets.append(target)
+        else:
+            link_sources.extend((source, target))
+            link_targets.extend((target, source))
+    logger.info("Read %d duplicate links and %d related links",
+                len(duplicate_sources), len(link_sources) // 2)
+
+    tag_ids = array('i')
+    tag_sources, tag_targets = array('i'), array('i')
+    post_tags = PostTag.select(PostTag.tag_id, PostTag.post_id).order_by(PostTag.tag_id).tuples()
+    for tag_id, post_id in post_tags.iterator():
+        question = node(post_id)
+        if question == NO_NODE:
+            continue
+        if not tag_ids or tag_ids[-1] != tag_id:
+            tag_ids.append(tag_id)
+        tag_sources.append(len(tag_ids) - 1)
+        tag_targets.append(question)
+
+    arrays = OrderedDict()
+    arrays['post_ids'] = post_ids
+    arrays['accepted'] = accepted
+    arrays['canonical'] = _canonical_questions(node_count, duplicate_sources, duplicate_targets)
+    arrays['answer_offsets'], arrays['answer_targets'] = build_csr(node_count, answer_sources, answer_targets)
+    arrays['duplicate_offsets'], arrays['duplicate_targets'] = build_csr(
+        node_count, duplicate_sources, duplicate_targets)
+    arrays['original_offsets'], arrays['original_targets'] = build_csr(
+        node_count, duplicate_targets, duplicate_sources)
+    arrays['link_offsets'], arrays['link_targets'] = build_csr(node_count, link_sources, link_targets)
+    arrays['tag_ids'] = tag_ids
+    arrays['tag_offsets'], arrays['tag_targets'] = build_csr(len(tag_ids), tag_sources, tag_targets)
+    _write_graph(filename, arrays)
+    logger.info("Saved the post graph to %s", filename)
+
+
+class PostGraph(object):
+    '''
+    The index, read from a file through a memory map.  Each array in SECTIONS is an
+    attribute, as a read-only memoryview of the file.  Methods take and return post IDs.
+    '''
+    def __init__(self, filename=GRAPH_FILENAME):
+        self.filename = filename
+        with open(filename, 'rb') as graph_file:
+            self.modified = os.fstat(graph_file.fileno()).st_mtime
+            self._mmap = mmap.mmap(graph_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, section_count = struct.unpack_from(HEADER_FORMAT, self._mmap)
+        if magic != MAGIC:
+            raise ValueError("%s is not a post graph file" % filename)
+        data = memoryview(self._mmap)
+        position = struct.calcsize(HEADER_FORMAT)
+        for _ in range(section_count):
+            name, typecode, offset, length = struct.unpack_from(SECTION_FORMAT, self._mmap, position)
+            position += struct.calcsize(SECTION_FORMAT)
+            typecode = typecode.rstrip(b'\0').decode('ascii')
+            size = array(typecode).itemsize
+            setattr(self, name.rstrip(b'\0').decode('ascii'),
+                    data[offset:offset + length * size].cast(typecode))
+        self.node_count = len(self.post_ids)
+
+    def _node(self, post_id):
+        position = bisect.bisect_left(self.post_ids, post_id)
+        if position < self.node_count and self.post_ids[position] == post_id:
+            return position
+        return NO_NODE
+
+    @staticmethod
+    def _row(offsets, targets, row):
+        return targets[offsets[row]:offsets[row + 1]]
+
+    def _post_ids(self, nodes):
+        return [self.post_ids[node] for node in nodes]
+
+    def _neighbors(self, post_id, offsets, targets):
+        node = self._node(post_id)
+        return self._post_ids(self._row(offsets, targets, node)) if node != NO_NODE else []
+
+    def answers(self, question_id):
+        return self._neighbors(question_id, self.answer_offsets, self.answer_targets)
+
+    def accepted_answer(self, question_id):
+        node = self._node(question_id)
+        if node == NO_NODE or self.accepted[node] == NO_NODE:
+            return None
+        return self.post_ids[self.accepted[node]]
+
+    def related_posts(self, post_id):
+        return self._neighbors(post_id, self.link_offsets, self.link_targets)
+
+    def duplicated_questions(self, post_id):
+        ''' The questions that a post is marked as a duplicate of. '''
+        return self._neighbors(post_id, self.duplicate_offsets, self.duplicate_targets)
+
+    def duplicates_of(self, question_id):
+        ''' The posts that are marked as duplicates of a question. '''
+        return self._neighbors(question_id, self.original_offsets, self.original_targets)
+
+    def canonical_question(self, post_id):
+        ''' The canonical question of a post's cluster of duplicates, or None if it has no duplicates. '''
+        node = self._node(post_id)
+        if node == NO_NODE or self.canonical[node] == NO_NODE:
+            return None
+        return self.post_ids[self.canonical[node]]
+
+    def duplicate_cluster(self, post_id):
+        ''' All posts that are linked to a post through duplicate links, in order of ID. '''
+        start = self._node(post_id)
+        if start == NO_NODE or self.canonical[start] == NO_NODE:
+            return []
+        cluster = set([start])
+        pending = [start]
+        while pending:
+            node = pending.pop()
+            for offsets, targets in ((self.duplicate_offsets, self.duplicate_targets),
+                                     (self.original_offsets, self.original_targets)):
+                for neighbor in self._row(offsets, targets, node):
+                    if neighbor not in cluster:
+                        cluster.add(neighbor)
+                        pending.append(neighbor)
+        return self._post_ids(sorted(cluster))
+
+    def _tag_nodes(self, tag_id):
+        position = bisect.bisect_left(self.tag_ids, tag_id)
+        if position >= len(self.tag_ids) or self.tag_ids[position] != tag_id:
+            return self.tag_targets[0:0]
+        return self._row(self.tag_offsets, self.tag_targets, position)
+
+    def canonical_questions(self, tag_id, limit=10):
+        '''
+        The canonical questions that the questions with a tag collapse into when
+        duplicates are merged, with the number of the tag's questions in each cluster.
+        '''
+        counts = Counter(
+            self.canonical[node] for node in self._tag_nodes(tag_id)
+            if self.canonical[node] != NO_NODE)
+        return [(self.post_ids[node], count) for node, count in counts.most_common(limit)]
+
+    def tag_link_centrality(self, tag_id, limit=10):
+        '''
+        The questions with a tag that are linked to the most other questions with the tag,
+        through related or duplicate links in either direction, with their link counts.
+        '''
+        nodes = self._tag_nodes(tag_id)
+        members = set(nodes)
+        degrees = []
+        for node in nodes:
+            degree = 0
+            for offsets, targets in ((self.link_offsets, self.link_targets),
+                                     (self.duplicate_offsets, self.duplicate_targets),
+                                     (self.original_offsets, self.original_targets)):
+                for neighbor in self._row(offsets, targets, node):
+                    if neighbor in members:
+                        degree += 1
+            if degree:
+                degrees.append((degree, -node))
+        return [(self.post_ids[-negative_node], degree)
+                for degree, negative_node in heapq.nlargest(limit, degrees)]
+
+
+# The graph loaded by this process from each file
+_graphs = {}
+
+
+def load_graph(filename=GRAPH_FILENAME):
+    '''
+    Get the graph saved in a file.  It's loaded once by each process, and loaded again
+    when the file is rebuilt.  Raises OSError if the file doesn't exist.
+    '''
+    graph = _graphs.get(filename)
+    if graph is None or os.stat(filename).st_mtime != graph.modified:
+        graph = PostGraph(filename)
+        _graphs[filename] = graph
+    return graph
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the index of the graph of Stack Overflow posts")
+    parser.add_argument('--db', default='sqlite', choices=['sqlite', 'postgres'])
+    parser.add_argument('--db-config', help="Postgres credentials file")
+    parser.add_argument('--output', default=GRAPH_FILENAME, help="File to save the index to")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+    init_database(args.db, args.db_config)
+    build_graph(args.output)
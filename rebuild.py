@@ -0,0 +1,290 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Rebuild the database from the Stack Exchange data dump, in phases:
+
+1. tables: create the tables for all models, without their indexes or foreign keys.
+2. load: import the dump's files in parallel.  Large files are split into shards
+   that are imported by separate processes.
+3. indexes: build all indexes (those declared by the models, those added by
+   migrations, and the full-text index), several at a time on Postgres.  Then add
+   the foreign keys, and record all migrations as applied.
+4. analyze: update the planner's statistics for the new data.
+
+Building an index once over a full table is much faster than updating it for every
+row that's loaded.  The time each phase takes is reported at the end.  Phases can be
+run on their own (e.g., to build the indexes again after a failed build):
+
+    python rebuild.py stackoverflow-dump/ --db postgres --db-config postgres-credentials.json \\
+        --processes 8 --index-workers 4 --report rebuild-report.json
+'''
+
+from __future__ import unicode_literals, print_function
+import logging
+import argparse
+import json
+import math
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+
+from peewee import Field, ForeignKeyField
+from models import init_database, open_connection, close_connection, db_proxy, using_postgres, \
+    create_table_without_indexes, MODELS, SchemaMigration
+from importer import DUMP_FILES, DEFAULT_BATCH_SIZE, import_table
+from migrations import MIGRATIONS, Index, create_index
+from partitions import PARTITIONED_MODELS, create_partitioned_table, is_partitioned
+from search import create_search_index
+
+
+logger = logging.getLogger('data')
+
+PHASES = ['tables', 'load', 'indexes', 'analyze']
+# Dump files are split into shards of about this many bytes.
+DEFAULT_SHARD_SIZE = 2 * 1024 ** 3
+DEFAULT_INDEX_WORKERS = 4
+
+
+def create_tables(partitioned=False):
+    ''' Create the tables for all models (see `models.create_tables`), without indexes. '''
+    for model in MODELS:
+        if partitioned and using_postgres() and model in PARTITIONED_MODELS:
+            # These tables are filled by fetches, rather than from the dump, so they're
+            # created with their indexes.
+            create_partitioned_table(model)
+        else:
+            create_table_without_indexes(model)
+
+
+def load_tasks(dump_dir, tables, shard_size):
+    '''
+    Split the import of each table into shards of about `shard_size` bytes.
+    Returns (table, shard) pairs, largest shards first, so that the longest imports
+    start first and the processes finish at about the same time.
+    '''
+    tasks = []
+    for table in tables:
+        size = os.path.getsize(os.path.join(dump_dir, table + '.xml'))
+        shard_count = max(1, int(math.ceil(size / float(shard_size))))
+        if shard_count == 1:
+            # Files that aren't split are read with the XML parser, like `importer.py` does.
+            tasks.append((size, table, None))
+            continue
+        for index in range(shard_count):
+            tasks.append((size / shard_count, table, (index, shard_count)))
+    tasks.sort(key=lambda task: task[0], reverse=True)
+    return [(table, shard) for _, table, shard in tasks]
+
+
+def _init_load_worker(db_type, db_config):
+    ''' Connect a worker process to the database, once when it starts. '''
+    init_database(db_type, db_config)
+
+
+def _load_shard(arguments):
+    ''' Import a shard of a table, in this process or in a worker process. '''
+    table, shard, dump_dir, batch_size, resume = arguments
+    start = time.time()
+    row_count = import_table(table, dump_dir, batch_size, resume, shard)
+    return table, row_count, time.time() - start
+
+
+def load(dump_dir, tables, db_type, db_config, processes, batch_size=DEFAULT_BATCH_SIZE,
+         resume=False, shard_size=DEFAULT_SHARD_SIZE):
+    '''
+    Import the dump's files, with `processes` shards imported at a time.  Sqlite only
+    allows one writer, so there, files are imported one at a time without shards.
+    Returns the number of rows and the seconds of import time for each table.
+    '''
+    if not using_postgres():
+        processes = 1
+        shard_size = float('inf')
+
+    arguments = [
+        (table, shard, dump_dir, batch_size, resume)
+        for table, shard in load_tasks(dump_dir, tables, shard_size)]
+    results = OrderedDict((table, {'rows': 0, 'seconds': 0.0}) for table in tables)
+
+    def record(result):
+        table, row_count, seconds = result
+        results[table]['rows'] += row_count
+        results[table]['seconds'] += seconds
+
+    if processes > 1:
+        # Connections can't be shared with child processes, so each worker opens its own.
+        close_connection()
+        pool = Pool(processes, initializer=_init_load_worker, initargs=(db_type, db_config))
+        try:
+            for result in pool.imap_unordered(_load_shard, arguments):
+                record(result)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task_arguments in arguments:
+            record(_load_shard(task_arguments))
+    return results
+
+
+def deferred_indexes():
+    '''
+    Get the indexes to build after loading: the indexes that peewee would have created
+    with each table (for indexed, unique, and foreign key fields, and the model's
+    declared indexes), and the indexes that migrations add.
+    '''
+    compiler = db_proxy.compiler()
+    indexes = OrderedDict()
+    for model in MODELS:
+        # Partitioned tables are created with their indexes.
+        if is_partitioned(model):
+            continue
+        for fields, unique in model._index_data():
+            # Declared indexes name their fields, and indexed fields are given as fields.
+            columns = [
+                (field if isinstance(field, Field) else model._meta.fields[field]).db_column
+                for field in fields]
+            name = compiler.index_name(model._meta.db_table, columns)
+            indexes[name] = Index(name, model, columns, None, unique)
+    for migration in MIGRATIONS:
+        for index in migration.indexes:
+            indexes.setdefault(index.name, index)
+    return list(indexes.values())
+
+
+def _timed(name, function, *args):
+    ''' Run a function from a worker thread, with a connection of the thread's own. '''
+    open_connection()
+    try:
+        start = time.time()
+        function(*args)
+        return name, time.time() - start
+    finally:
+        close_connection()
+
+
+def build_indexes(workers=DEFAULT_INDEX_WORKERS):
+    '''
+    Build the deferred indexes and the full-text index, `workers` at a time on Postgres
+    (one at a time on Sqlite), and then add the foreign keys on Postgres.  Sqlite can't
+    add foreign keys to existing tables, but it doesn't enforce them by default either.
+    Records all migrations as applied, as their indexes have been built.
+    Returns the seconds each index took to build.
+    '''
+    tasks = [(index.name, create_index, index, False) for index in deferred_indexes()]
+    tasks.append(('full-text search', create_search_index))
+    if not using_postgres():
+        workers = 1
+
+    timings = OrderedDict()
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_timed, *task) for task in tasks]
+            for future in futures:
+                name, seconds = future.result()
+                timings[name] = seconds
+    else:
+        for task in tasks:
+            start = time.time()
+            task[1](*task[2:])
+            timings[task[0]] = time.time() - start
+
+    if using_postgres():
+        start = time.time()
+        for model in MODELS:
+            for field in model._meta.sorted_fields:
+                if isinstance(field, ForeignKeyField) and not _has_constraint(model, field):
+                    db_proxy.create_foreign_key(model, field)
+        timings['foreign keys'] = time.time() - start
+
+    db_proxy.create_tables([SchemaMigration], safe=True)
+    applied = set(version for version, in SchemaMigration.select(SchemaMigration.version).tuples())
+    for migration in MIGRATIONS:
+        if migration.version not in applied:
+            SchemaMigration.create(version=migration.version, name=migration.name)
+    return timings
+
+
+def _has_constraint(model, field):
+    ''' Check whether a Postgres table already has a foreign key for a field. '''
+    return any(
+        foreign_key.column == field.db_column
+        for foreign_key in db_proxy.get_foreign_keys(model._meta.db_table))
+
+
+def analyze():
+    db_proxy.execute_sql('ANALYZE')
+
+
+def rebuild(dump_dir, db_type='sqlite', db_config=None, phases=PHASES, tables=None,
+            processes=1, index_workers=DEFAULT_INDEX_WORKERS, batch_size=DEFAULT_BATCH_SIZE,
+            resume=False, shard_size=DEFAULT_SHARD_SIZE, partitioned=False):
+    '''
+    Run the phases of a rebuild, in order.  Returns a report of the seconds each phase
+    took, with the rows and import time of each table and the build time of each index.
+    '''
+    init_database(db_type, db_config)
+    tables = tables or list(DUMP_FILES.keys())
+    report = OrderedDict([('phases', OrderedDict())])
+    for phase in PHASES:
+        if phase not in phases:
+            continue
+        logger.info("Starting phase: %s", phase)
+        start = time.time()
+        if phase == 'tables':
+            create_tables(partitioned)
+        elif phase == 'load':
+            report['tables'] = load(
+                dump_dir, tables, db_type, db_config, processes, batch_size, resume, shard_size)
+        elif phase == 'indexes':
+            report['indexes'] = build_indexes(index_workers)
+        elif phase == 'analyze':
+            analyze()
+        report['phases'][phase] = time.time() - start
+        logger.info("Finished phase %s in %.1f s", phase, report['phases'][phase])
+    return report
+
+
+def print_report(report):
+    for phase, seconds in report['phases'].items():
+        print("{phase:<10} {seconds:10.1f} s".format(phase=phase, seconds=seconds))
+    for table, result in report.get('tables', {}).items():
+        print("  {table:<20} {rows:12d} rows {seconds:10.1f} s".format(table=table, **result))
+    slowest = sorted(report.get('indexes', {}).items(), key=lambda item: item[1], reverse=True)
+    for name, seconds in slowest[:10]:
+        print("  {name:<40} {seconds:10.1f} s".format(name=name, seconds=seconds))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rebuild the database from the Stack Exchange data dump")
+    parser.add_argument('dump_dir', help="Directory containing the dump's XML files")
+    parser.add_argument('--db', default='sqlite', choices=['sqlite', 'postgres'])
+    parser.add_argument('--db-config', help="Postgres credentials file")
+    parser.add_argument('--phases', nargs='+', choices=PHASES, default=PHASES,
+                        help="Phases to run (default: all)")
+    parser.add_argument('--tables', nargs='+', choices=list(DUMP_FILES.keys()),
+                        help="Tables to load (default: all)")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="Number of shards to load in parallel (Postgres only)")
+    parser.add_argument('--index-workers', type=int, default=DEFAULT_INDEX_WORKERS,
+                        help="Number of indexes to build in parallel (Postgres only)")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--shard-size', type=int, default=DEFAULT_SHARD_SIZE,
+                        help="Approximate size in bytes of the shards that dump files are split into")
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue an interrupted load after the last rows that were saved")
+    parser.add_argument('--partitioned', action='store_true',
+                        help="Create the tables for periodic fetches as partitioned tables")
+    parser.add_argument('--report', help="File to write the timings to, as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+    report = rebuild(
+        args.dump_dir, args.db, args.db_config, args.phases, args.tables, args.processes,
+        args.index_workers, args.batch_size, args.resume, args.shard_size, args.partitioned)
+    print_report(report)
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
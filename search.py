@@ -0,0 +1,210 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import base64
+import binascii
+import json
+from collections import namedtuple
+
+from models import db_proxy, using_postgres, read_replica, Post
+from pagination import InvalidCursor, MAX_PAGE_SIZE
+
+
+logger = logging.getLogger('data')
+
+# On Postgres, this is the name of a GIN index over the text of posts.
+# On Sqlite, it's the name of an FTS5 table that mirrors the text of posts.
+SEARCH_INDEX_NAME = 'post_search'
+TEXT_SEARCH_CONFIG = 'english'
+DEFAULT_PAGE_SIZE = 10
+
+# On Postgres, the document that gets indexed for each post is stored in this column,
+# so that it isn't parsed again to rank the posts that match a search.
+SEARCH_DOCUMENT_COLUMN = 'search_document'
+POSTGRES_DOCUMENT = (
+    "to_tsvector('{config}', coalesce(title, '') || ' ' || coalesce(body, ''))"
+).format(config=TEXT_SEARCH_CONFIG)
+
+# The fields of the posts in search results, which are listed without their bodies
+RESULT_FIELDS = ['id', 'title', 'score', 'answer_count', 'comment_count', 'creation_date']
+SearchResult = namedtuple('SearchResult', RESULT_FIELDS + ['rank'])
+
+
+def _table():
+    return db_proxy.quote_char + Post._meta.db_table + db_proxy.quote_char
+
+
+def _create_postgres_search_index():
+    '''
+    Add the column with each post's search document, which a trigger keeps up to date,
+    and index it.  Databases that searched an index over the document's expression
+    before the column was added have that index replaced.
+    '''
+    columns = [column.name for column in db_proxy.get_columns(Post._meta.db_table)]
+    if SEARCH_DOCUMENT_COLUMN not in columns:
+        db_proxy.execute_sql("ALTER TABLE {table} ADD COLUMN {column} tsvector".format(
+            table=_table(), column=SEARCH_DOCUMENT_COLUMN))
+        db_proxy.execute_sql(
+            "CREATE TRIGGER {index}_update BEFORE INSERT OR UPDATE OF title, body ON {table} "
+            "FOR EACH ROW EXECUTE PROCEDURE "
+            "tsvector_update_trigger({column}, 'pg_catalog.{config}', title, body)".format(
+                index=SEARCH_INDEX_NAME, table=_table(), column=SEARCH_DOCUMENT_COLUMN,
+                config=TEXT_SEARCH_CONFIG))
+        db_proxy.execute_sql("DROP INDEX IF EXISTS {index}".format(index=SEARCH_INDEX_NAME))
+        rebuild_search_index()
+    db_proxy.execute_sql(
+        "CREATE INDEX IF NOT EXISTS {index} ON {table} USING GIN ({column})".format(
+            index=SEARCH_INDEX_NAME, table=_table(), column=SEARCH_DOCUMENT_COLUMN))
+
+
+def create_search_index():
+    '''
+    Create the full-text index for Stack Overflow posts, if it doesn't exist yet.
+
+    On Postgres, this is a GIN index over a column with each post's search document,
+    which a trigger fills in as rows are inserted.  On Sqlite, it's an external-content
+    FTS5 table that is kept in sync with the post table through triggers.
+    '''
+    if using_postgres():
+        _create_postgres_search_index()
+        return
+
+    index_existed = SEARCH_INDEX_NAME in db_proxy.get_tables()
+    db_proxy.execute_sql(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {index} USING fts5("
+        "title, body, content='{table}', content_rowid='id')".format(
+            index=SEARCH_INDEX_NAME, table=Post._meta.db_table))
+
+    # FTS5 expects a special 'delete' command with the old values of a row to
+    # remove it from an external-content index.
+    add_row = (
+        "INSERT INTO {index}(rowid, title, body) VALUES (new.id, new.title, new.body);")
+    remove_row = (
+        "INSERT INTO {index}({index}, rowid, title, body) "
+        "VALUES ('delete', old.id, old.title, old.body);")
+    triggers = {
+        'insert': ('AFTER INSERT', add_row),
+        'delete': ('AFTER DELETE', remove_row),
+        'update': ('AFTER UPDATE', remove_row + ' ' + add_row),
+    }
+    for suffix, (event, body) in triggers.items():
+        db_proxy.execute_sql(
+            "CREATE TRIGGER IF NOT EXISTS {index}_{suffix} {event} ON {table} "
+            "BEGIN {body} END".format(
+                index=SEARCH_INDEX_NAME, suffix=suffix, event=event, table=_table(),
+                body=body.format(index=SEARCH_INDEX_NAME)))
+
+    # Posts that were saved before the index existed have to be indexed all at once.
+    if not index_existed:
+        rebuild_search_index()
+
+
+def rebuild_search_index():
+    '''
+    Re-index all posts.  This is needed if posts were saved before the triggers that
+    index them were created: on Postgres, each post's search document is computed
+    again, and on Sqlite, the FTS5 table is rebuilt.
+    '''
+    if using_postgres():
+        db_proxy.execute_sql("UPDATE {table} SET {column} = {document}".format(
+            table=_table(), column=SEARCH_DOCUMENT_COLUMN, document=POSTGRES_DOCUMENT))
+    else:
+        db_proxy.execute_sql(
+            "INSERT INTO {index}({index}) VALUES ('rebuild')".format(index=SEARCH_INDEX_NAME))
+
+
+def _fts5_query(text):
+    '''
+    Convert free text into an FTS5 query that matches posts containing all of the words.
+    Each word is quoted so that characters like '+' and '-' (e.g., in 'c++') are not
+    interpreted as FTS5 query syntax.
+    '''
+    terms = ['"' + term.replace('"', '""') + '"' for term in text.split()]
+    return ' '.join(terms)
+
+
+def encode_cursor(rank, post_id):
+    '''
+    Make an opaque continuation token that points just past a search result.
+    The rank is saved as text, so that it's compared with the exact value it had.
+    '''
+    payload = json.dumps([str(rank), post_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    ''' Get the rank (as text) and ID of the search result a continuation token points past. '''
+    try:
+        padding = '=' * (-len(token) % 4)
+        rank, post_id = json.loads(
+            base64.urlsafe_b64decode((token + padding).encode('ascii')).decode('utf-8'))
+        float(rank)
+        return rank, int(post_id)
+    except (binascii.Error, UnicodeError, ValueError, TypeError):
+        raise InvalidCursor("Malformed continuation token")
+
+
+def search_posts(text, cursor=None, per_page=DEFAULT_PAGE_SIZE):
+    '''
+    Find the Stack Overflow posts whose title or body match a search query, with the
+    most relevant posts first.  Each result has a 'rank', where higher ranks mean more
+    relevant posts.  Posts are returned without their bodies, as named tuples.
+
+    Like `pagination.keyset_page`, a page starts right after the result that the
+    `cursor` points to, rather than skipping the results before it with OFFSET.
+    Returns the results on the page, and a cursor for the next page (None if this is
+    the last page).
+    '''
+    if not text.split():
+        return [], None
+    per_page = max(1, min(per_page, MAX_PAGE_SIZE))
+
+    param = db_proxy.interpolation
+    columns = ', '.join('{table}.{column}'.format(table=_table(), column=column)
+                        for column in RESULT_FIELDS)
+    if using_postgres():
+        # Ranks are rounded, so that they compare equal to the ranks in cursors.
+        matches = (
+            "SELECT {columns}, round(ts_rank({table}.{document}, query)::numeric, 6) AS rank "
+            "FROM {table}, plainto_tsquery('{config}', {param}) query "
+            "WHERE {table}.{document} @@ query"
+        ).format(
+            columns=columns, table=_table(), document=SEARCH_DOCUMENT_COLUMN,
+            config=TEXT_SEARCH_CONFIG, param=param)
+        params = [text]
+        rank_param = 'CAST({param} AS numeric)'.format(param=param)
+    else:
+        # FTS5 ranks results with BM25, where lower scores are better matches.
+        matches = (
+            "SELECT {columns}, -{index}.rank AS rank "
+            "FROM {index} JOIN {table} ON {table}.id = {index}.rowid "
+            "WHERE {index} MATCH {param}"
+        ).format(columns=columns, table=_table(), index=SEARCH_INDEX_NAME, param=param)
+        params = [_fts5_query(text)]
+        rank_param = param
+
+    sql = "SELECT * FROM ({matches}) matches".format(matches=matches)
+    if cursor is not None:
+        rank, post_id = decode_cursor(cursor)
+        rank = rank if using_postgres() else float(rank)
+        sql += " WHERE rank < {rank} OR (rank = {rank} AND id < {param})".format(
+            rank=rank_param, param=param)
+        params += [rank, rank, post_id]
+    sql += " ORDER BY rank DESC, id DESC LIMIT {param}".format(param=param)
+    params.append(per_page + 1)
+
+    # Like the models' queries, searches read from a replica if there is one.
+    database = read_replica()
+    if database is None:
+        database = db_proxy
+    rows = database.execute_sql(sql, params).fetchall()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(rows[-1][-1], rows[-1][0])
+    return [
+        SearchResult(*(Post._meta.fields[field].python_value(value)
+                       for field, value in zip(RESULT_FIELDS, row[:-1])), rank=float(row[-1]))
+        for row in rows], next_cursor
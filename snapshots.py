@@ -0,0 +1,457 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Compact storage of question snapshots, and time series of their counters.
+
+Most of a question doesn't change between two polls of the Stack Overflow API: the
+title and body stay the same, and only a few counters (e.g., views) go up.  So instead
+of a full QuestionSnapshot for every poll, `SnapshotWriter` saves a full snapshot (a
+keyframe) only for the first poll of a question, when its title, body, owner, or tags
+change, and after every `KEYFRAME_INTERVAL` deltas.  Other polls are saved as a
+QuestionSnapshotDelta: the counters that changed since the previous poll, and by how
+much, packed into a small array.  Polls where nothing changed aren't saved at all.
+
+Time series are rebuilt from the counter columns of the keyframes and the deltas,
+without reading titles and bodies, into arrays (see `SnapshotSeries`).  Snapshots saved
+before deltas were used can be converted with `compact_snapshots`:
+
+    python snapshots.py --db postgres --db-config postgres-credentials.json --compact
+'''
+
+from __future__ import unicode_literals
+import logging
+import argparse
+import bisect
+import datetime
+from array import array
+from collections import OrderedDict, defaultdict
+
+from peewee import fn
+from models import init_database, db_proxy, BatchInserter, \
+    QuestionSnapshot, QuestionSnapshotTag, QuestionSnapshotDelta
+from partitions import PartitionedBatchInserter, ensure_partitions
+from content_store import content_digest
+
+
+logger = logging.getLogger('data')
+
+# The counters that deltas record, in the order of their positions in a delta.
+# 'is_answered' is stored as 0 or 1 and 'last_activity_date' as seconds since the epoch.
+COUNTER_FIELDS = [
+    'comment_count',
+    'delete_vote_count',
+    'reopen_vote_count',
+    'close_vote_count',
+    'is_answered',
+    'view_count',
+    'favorite_count',
+    'down_vote_count',
+    'up_vote_count',
+    'answer_count',
+    'score',
+    'last_activity_date',
+]
+SERIES_FIELDS = ['view_count', 'score', 'answer_count']
+KEYFRAME_INTERVAL = 32
+DEFAULT_BATCH_SIZE = 1000
+# The number of questions whose series are read at a time
+QUESTION_BATCH_SIZE = 500
+# Array type code for signed 64-bit integers
+INTEGER_TYPE = 'q'
+
+EPOCH = datetime.datetime(1970, 1, 1)
+COUNTER_COLUMNS = [getattr(QuestionSnapshot, name) for name in COUNTER_FIELDS]
+
+
+def _timestamp(date):
+    return (date - EPOCH).total_seconds()
+
+
+def counter_values(snapshot):
+    ''' Get the values of a snapshot's counters (a dictionary of fields), as integers. '''
+    values = []
+    for name in COUNTER_FIELDS:
+        value = snapshot[name]
+        if name == 'last_activity_date':
+            value = int(_timestamp(value))
+        values.append(int(value))
+    return values
+
+
+def encode_delta(previous, current):
+    '''
+    Pack the differences between two lists of counter values into bytes.  Only the
+    counters that changed are included, as (position, difference) pairs.
+    Returns None if no counter changed.
+    '''
+    changes = array(INTEGER_TYPE)
+    for position, (old, new) in enumerate(zip(previous, current)):
+        if old != new:
+            changes.append(position)
+            changes.append(new - old)
+    return changes.tobytes() if changes else None
+
+
+def apply_delta(values, delta):
+    ''' Apply a packed delta to a list of counter values, in place. '''
+    changes = array(INTEGER_TYPE)
+    changes.frombytes(bytes(delta))
+    for index in range(0, len(changes), 2):
+        values[changes[index]] += changes[index + 1]
+
+
+def _fingerprint(owner_id, title, body, tag_ids):
+    ''' Identify the parts of a question that can't be stored as deltas. '''
+    return (owner_id, content_digest(title + '\n' + body), tuple(sorted(tag_ids)))
+
+
+class SnapshotWriter(object):
+    '''
+    Saves polls of questions as keyframes or deltas.  Pass each poll to `save`, and
+    call `flush` when finished.  The writer remembers the last state of each question
+    it has seen, so the state of a question is only read from the database once.
+    '''
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, keyframe_interval=KEYFRAME_INTERVAL):
+        self.batch_size = batch_size
+        self.keyframe_interval = keyframe_interval
+        self.pending = []
+        # For each question: its counter values, fingerprint, and deltas since its last keyframe
+        self.states = {}
+        self.delta_inserter = PartitionedBatchInserter(QuestionSnapshotDelta, batch_size)
+        self.tag_inserter = BatchInserter(QuestionSnapshotTag, batch_size)
+
+    def save(self, snapshot, tag_ids):
+        '''
+        Save a poll of a question.  `snapshot` is a dictionary with the fields of a
+        QuestionSnapshot, and `tag_ids` are the IDs of the question's tags.
+        '''
+        self.pending.append((snapshot, tag_ids))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        unknown_ids = set(
+            snapshot['question_id'] for snapshot, _ in self.pending
+            if snapshot['question_id'] not in self.states)
+        self.states.update(latest_states(unknown_ids))
+
+        date = datetime.datetime.now()
+        with db_proxy.atomic():
+            for snapshot, tag_ids in self.pending:
+                snapshot = dict(snapshot)
+                snapshot.setdefault('date', date)
+                self._save_one(snapshot, tag_ids)
+            self.delta_inserter.flush()
+            self.tag_inserter.flush()
+        self.pending = []
+
+    def _save_one(self, snapshot, tag_ids):
+        question_id = snapshot['question_id']
+        values = counter_values(snapshot)
+        fingerprint = _fingerprint(snapshot.get('owner_id'), snapshot['title'], snapshot['body'], tag_ids)
+        state = self.states.get(question_id)
+
+        if state is None or state[1] != fingerprint or state[2] >= self.keyframe_interval:
+            ensure_partitions(QuestionSnapshot, [snapshot['date']])
+            snapshot_id = QuestionSnapshot.insert(**snapshot).execute()
+            for tag_id in tag_ids:
+                self.tag_inserter.insert({'question_snapshot_id': snapshot_id, 'tag_id': tag_id})
+            self.states[question_id] = (values, fingerprint, 0)
+            return
+
+        delta = encode_delta(state[0], values)
+        if delta is None:
+            return
+        self.delta_inserter.insert({
+            'fetch_index': snapshot['fetch_index'],
+            'date': snapshot['date'],
+            'question_id': question_id,
+            'changes': delta,
+        })
+        self.states[question_id] = (values, fingerprint, state[2] + 1)
+
+
+def latest_states(question_ids):
+    '''
+    Get the latest state of each question: its counter values, the fingerprint of its
+    latest keyframe, and the number of deltas since that keyframe.
+    '''
+    question_ids = list(question_ids)
+    if not question_ids:
+        return {}
+    keyframe_ids = (
+        QuestionSnapshot.select(fn.Max(QuestionSnapshot.id))
+        .where(QuestionSnapshot.question_id << question_ids)
+        .group_by(QuestionSnapshot.question_id)
+    )
+    keyframes = list(
+        QuestionSnapshot.select(
+            QuestionSnapshot.id, QuestionSnapshot.question_id, QuestionSnapshot.date,
+            QuestionSnapshot.owner_id, QuestionSnapshot.title, QuestionSnapshot.body,
+            *COUNTER_COLUMNS)
+        .where(QuestionSnapshot.id << keyframe_ids)
+        .dicts()
+    )
+    if not keyframes:
+        return {}
+    tag_ids = defaultdict(list)
+    for snapshot_id, tag_id in (
+            QuestionSnapshotTag.select(QuestionSnapshotTag.question_snapshot_id, QuestionSnapshotTag.tag_id)
+            .where(QuestionSnapshotTag.question_snapshot_id << [row['id'] for row in keyframes])
+            .tuples()):
+        tag_ids[snapshot_id].append(tag_id)
+
+    states = {}
+    keyframe_dates = {}
+    for row in keyframes:
+        fingerprint = _fingerprint(row['owner_id'], row['title'], row['body'], tag_ids[row['id']])
+        states[row['question_id']] = [counter_values(row), fingerprint, 0]
+        keyframe_dates[row['question_id']] = row['date']
+
+    deltas = (
+        QuestionSnapshotDelta.select(
+            QuestionSnapshotDelta.question_id, QuestionSnapshotDelta.date, QuestionSnapshotDelta.changes)
+        .where(
+            (QuestionSnapshotDelta.question_id << list(states.keys())) &
+            (QuestionSnapshotDelta.date > min(keyframe_dates.values())))
+        .order_by(QuestionSnapshotDelta.date, QuestionSnapshotDelta.id)
+        .tuples()
+    )
+    for question_id, date, changes in deltas.iterator():
+        if date > keyframe_dates[question_id]:
+            state = states[question_id]
+            apply_delta(state[0], changes)
+            state[2] += 1
+    return {question_id: tuple(state) for question_id, state in states.items()}
+
+
+class SnapshotSeries(object):
+    '''
+    The counters of a question at each poll that changed them, as arrays: `timestamps`
+    (seconds since the epoch) and one array of values for each counter in `columns`.
+    A counter's value at any time is its value at the latest poll before then.
+    '''
+    def __init__(self, question_id):
+        self.question_id = question_id
+        self.timestamps = array('d')
+        self.columns = OrderedDict((name, array(INTEGER_TYPE)) for name in COUNTER_FIELDS)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def append(self, date, values):
+        self.timestamps.append(_timestamp(date))
+        for column, value in zip(self.columns.values(), values):
+            column.append(value)
+
+    def _position(self, date):
+        ''' The position of the latest poll at or before a date (-1 if there is none). '''
+        return bisect.bisect_right(self.timestamps, _timestamp(date)) - 1
+
+    def value_at(self, field, date):
+        position = self._position(date)
+        return self.columns[field][position] if position >= 0 else None
+
+    def growth(self, field, start=None, end=None):
+        '''
+        How much a counter grew between two dates.  If the question wasn't polled
+        before `start`, its growth is counted from its first poll.
+        '''
+        if not self.timestamps:
+            return 0
+        end_position = self._position(end) if end is not None else len(self.timestamps) - 1
+        if end_position < 0:
+            return 0
+        start_position = max(self._position(start), 0) if start is not None else 0
+        column = self.columns[field]
+        return column[end_position] - column[min(start_position, end_position)]
+
+
+def read_series(question_ids, start=None, end=None):
+    '''
+    Rebuild the series of a group of questions, for polls up to `end`.  Polls before
+    `start` are only read back to the keyframe that the series for `start` begins at.
+    Returns a dictionary from question ID to its SnapshotSeries.
+    '''
+    question_ids = list(question_ids)
+    series = {question_id: SnapshotSeries(question_id) for question_id in question_ids}
+    if not question_ids:
+        return series
+
+    # The earliest date any of the questions' series needs data from: the latest keyframe
+    # before `start` of each question.  Questions without one were first polled after `start`.
+    lower_bound = None
+    if start is not None:
+        anchors = dict(
+            QuestionSnapshot.select(QuestionSnapshot.question_id, fn.Max(QuestionSnapshot.date))
+            .where((QuestionSnapshot.question_id << question_ids) & (QuestionSnapshot.date <= start))
+            .group_by(QuestionSnapshot.question_id)
+            .tuples()
+        )
+        lower_bound = min(anchors.values()) if anchors else start
+
+    def limit(query, model):
+        condition = model.question_id << question_ids
+        if lower_bound is not None:
+            condition &= model.date >= lower_bound
+        if end is not None:
+            condition &= model.date <= end
+        return query.where(condition).order_by(model.date, model.id).tuples()
+
+    # Keyframes and deltas are merged in order of date.  Keyframes come first when
+    # dates are equal, as a delta is always saved after the keyframe it builds on.
+    events = []
+    for row in limit(QuestionSnapshot.select(
+            QuestionSnapshot.question_id, QuestionSnapshot.date, *COUNTER_COLUMNS), QuestionSnapshot):
+        events.append((row[1], 0, row[0], row[2:]))
+    for row in limit(QuestionSnapshotDelta.select(
+            QuestionSnapshotDelta.question_id, QuestionSnapshotDelta.date, QuestionSnapshotDelta.changes),
+            QuestionSnapshotDelta):
+        events.append((row[1], 1, row[0], row[2]))
+    events.sort(key=lambda event: event[:2])
+
+    values = {}
+    for date, is_delta, question_id, data in events:
+        if not is_delta:
+            values[question_id] = counter_values(dict(zip(COUNTER_FIELDS, data)))
+        elif question_id in values:
+            apply_delta(values[question_id], data)
+        else:
+            # A delta whose keyframe is before the range that was read
+            continue
+        series[question_id].append(date, values[question_id])
+    return series
+
+
+def question_series(question_id, start=None, end=None):
+    return read_series([question_id], start, end)[question_id]
+
+
+def question_growth(question_id, start=None, end=None, fields=SERIES_FIELDS):
+    ''' How much a question's views, score, and answers grew between two dates. '''
+    series = question_series(question_id, start, end)
+    return OrderedDict((field, series.growth(field, start, end)) for field in fields)
+
+
+def tag_question_ids(tag_id):
+    ''' Get the IDs of the questions that had a tag in any of their snapshots. '''
+    return [question_id for question_id, in (
+        QuestionSnapshot.select(QuestionSnapshot.question_id)
+        .join(QuestionSnapshotTag, on=(QuestionSnapshotTag.question_snapshot_id == QuestionSnapshot.id))
+        .where(QuestionSnapshotTag.tag_id == tag_id)
+        .distinct()
+        .tuples())]
+
+
+def tag_growth(tag_id, start=None, end=None, fields=SERIES_FIELDS):
+    '''
+    How much the views, score, and answers of all questions with a tag grew between two
+    dates.  The questions are read in batches, so memory use doesn't grow with the tag.
+    '''
+    question_ids = tag_question_ids(tag_id)
+    totals = OrderedDict((field, 0) for field in fields)
+    totals['questions'] = 0
+    for batch_start in range(0, len(question_ids), QUESTION_BATCH_SIZE):
+        batch = question_ids[batch_start:batch_start + QUESTION_BATCH_SIZE]
+        for series in read_series(batch, start, end).values():
+            if not len(series):
+                continue
+            totals['questions'] += 1
+            for field in fields:
+                totals[field] += series.growth(field, start, end)
+    return totals
+
+
+def compact_snapshots(batch_size=DEFAULT_BATCH_SIZE, keyframe_interval=KEYFRAME_INTERVAL):
+    '''
+    Convert the full snapshots saved before deltas were used into keyframes and deltas.
+    Questions that already have deltas are skipped, so this can be run again to convert
+    questions that were added since.  Each batch of questions is converted in one
+    transaction.  Returns the number of snapshots that were replaced by deltas.
+    '''
+    compacted_ids = QuestionSnapshotDelta.select(QuestionSnapshotDelta.question_id).distinct()
+    last_question_id = -1
+    replaced_count = 0
+    while True:
+        question_ids = [question_id for question_id, in (
+            QuestionSnapshot.select(QuestionSnapshot.question_id)
+            .where(
+                (QuestionSnapshot.question_id > last_question_id) &
+                ~(QuestionSnapshot.question_id << compacted_ids))
+            .group_by(QuestionSnapshot.question_id)
+            .order_by(QuestionSnapshot.question_id)
+            .limit(batch_size)
+            .tuples())]
+        if not question_ids:
+            break
+        last_question_id = question_ids[-1]
+
+        snapshots = list(
+            QuestionSnapshot.select(
+                QuestionSnapshot.id, QuestionSnapshot.fetch_index, QuestionSnapshot.date,
+                QuestionSnapshot.question_id, QuestionSnapshot.owner_id,
+                QuestionSnapshot.title, QuestionSnapshot.body, *COUNTER_COLUMNS)
+            .where(QuestionSnapshot.question_id << question_ids)
+            .order_by(QuestionSnapshot.question_id, QuestionSnapshot.date, QuestionSnapshot.id)
+            .dicts()
+        )
+        tag_ids = defaultdict(list)
+        for snapshot_id, tag_id in (
+                QuestionSnapshotTag.select(QuestionSnapshotTag.question_snapshot_id, QuestionSnapshotTag.tag_id)
+                .where(QuestionSnapshotTag.question_snapshot_id << [row['id'] for row in snapshots])
+                .tuples()):
+            tag_ids[snapshot_id].append(tag_id)
+
+        deltas = []
+        replaced_ids = []
+        state = None
+        for row in snapshots:
+            values = counter_values(row)
+            fingerprint = _fingerprint(row['owner_id'], row['title'], row['body'], tag_ids[row['id']])
+            if (state is None or state[0] != row['question_id'] or state[2] != fingerprint or
+                    state[3] >= keyframe_interval):
+                state = (row['question_id'], values, fingerprint, 0)
+                continue
+            delta = encode_delta(state[1], values)
+            if delta is not None:
+                deltas.append({
+                    'fetch_index': row['fetch_index'], 'date': row['date'],
+                    'question_id': row['question_id'], 'changes': delta})
+                state = (row['question_id'], values, fingerprint, state[3] + 1)
+            replaced_ids.append(row['id'])
+
+        # The deltas are only saved along with the deletion of the snapshots they replace,
+        # as a question with deltas is skipped by later runs.
+        with db_proxy.atomic():
+            delta_inserter = PartitionedBatchInserter(QuestionSnapshotDelta, batch_size)
+            for delta in deltas:
+                delta_inserter.insert(delta)
+            delta_inserter.flush()
+            for start in range(0, len(replaced_ids), batch_size):
+                ids = replaced_ids[start:start + batch_size]
+                QuestionSnapshotTag.delete().where(QuestionSnapshotTag.question_snapshot_id << ids).execute()
+                QuestionSnapshot.delete().where(QuestionSnapshot.id << ids).execute()
+        replaced_count += len(replaced_ids)
+        logger.info("Compacted questions up to %d (%d snapshots replaced)", last_question_id, replaced_count)
+    return replaced_count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compact question snapshots into keyframes and deltas")
+    parser.add_argument('--db', default='sqlite', choices=['sqlite', 'postgres'])
+    parser.add_argument('--db-config', help="Postgres credentials file")
+    parser.add_argument('--compact', action='store_true',
+                        help="Convert full snapshots saved before deltas were used")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="Number of questions converted at a time")
+    parser.add_argument('--keyframe-interval', type=int, default=KEYFRAME_INTERVAL)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+    init_database(args.db, args.db_config)
+    db_proxy.create_tables([QuestionSnapshotDelta], safe=True)
+    if args.compact:
+        compact_snapshots(args.batch_size, args.keyframe_interval)
@@ -0,0 +1,287 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Extract code snippets and 'npm install' commands from the bodies of Stack Overflow posts.
+
+Bodies are streamed from the database in order of post ID, and scanned in parallel
+by a pool of worker processes.  Each worker compiles the SnippetPatterns once.  The
+patterns that can be combined are also joined into one expression, which lets a worker
+skip a post with a single scan when none of them match it.  The snippets and packages
+found are saved in batches, tagged with a new compute index.
+
+    python snippets.py --db postgres --db-config postgres-credentials.json --processes 8
+    python snippets.py --db postgres --db-config postgres-credentials.json --resume
+'''
+
+from __future__ import unicode_literals
+import logging
+import argparse
+import datetime
+import re
+from collections import deque
+from multiprocessing import Pool, cpu_count
+
+from peewee import fn
+from models import init_database, db_proxy, using_postgres, BatchInserter, \
+    Post, SnippetPattern, PostSnippet, PostNpmInstallPackage
+
+
+logger = logging.getLogger('data')
+
+DEFAULT_BATCH_SIZE = 10000
+# The number of posts sent to a worker at a time
+DEFAULT_CHUNK_SIZE = 500
+LOG_INTERVAL = 100000
+
+# Patterns that use these can't be combined with other patterns into one expression:
+# backreferences would refer to the wrong groups, and global flags would apply to all patterns.
+UNCOMBINABLE_PATTERN = re.compile(r'\\[1-9]|\(\?P=|\(\?[aiLmsux]+\)')
+
+NPM_INSTALL_PATTERN = re.compile(r'\bnpm\s+(?:install|i|add)\b([^\n<&|;]*)')
+# A package name, possibly scoped (e.g., "@angular/core"), without a version (e.g., "@1.2.0")
+NPM_PACKAGE_PATTERN = re.compile(r'(?:@[a-z0-9][\w.-]*/)?[a-z0-9][\w.-]*', re.IGNORECASE)
+
+
+def npm_packages(body):
+    ''' Find the names of the packages installed by 'npm install' commands in a text. '''
+    packages = []
+    for match in NPM_INSTALL_PATTERN.finditer(body):
+        for argument in match.group(1).split():
+            # Skip options (e.g., "--save")
+            if argument.startswith('-'):
+                continue
+            package = NPM_PACKAGE_PATTERN.match(argument)
+            if package is not None and package.group(0).lower() not in packages:
+                packages.append(package.group(0).lower())
+    return packages
+
+
+class SnippetMatcher(object):
+    '''
+    Finds the snippets that each of a list of patterns matches in a text.  If a pattern
+    has groups, its first group is the snippet.  Otherwise, the whole match is.
+    '''
+    def __init__(self, patterns):
+        ''' `patterns` is a list of (pattern ID, regular expression) pairs. '''
+        self.patterns = []
+        combinable = []
+        for pattern_id, pattern in patterns:
+            try:
+                self.patterns.append((pattern_id, re.compile(pattern)))
+            except re.error:
+                logger.warning("Skipping invalid snippet pattern %d: %s", pattern_id, pattern)
+                continue
+            if not UNCOMBINABLE_PATTERN.search(pattern):
+                combinable.append((pattern_id, pattern))
+
+        # The patterns that have to be checked even if the combined expression doesn't match
+        self.prefilter = None
+        self.unfiltered_patterns = self.patterns
+        if combinable:
+            try:
+                self.prefilter = re.compile(
+                    '|'.join('(?:' + pattern + ')' for _, pattern in combinable))
+            except re.error:
+                logger.warning("Could not combine snippet patterns; each will be checked separately")
+            else:
+                combined_ids = set(pattern_id for pattern_id, _ in combinable)
+                self.unfiltered_patterns = [
+                    pattern for pattern in self.patterns if pattern[0] not in combined_ids]
+
+    def find(self, text):
+        ''' Find snippets in a text.  Returns a list of (pattern ID, snippet) pairs. '''
+        patterns = self.patterns
+        if self.prefilter is not None and self.prefilter.search(text) is None:
+            patterns = self.unfiltered_patterns
+
+        snippets = []
+        for pattern_id, regex in patterns:
+            for match in regex.finditer(text):
+                snippet = match.group(1) if regex.groups else match.group(0)
+                if snippet:
+                    snippets.append((pattern_id, snippet))
+        return snippets
+
+
+# The matcher for a worker process, which is created once when the worker starts
+_matcher = None
+
+
+def _init_worker(patterns):
+    global _matcher
+    _matcher = SnippetMatcher(patterns)
+
+
+def _scan_posts(posts):
+    '''
+    Scan a chunk of posts.  Returns the snippets as (post ID, pattern ID, snippet)
+    tuples, and the packages as (post ID, package) pairs.
+    '''
+    snippets = []
+    packages = []
+    for post_id, body in posts:
+        if not body:
+            continue
+        for pattern_id, snippet in _matcher.find(body):
+            snippets.append((post_id, pattern_id, snippet))
+        for package in npm_packages(body):
+            packages.append((post_id, package))
+    return snippets, packages
+
+
+def iterate_post_bodies(start_id=0, end_id=None, batch_size=DEFAULT_BATCH_SIZE):
+    '''
+    Yield the ID and body of each post with an ID greater than `start_id` and at most
+    `end_id`, in order of ID.  On Postgres, posts are streamed through a server-side
+    cursor, so they're never all held in memory.  The cursor is kept open across
+    commits, so rows can be saved while posts are being read.  On other databases,
+    posts are read in batches.
+    '''
+    end_condition = 'AND id <= %s' % int(end_id) if end_id is not None else ''
+    if using_postgres():
+        cursor = db_proxy.get_conn().cursor('post_bodies', withhold=True)
+        cursor.itersize = batch_size
+        cursor.execute(
+            'SELECT id, body FROM post WHERE id > %s {end} ORDER BY id'.format(end=end_condition),
+            (start_id,))
+        try:
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+        return
+
+    last_id = start_id
+    while True:
+        query = Post.select(Post.id, Post.body).where(Post.id > last_id)
+        if end_id is not None:
+            query = query.where(Post.id <= end_id)
+        posts = list(query.order_by(Post.id).limit(batch_size).tuples())
+        if not posts:
+            break
+        for row in posts:
+            yield row
+        last_id = posts[-1][0]
+
+
+def _chunks(rows, chunk_size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def latest_compute_index():
+    return max(
+        PostSnippet.select(fn.Max(PostSnippet.compute_index)).scalar() or 0,
+        PostNpmInstallPackage.select(fn.Max(PostNpmInstallPackage.compute_index)).scalar() or 0)
+
+
+def _last_scanned_post_id(compute_index):
+    ''' Get the ID of the last post that has results saved for a compute index. '''
+    return max(
+        PostSnippet.select(fn.Max(PostSnippet.post)).where(
+            PostSnippet.compute_index == compute_index).scalar() or 0,
+        PostNpmInstallPackage.select(fn.Max(PostNpmInstallPackage.post)).where(
+            PostNpmInstallPackage.compute_index == compute_index).scalar() or 0)
+
+
+def extract_snippets(start_id=0, end_id=None, resume=False, processes=None,
+                     batch_size=DEFAULT_BATCH_SIZE, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Find the snippets and npm packages in the posts with IDs greater than `start_id`
+    and at most `end_id`.  Results are saved with a new compute index.
+
+    If `resume` is set, this continues the last extraction instead, with its compute
+    index, from the last post it saved results for.  The results for a chunk of posts
+    are always saved in the same transaction, so no post's results are saved twice.
+    Returns the compute index.
+    '''
+    compute_index = latest_compute_index()
+    if resume and compute_index:
+        start_id = max(start_id, _last_scanned_post_id(compute_index))
+        logger.info("Resuming extraction %d after post %d", compute_index, start_id)
+    else:
+        compute_index += 1
+
+    patterns = list(SnippetPattern.select(SnippetPattern.id, SnippetPattern.pattern).tuples())
+    processes = processes or cpu_count()
+    date = datetime.datetime.now()
+    snippet_inserter = BatchInserter(PostSnippet, batch_size)
+    package_inserter = BatchInserter(PostNpmInstallPackage, batch_size)
+
+    def save(results, force=False):
+        snippets, packages = results
+        snippet_inserter.rows.extend([
+            {'compute_index': compute_index, 'date': date,
+             'post': post_id, 'pattern': pattern_id, 'snippet': snippet}
+            for post_id, pattern_id, snippet in snippets])
+        package_inserter.rows.extend([
+            {'compute_index': compute_index, 'date': date, 'post': post_id, 'package': package}
+            for post_id, package in packages])
+        # Both tables are saved together, so that a resumed extraction can start after
+        # the last post in either of them.
+        if force or len(snippet_inserter.rows) + len(package_inserter.rows) >= batch_size:
+            with db_proxy.atomic():
+                snippet_inserter.flush()
+                package_inserter.flush()
+
+    chunks = _chunks(iterate_post_bodies(start_id, end_id, batch_size), chunk_size)
+    post_count = 0
+    if processes == 1:
+        _init_worker(patterns)
+        for chunk in chunks:
+            save(_scan_posts(chunk))
+            post_count += len(chunk)
+            if post_count % LOG_INTERVAL < chunk_size:
+                logger.info("Scanned %d posts (up to post %d)", post_count, chunk[-1][0])
+    else:
+        pool = Pool(processes, initializer=_init_worker, initargs=(patterns,))
+        try:
+            # Only a few chunks are queued per worker, so that posts aren't read
+            # from the database much faster than they can be scanned.
+            pending = deque()
+            for chunk in chunks:
+                pending.append((chunk[-1][0], len(chunk), pool.apply_async(_scan_posts, (chunk,))))
+                while len(pending) > processes * 2 or (pending and pending[0][2].ready()):
+                    last_post_id, chunk_post_count, result = pending.popleft()
+                    save(result.get())
+                    post_count += chunk_post_count
+                    if post_count % LOG_INTERVAL < chunk_size:
+                        logger.info("Scanned %d posts (up to post %d)", post_count, last_post_id)
+            while pending:
+                save(pending.popleft()[2].get())
+        finally:
+            pool.close()
+            pool.join()
+
+    save(([], []), force=True)
+    logger.info("Finished extraction %d", compute_index)
+    return compute_index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Extract code snippets and npm packages from Stack Overflow posts")
+    parser.add_argument('--db', default='sqlite', choices=['sqlite', 'postgres'])
+    parser.add_argument('--db-config', help="Postgres credentials file")
+    parser.add_argument('--processes', type=int, help="Number of worker processes (default: one per core)")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="Number of posts sent to a worker at a time")
+    parser.add_argument('--start-id', type=int, default=0, help="Only scan posts after this ID")
+    parser.add_argument('--end-id', type=int, help="Only scan posts up to this ID")
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue the last extraction from the last post it saved results for")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+    init_database(args.db, args.db_config)
+    db_proxy.create_tables([SnippetPattern, PostSnippet, PostNpmInstallPackage], safe=True)
+    extract_snippets(
+        args.start_id, args.end_id, args.resume, args.processes, args.batch_size, args.chunk_size)
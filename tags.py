@@ -0,0 +1,148 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import argparse
+import re
+
+from peewee import fn, Field
+from models import init_database, db_proxy, BatchInserter, light_select, as_namedtuples, \
+    create_table_without_indexes, Post, Tag, PostTag
+
+
+logger = logging.getLogger('data')
+
+DEFAULT_BATCH_SIZE = 10000
+
+# Post.tags stores all of a post's tags in one string, e.g., "<python><django>"
+TAG_PATTERN = re.compile(r'<([^>]+)>')
+
+
+def normalize_tag_name(package_name):
+    '''
+    Stack Overflow tag names are lowercase, with hyphens instead of spaces.
+    This converts a package name into the form that its tag would take.
+    '''
+    return '-'.join(package_name.strip().lower().split())
+
+
+def parse_tags(tags):
+    ''' Split the tags string of a post (e.g., "<python><django>") into tag names. '''
+    return TAG_PATTERN.findall(tags) if tags else []
+
+
+def find_tag(package_name):
+    ''' Look up the Stack Overflow tag for a package.  Returns None if there is no such tag. '''
+    try:
+        return Tag.get(Tag.tag_name == normalize_tag_name(package_name))
+    except Tag.DoesNotExist:
+        return None
+
+
+def tagged_posts_query(tag):
+    '''
+    Build a query for the posts with a tag, most recent posts first.
+    Posts are found by walking the (tag_id, post_id) index of PostTag, so the
+    query never has to look at the text of posts to find them.
+    Post bodies are left out; they're loaded from a post only when they're accessed.
+    '''
+    return (
+        light_select(Post)
+        .join(PostTag, on=(PostTag.post_id == Post.id))
+        .where(PostTag.tag_id == tag.id)
+        .order_by(PostTag.post_id.desc())
+    )
+
+
+def posts_for_package(package_name, limit=10):
+    ''' Fetch the most recent posts with the tag for a package, as named tuples without bodies. '''
+    tag = find_tag(package_name)
+    if tag is None:
+        return []
+    return as_namedtuples(tagged_posts_query(tag).limit(limit))
+
+
+def ensure_post_tag_index():
+    '''
+    Add the indexes of PostTag that its table doesn't have.  The table is created
+    without them before the links are backfilled, and tables created before PostTag
+    declared its (tag_id, post_id) index don't have that one either, as `create_tables`
+    skips tables that already exist.
+    '''
+    index_columns = [index.columns for index in db_proxy.get_indexes(PostTag._meta.db_table)]
+    for fields, unique in PostTag._index_data():
+        columns = [
+            (field if isinstance(field, Field) else PostTag._meta.fields[field]).db_column
+            for field in fields]
+        if columns not in index_columns:
+            db_proxy.create_index(PostTag, fields, unique)
+
+
+def backfill_post_tags(batch_size=DEFAULT_BATCH_SIZE):
+    '''
+    Create the PostTag links for all posts, based on the tags string of each post.
+
+    Posts are read in batches in order of ID, fetching only their IDs and tags.
+    This can be resumed after it's interrupted: it will pick up at the post it
+    last saved links for.
+    '''
+    # There are only tens of thousands of tags, so we can keep a map from all tag names to IDs.
+    tag_ids = dict(Tag.select(Tag.tag_name, Tag.id).tuples())
+
+    # The links for the last post we saved might have been split across batches.
+    # Remove them, and start again from that post.
+    last_post_id = PostTag.select(fn.Max(PostTag.post_id)).scalar()
+    if last_post_id is not None:
+        PostTag.delete().where(PostTag.post_id == last_post_id).execute()
+        last_post_id -= 1
+    else:
+        last_post_id = 0
+
+    inserter = BatchInserter(PostTag, batch_size)
+    unknown_tags = set()
+    post_count = 0
+
+    while True:
+        posts = list(
+            Post.select(Post.id, Post.tags)
+            .where((Post.id > last_post_id) & (Post.tags.is_null(False)))
+            .order_by(Post.id)
+            .limit(batch_size)
+            .tuples()
+        )
+        if not posts:
+            break
+
+        for post_id, tags in posts:
+            for tag_name in parse_tags(tags):
+                tag_id = tag_ids.get(tag_name)
+                if tag_id is None:
+                    unknown_tags.add(tag_name)
+                    continue
+                inserter.insert({'post_id': post_id, 'tag_id': tag_id})
+
+        last_post_id = posts[-1][0]
+        post_count += len(posts)
+        logger.info("Linked tags for %d posts (up to post %d)", post_count, last_post_id)
+
+    if inserter.rows:
+        inserter.flush()
+
+    if unknown_tags:
+        logger.warning("%d tag names were not found in the Tag table", len(unknown_tags))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build links between Stack Overflow posts and tags")
+    parser.add_argument('--db', default='sqlite', choices=['sqlite', 'postgres'])
+    parser.add_argument('--db-config', help="Postgres credentials file")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+    init_database(args.db, args.db_config)
+    # Building the indexes after all the links are saved is faster than updating them during the load.
+    create_table_without_indexes(PostTag)
+    backfill_post_tags(args.batch_size)
+    ensure_post_tag_index()
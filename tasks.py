@@ -0,0 +1,332 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Extract tasks (e.g., "parse a JSON file") from the documentation pages found by searches.
+
+The contents of search results are streamed from the database in batches and parsed
+by a pool of worker processes with spaCy.  A task is a verb with its direct object,
+and it's linked to the lemmas of its verb and of the nouns in its object.  Lemmas are
+kept in memory with their IDs, so each new lemma is saved once, in bulk with the other
+new lemmas in its batch, rather than being looked up for every task.
+
+spaCy and its English model need to be installed:
+
+    pip install spacy && python -m spacy download en_core_web_sm
+    python tasks.py --db postgres --db-config postgres-credentials.json --processes 8
+'''
+
+from __future__ import unicode_literals
+import logging
+import argparse
+import datetime
+from collections import deque
+from html.parser import HTMLParser
+from multiprocessing import Pool, cpu_count
+
+from peewee import fn
+from models import init_database, db_proxy, using_postgres, BatchInserter, \
+    SearchResultContent, WebPageContent, Task, Verb, Noun, TaskVerb, TaskNoun
+from content_store import load_content
+
+try:
+    import spacy
+except ImportError:
+    spacy = None
+
+
+logger = logging.getLogger('data')
+
+SPACY_MODEL = 'en_core_web_sm'
+# The number of search results whose contents are read at a time
+DEFAULT_BATCH_SIZE = 200
+# The number of pages sent to a worker at a time
+DEFAULT_CHUNK_SIZE = 20
+# Objects longer than this are usually parsing mistakes, rather than tasks.
+MAX_OBJECT_WORDS = 6
+# The number of new lemmas whose IDs are looked up in one query
+LEMMA_LOOKUP_BATCH_SIZE = 500
+TASK_MODE = 'verb-object'
+
+SKIPPED_TAGS = set(['script', 'style', 'noscript'])
+BLOCK_TAGS = set([
+    'p', 'div', 'br', 'li', 'ul', 'ol', 'pre', 'table', 'tr', 'td', 'th', 'section',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'article', 'header', 'footer',
+])
+
+
+class _TextExtractor(HTMLParser):
+    ''' Collects the visible text of an HTML page, with a line break after each block. '''
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.parts = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self.skip_depth += 1
+        elif tag in BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.parts.append(data)
+
+
+def html_text(html):
+    extractor = _TextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return ''.join(extractor.parts)
+
+
+def extract_tasks(document):
+    '''
+    Find the tasks in a document parsed by spaCy.  Returns a list of
+    (task, verb lemma, noun lemmas) tuples.
+    '''
+    tasks = []
+    for token in document:
+        if token.pos_ != 'VERB':
+            continue
+        for child in token.children:
+            if child.dep_ not in ('dobj', 'obj'):
+                continue
+            object_tokens = list(child.subtree)
+            if len(object_tokens) > MAX_OBJECT_WORDS:
+                continue
+            nouns = [
+                object_token.lemma_.lower() for object_token in object_tokens
+                if object_token.pos_ in ('NOUN', 'PROPN')]
+            if not nouns:
+                continue
+            task = ' '.join([token.lemma_] + [object_token.text for object_token in object_tokens])
+            tasks.append((task.lower(), token.lemma_.lower(), nouns))
+    return tasks
+
+
+# The spaCy pipeline for a worker process, which is loaded once when the worker starts
+_nlp = None
+
+
+def _init_worker(model_name):
+    global _nlp
+    _nlp = spacy.load(model_name, disable=['ner'])
+
+
+def _parse_pages(pages):
+    '''
+    Find the tasks in a chunk of pages, given as (page ID, HTML) pairs.
+    Returns a list of (page ID, tasks) pairs.  Pages are parsed together, which
+    is much faster than parsing them one at a time.  spaCy refuses to parse texts
+    longer than its `max_length`, so only the start of longer pages is parsed.
+    '''
+    page_ids = [page_id for page_id, _ in pages]
+    texts = [html_text(html) for _, html in pages]
+    for index, text in enumerate(texts):
+        if len(text) > _nlp.max_length:
+            logger.warning("Only parsing the first %d of %d characters of page %s",
+                           _nlp.max_length, len(text), page_ids[index])
+            texts[index] = text[:_nlp.max_length]
+    return [
+        (page_id, extract_tasks(document))
+        for page_id, document in zip(page_ids, _nlp.pipe(texts))]
+
+
+class LemmaTable(object):
+    '''
+    The IDs of all lemmas of one kind (e.g., verbs), kept in memory.  New lemmas are
+    collected with `add`, and saved together by `save_new_lemmas`.
+    '''
+    def __init__(self, ModelType, field):
+        self.ModelType = ModelType
+        self.field = field
+        self.ids = dict(ModelType.select(field, ModelType.id).tuples())
+        self.new_lemmas = set()
+
+    def add(self, lemma):
+        if lemma not in self.ids:
+            self.new_lemmas.add(lemma)
+
+    def save_new_lemmas(self):
+        if not self.new_lemmas:
+            return
+        lemmas = sorted(self.new_lemmas)
+        inserter = BatchInserter(self.ModelType, len(lemmas))
+        for lemma in lemmas:
+            inserter.insert({self.field.name: lemma})
+        inserter.flush()
+
+        # The IDs are looked up in batches, to stay under the limit on query parameters.
+        for start in range(0, len(lemmas), LEMMA_LOOKUP_BATCH_SIZE):
+            self.ids.update(
+                self.ModelType.select(self.field, self.ModelType.id)
+                .where(self.field << lemmas[start:start + LEMMA_LOOKUP_BATCH_SIZE])
+                .tuples())
+        self.new_lemmas = set()
+
+
+def _read_pages(start_id, batch_size):
+    '''
+    Yield batches of search results with an ID greater than `start_id`, in order of ID.
+    Each batch is a list of (search result content ID, page ID) pairs, and a dictionary
+    from the ID of each page in the batch to its HTML.
+    '''
+    last_id = start_id
+    while True:
+        rows = list(
+            SearchResultContent.select(
+                SearchResultContent.id, WebPageContent.id,
+                WebPageContent.content, WebPageContent.digest)
+            .join(WebPageContent)
+            .where(SearchResultContent.id > last_id)
+            .order_by(SearchResultContent.id)
+            .limit(batch_size)
+            .tuples()
+        )
+        if not rows:
+            break
+
+        pages = {}
+        for _, page_id, content, digest in rows:
+            if page_id not in pages:
+                pages[page_id] = (content if content is not None else load_content(digest)) or ''
+        yield [(row[0], row[1]) for row in rows], pages
+        last_id = rows[-1][0]
+
+
+def reserve_task_ids(count):
+    '''
+    Reserve IDs for `count` new tasks, so that tasks can be saved with known IDs and
+    linked to their lemmas without reading the IDs back.  On Postgres, the IDs are taken
+    from the table's sequence.  On Sqlite, they follow the largest saved ID, so this has
+    to be called in a transaction that holds the write lock until the tasks are saved.
+    '''
+    if count == 0:
+        return []
+    if using_postgres():
+        cursor = db_proxy.execute_sql(
+            "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+            (Task._meta.db_table, count))
+        return [task_id for task_id, in cursor.fetchall()]
+    last_task_id = Task.select(fn.Max(Task.id)).scalar() or 0
+    return list(range(last_task_id + 1, last_task_id + 1 + count))
+
+
+def latest_compute_index():
+    return Task.select(fn.Max(Task.compute_index)).scalar() or 0
+
+
+def extract_all_tasks(resume=False, processes=None, batch_size=DEFAULT_BATCH_SIZE,
+                      chunk_size=DEFAULT_CHUNK_SIZE, model_name=SPACY_MODEL):
+    '''
+    Extract the tasks from the contents of all search results, and save them with a new
+    compute index.  The tasks and links for each batch of search results are saved in one
+    transaction.  If `resume` is set, this continues the last extraction instead, after
+    the last search result it saved tasks for.  Returns the compute index.
+    '''
+    if spacy is None:
+        raise RuntimeError("spaCy is needed to extract tasks (pip install spacy)")
+
+    compute_index = latest_compute_index()
+    start_id = 0
+    if resume and compute_index:
+        start_id = Task.select(fn.Max(Task.search_result_content)).where(
+            Task.compute_index == compute_index).scalar() or 0
+        logger.info("Resuming extraction %d after search result %d", compute_index, start_id)
+    else:
+        compute_index += 1
+
+    date = datetime.datetime.now()
+    verbs = LemmaTable(Verb, Verb.verb)
+    nouns = LemmaTable(Noun, Noun.noun)
+    task_inserter = BatchInserter(Task, batch_size)
+    verb_inserter = BatchInserter(TaskVerb, batch_size)
+    noun_inserter = BatchInserter(TaskNoun, batch_size)
+    processes = processes or cpu_count()
+
+    def save(search_results, page_tasks):
+        ''' Save the tasks for a batch of search results, given the tasks found on each page. '''
+        for _, page_id in search_results:
+            for _, verb, noun_lemmas in page_tasks[page_id]:
+                verbs.add(verb)
+                for noun in noun_lemmas:
+                    nouns.add(noun)
+
+        # On Sqlite, the write lock is taken at the start, so that no other writer can
+        # save tasks between reserving the tasks' IDs and saving them.
+        with db_proxy.atomic(None if using_postgres() else 'IMMEDIATE'):
+            verbs.save_new_lemmas()
+            nouns.save_new_lemmas()
+
+            # Tasks are saved with reserved IDs, so each one's links use its own ID.
+            tasks = [
+                (search_result_id, task, verb, noun_lemmas)
+                for search_result_id, page_id in search_results
+                for task, verb, noun_lemmas in page_tasks[page_id]]
+            task_ids = reserve_task_ids(len(tasks))
+            for task_id, (search_result_id, task, _, _) in zip(task_ids, tasks):
+                task_inserter.insert({
+                    'id': task_id, 'compute_index': compute_index, 'date': date, 'task': task,
+                    'mode': TASK_MODE, 'search_result_content': search_result_id})
+            task_inserter.flush()
+
+            for task_id, (_, _, verb, noun_lemmas) in zip(task_ids, tasks):
+                verb_inserter.insert({'task': task_id, 'verb': verbs.ids[verb]})
+                for noun in noun_lemmas:
+                    noun_inserter.insert({'task': task_id, 'noun': nouns.ids[noun]})
+            verb_inserter.flush()
+            noun_inserter.flush()
+
+    pool = Pool(processes, initializer=_init_worker, initargs=(model_name,))
+    try:
+        # Only a few batches are parsed ahead of the one being saved, so that pages
+        # aren't read from the database much faster than they can be parsed.
+        pending = deque()
+        result_count = 0
+        for search_results, pages in _read_pages(start_id, batch_size):
+            page_items = list(pages.items())
+            chunks = [
+                pool.apply_async(_parse_pages, (page_items[start:start + chunk_size],))
+                for start in range(0, len(page_items), chunk_size)]
+            pending.append((search_results, chunks))
+
+            while len(pending) > 2:
+                batch, batch_chunks = pending.popleft()
+                save(batch, dict(item for chunk in batch_chunks for item in chunk.get()))
+                result_count += len(batch)
+                logger.info("Extracted tasks from %d search results", result_count)
+        while pending:
+            batch, batch_chunks = pending.popleft()
+            save(batch, dict(item for chunk in batch_chunks for item in chunk.get()))
+    finally:
+        pool.close()
+        pool.join()
+
+    logger.info("Finished extraction %d", compute_index)
+    return compute_index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Extract tasks from documentation pages")
+    parser.add_argument('--db', default='sqlite', choices=['sqlite', 'postgres'])
+    parser.add_argument('--db-config', help="Postgres credentials file")
+    parser.add_argument('--processes', type=int, help="Number of worker processes (default: one per core)")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="Number of pages sent to a worker at a time")
+    parser.add_argument('--model', default=SPACY_MODEL, help="spaCy model to parse pages with")
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue the last extraction after the last search result it saved tasks for")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+    init_database(args.db, args.db_config)
+    db_proxy.create_tables([Task, Verb, Noun, TaskVerb, TaskNoun], safe=True)
+    extract_all_tasks(args.resume, args.processes, args.batch_size, args.chunk_size, args.model)
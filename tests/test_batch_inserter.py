@@ -0,0 +1,53 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests for the rows that BatchInserter accepts.
+'''
+
+from __future__ import unicode_literals
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from models import init_database, db_proxy, BatchInserter, Tag
+
+
+class BatchInserterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        init_database('sqlite', sqlite_filename=os.path.join(self.directory, 'test.db'))
+        db_proxy.create_tables([Tag], safe=True)
+
+    def tearDown(self):
+        db_proxy.close()
+        shutil.rmtree(self.directory)
+
+    def test_unknown_field_in_later_row_is_rejected(self):
+        inserter = BatchInserter(Tag, 10)
+        inserter.insert({'tag_name': 'python', 'count': 1})
+        inserter.insert({'tag_name': 'django', 'count': 1, 'bogus': 1})
+        with self.assertRaises(ValueError):
+            inserter.flush()
+        self.assertEqual(Tag.select().count(), 0)
+
+    def test_explicit_ids_are_saved_in_every_batch(self):
+        inserter = BatchInserter(Tag, 2)
+        for tag_name in ['python', 'django']:
+            inserter.insert({'tag_name': tag_name, 'count': 1})
+        inserter.insert({'id': 99, 'tag_name': 'flask', 'count': 1})
+        inserter.flush()
+        self.assertEqual(Tag.get(Tag.tag_name == 'flask').id, 99)
+
+    def test_rows_that_disagree_about_ids_are_rejected(self):
+        inserter = BatchInserter(Tag, 10)
+        inserter.insert({'tag_name': 'python', 'count': 1})
+        inserter.insert({'id': 99, 'tag_name': 'django', 'count': 1})
+        with self.assertRaises(ValueError):
+            inserter.flush()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests for syncing GitHub projects, using responses from a fixture file instead of the API.
+'''
+
+from __future__ import unicode_literals
+import copy
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from models import init_database, db_proxy, GitHubProject, GitHubSyncState, \
+    Issue, IssueComment, IssueEvent
+from github_sync import FixtureClient, sync_project
+
+
+FIXTURE_PATH = os.path.join(os.path.dirname(__file__), 'fixtures', 'github_sync.json')
+PROJECT = ('requests', 'psf', 'requests')
+
+
+class FailingClient(FixtureClient):
+    ''' Serves the first page of issues, then fails as if the connection was lost. '''
+
+    def issues(self, owner, repo, since=None):
+        pages = FixtureClient.issues(self, owner, repo, since)
+        yield next(pages)
+        raise IOError("Connection reset")
+
+
+class SyncProjectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        init_database('sqlite', sqlite_filename=os.path.join(self.directory, 'test.db'))
+        db_proxy.create_tables(
+            [GitHubProject, Issue, IssueComment, IssueEvent, GitHubSyncState], safe=True)
+        self.client = FixtureClient(FIXTURE_PATH)
+        self.repository = self.client.repositories['psf/requests']
+
+    def tearDown(self):
+        db_proxy.close()
+        shutil.rmtree(self.directory)
+
+    def sync(self, fetch_index):
+        return sync_project(self.client, *PROJECT, fetch_index=fetch_index)
+
+    def change(self, key, index, **fields):
+        ''' Change an item in the fixture, as if it had changed on GitHub. '''
+        item = self.repository[key][index]
+        item.update(fields)
+        return item
+
+    def add(self, key, item, **fields):
+        ''' Add a copy of an item to the fixture, with some of its fields changed. '''
+        item = copy.deepcopy(item)
+        item.update(fields)
+        self.repository[key].append(item)
+
+    def test_first_sync_inserts_everything(self):
+        self.assertEqual(self.sync(1), (2, 1, 2))
+        self.assertEqual(
+            sorted(Issue.select(Issue.number, Issue.state).tuples()), [(1, 'open'), (2, 'open')])
+        self.assertEqual(IssueComment.get().body, "I can reproduce this")
+        self.assertEqual(sorted(event.event for event in IssueEvent.select()), ['assigned', 'labeled'])
+        self.assertEqual(GitHubProject.get().fetch_index, 1)
+
+    def test_sync_without_changes_saves_nothing(self):
+        self.sync(1)
+        self.assertEqual(self.sync(2), (0, 0, 0))
+        self.assertEqual(Issue.select().count(), 2)
+        self.assertEqual(IssueEvent.select().count(), 2)
+        # The project keeps its fetch index, so rollups and caches don't refresh for nothing.
+        self.assertEqual(GitHubProject.get().fetch_index, 1)
+
+    def test_updated_issue_and_comment_replace_saved_rows(self):
+        self.sync(1)
+        self.change('issues', 0, state='closed', updated_at='2017-01-05T09:00:00Z',
+                    closed_at='2017-01-05T09:00:00Z')
+        self.change('comments', 0, body="Fixed in 2.14", updated_at='2017-01-05T09:00:00Z')
+
+        self.assertEqual(self.sync(2), (1, 1, 0))
+        issue = Issue.get(Issue.number == 1)
+        self.assertEqual((issue.state, issue.fetch_index), ('closed', 2))
+        self.assertEqual(Issue.select().count(), 2)
+        self.assertEqual(IssueComment.get().body, "Fixed in 2.14")
+        self.assertEqual(GitHubProject.get().fetch_index, 2)
+
+    def test_item_updated_in_same_second_as_watermark_is_saved(self):
+        self.sync(1)
+        # Updated in the same second as the newest issue and comment saved by the last sync
+        self.add('issues', self.repository['issues'][1], id=1003, number=3, body="Add a CLI")
+        self.add('comments', self.repository['comments'][0], id=2002, body="Me too")
+
+        self.assertEqual(self.sync(2), (1, 1, 0))
+        self.assertEqual(sorted(number for number, in Issue.select(Issue.number).tuples()), [1, 2, 3])
+        self.assertEqual(IssueComment.select().count(), 2)
+
+    def test_events_stop_at_newest_saved_event(self):
+        self.sync(1)
+        # A new event, another one in the same second as the newest saved one, and an old
+        # event that would only be listed after the saved ones.
+        self.add('events', self.repository['events'][0], id=3003, created_at='2017-01-06T09:00:00Z',
+                 event='closed')
+        self.add('events', self.repository['events'][1], id=3004, event='labeled')
+        self.add('events', self.repository['events'][0], id=3005, created_at='2017-01-01T09:00:00Z',
+                 event='mentioned')
+
+        self.assertEqual(self.sync(2), (0, 0, 2))
+        self.assertEqual(
+            sorted(github_id for github_id, in IssueEvent.select(IssueEvent.github_id).tuples()),
+            [3001, 3002, 3003, 3004])
+        self.assertEqual(GitHubSyncState.get().events_created_at.day, 6)
+
+    def test_sync_resumes_after_last_saved_page(self):
+        with self.assertRaises(IOError):
+            sync_project(FailingClient(FIXTURE_PATH, page_size=1), *PROJECT, fetch_index=1)
+        # The first page was saved, with the watermark that it advanced.
+        self.assertEqual([number for number, in Issue.select(Issue.number).tuples()], [1])
+        self.assertEqual(GitHubSyncState.get().issues_updated_at,
+                         Issue.get(Issue.number == 1).updated_at)
+
+        self.client.page_size = 1
+        self.assertEqual(self.sync(1), (1, 1, 2))
+        self.assertEqual(Issue.select().count(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests for converting full question snapshots into keyframes and deltas.
+'''
+
+from __future__ import unicode_literals
+import datetime
+import os.path
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from models import init_database, db_proxy, QuestionSnapshot, QuestionSnapshotTag, \
+    QuestionSnapshotDelta
+from snapshots import compact_snapshots, question_series
+
+
+QUESTION_IDS = [1, 2, 3]
+POLL_COUNT = 12
+
+
+def _snapshot(question_id, day):
+    ''' A full snapshot, as saved before deltas were used.  Views and score go up every day. '''
+    return {
+        'fetch_index': day, 'date': datetime.datetime(2017, 1, day), 'question_id': question_id,
+        'owner_id': 1, 'title': "Question %d" % question_id,
+        # The body is edited halfway, which starts a new keyframe.
+        'body': "Body" if day <= POLL_COUNT // 2 else "Edited body",
+        'comment_count': 0, 'delete_vote_count': 0, 'reopen_vote_count': 0, 'close_vote_count': 0,
+        'is_answered': day > 3, 'view_count': 10 * day * question_id, 'favorite_count': 0,
+        'down_vote_count': 0, 'up_vote_count': day, 'answer_count': day // 4, 'score': day,
+        'last_activity_date': datetime.datetime(2017, 1, day),
+        'creation_date': datetime.datetime(2017, 1, 1),
+    }
+
+
+class CompactSnapshotsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        init_database('sqlite', sqlite_filename=os.path.join(self.directory, 'test.db'))
+        db_proxy.create_tables(
+            [QuestionSnapshot, QuestionSnapshotTag, QuestionSnapshotDelta], safe=True)
+        for question_id in QUESTION_IDS:
+            for day in range(1, POLL_COUNT + 1):
+                snapshot_id = QuestionSnapshot.insert(**_snapshot(question_id, day)).execute()
+                QuestionSnapshotTag.insert(question_snapshot_id=snapshot_id, tag_id=7).execute()
+
+    def tearDown(self):
+        db_proxy.close()
+        shutil.rmtree(self.directory)
+
+    def series_values(self, question_id):
+        series = question_series(question_id)
+        return list(series.timestamps), {
+            name: list(values) for name, values in series.columns.items()}
+
+    def test_compacted_series_reads_back_the_same(self):
+        before = {question_id: self.series_values(question_id) for question_id in QUESTION_IDS}
+
+        # Each batch has far more deltas than the batch size.
+        replaced_count = compact_snapshots(batch_size=2, keyframe_interval=4)
+        self.assertGreater(replaced_count, 0)
+        self.assertGreater(QuestionSnapshotDelta.select().count(), 2)
+        self.assertEqual(
+            QuestionSnapshot.select().count(), len(QUESTION_IDS) * POLL_COUNT - replaced_count)
+
+        for question_id in QUESTION_IDS:
+            self.assertEqual(self.series_values(question_id), before[question_id])
+        # Compacted questions are skipped.
+        self.assertEqual(compact_snapshots(batch_size=2), 0)
+
+    def test_failed_batch_saves_no_deltas(self):
+        before = {question_id: self.series_values(question_id) for question_id in QUESTION_IDS}
+
+        with mock.patch.object(QuestionSnapshot, 'delete', side_effect=RuntimeError("crash")):
+            with self.assertRaises(RuntimeError):
+                compact_snapshots(batch_size=2, keyframe_interval=4)
+        self.assertEqual(QuestionSnapshotDelta.select().count(), 0)
+        self.assertEqual(QuestionSnapshot.select().count(), len(QUESTION_IDS) * POLL_COUNT)
+
+        # The next run converts the questions as if the failed one never happened.
+        compact_snapshots(batch_size=2, keyframe_interval=4)
+        for question_id in QUESTION_IDS:
+            self.assertEqual(self.series_values(question_id), before[question_id])
+
+
+if __name__ == '__main__':
+    unittest.main()